@@ -0,0 +1,244 @@
+"""This file contains the compact callback data codec and the callback dispatch table"""
+
+from dataclasses import dataclass, replace
+from enum import Enum
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+
+from app.database.models import TaskStatus
+
+VERSION = "1"
+SEPARATOR = ":"
+MAX_LENGTH = 64
+
+
+class Action(Enum):
+    """
+    Represents what a button does, encoded as a short code in the callback data.
+    """
+
+    MAIN_MENU = "m"
+    NEW_TASK = "nt"
+    TASK = "t"
+    TASK_STATUS = "ts"
+    CHANGE_TASK = "ct"
+    DELETE_TASK = "dt"
+    RENAME_TASK = "rt"
+    CANCEL_RENAME_TASK = "xt"
+    ADD_COMMENT = "ac"
+    CANCEL_COMMENT = "xc"
+    DUE_DATE = "dd"
+    GENERAL_TASKS = "gl"
+    PROJECT_TASKS = "tl"
+    NEW_PROJECT = "np"
+    PROJECTS = "pl"
+    PROJECT = "p"
+    CHANGE_PROJECT = "cp"
+    DELETE_PROJECT = "dp"
+    RENAME_PROJECT = "rp"
+    CANCEL_RENAME_PROJECT = "xp"
+    CANCEL = "x"
+    SELECT_TASKS = "s"
+    TOGGLE_TASK = "st"
+    BULK_STATUS = "bs"
+    BULK_DELETE = "bd"
+    BULK_MOVE = "bm"
+    BULK_MOVE_TO = "bt"
+    CANCEL_SELECT = "xs"
+    SEARCH = "f"
+    SEARCH_PAGE = "fp"
+    INLINE_STATUS = "is"
+
+
+class Position(Enum):
+    """
+    Represents the screen a flow was started from, so it can return there.
+
+    Attributes:
+        GENERAL: The main menu or the list of general tasks.
+        LIST: A list of projects or project tasks.
+        PROJECT: The project menu.
+    """
+
+    GENERAL = "g"
+    LIST = "l"
+    PROJECT = "p"
+
+
+# Fields packed for each action, in order. Fields left out are always None.
+SCHEMAS = {
+    Action.MAIN_MENU: (),
+    Action.NEW_TASK: ("project_id", "position"),
+    Action.TASK: ("project_id", "task_id", "position"),
+    Action.TASK_STATUS: ("project_id", "task_id", "position", "status", "version"),
+    Action.CHANGE_TASK: ("project_id", "task_id", "position"),
+    Action.DELETE_TASK: ("project_id", "task_id", "position"),
+    Action.RENAME_TASK: ("project_id", "task_id", "position"),
+    Action.CANCEL_RENAME_TASK: ("project_id", "task_id", "position"),
+    Action.ADD_COMMENT: ("project_id", "task_id", "position"),
+    Action.CANCEL_COMMENT: ("project_id", "task_id", "position"),
+    Action.DUE_DATE: ("project_id", "task_id", "position"),
+    Action.GENERAL_TASKS: ("after", "before"),
+    Action.PROJECT_TASKS: ("project_id", "after", "before"),
+    Action.NEW_PROJECT: ("position",),
+    Action.PROJECTS: ("after", "before"),
+    Action.PROJECT: ("project_id",),
+    Action.CHANGE_PROJECT: ("project_id",),
+    Action.DELETE_PROJECT: ("project_id",),
+    Action.RENAME_PROJECT: ("project_id",),
+    Action.CANCEL_RENAME_PROJECT: ("project_id",),
+    Action.CANCEL: ("project_id", "position"),
+    Action.SELECT_TASKS: ("project_id", "position", "after", "before"),
+    Action.TOGGLE_TASK: ("project_id", "task_id", "position", "after", "before"),
+    Action.BULK_STATUS: ("project_id", "position", "status"),
+    Action.BULK_DELETE: ("project_id", "position"),
+    Action.BULK_MOVE: ("project_id", "position", "after", "before"),
+    Action.BULK_MOVE_TO: ("project_id", "position", "target_id"),
+    Action.CANCEL_SELECT: ("project_id", "position"),
+    Action.SEARCH: (),
+    Action.SEARCH_PAGE: ("page",),
+    Action.INLINE_STATUS: ("project_id", "task_id", "status", "version"),
+}
+
+# Types of the fields that are not integers
+FIELD_TYPES = {"position": Position, "status": TaskStatus}
+
+_ACTIONS = {action.value: action for action in Action}
+
+
+def _pack_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, Enum):
+        return str(value.value)
+    return str(value)
+
+
+def _unpack_value(name, value):
+    if value == "":
+        return None
+    kind = FIELD_TYPES.get(name, int)
+    if kind is TaskStatus:
+        return TaskStatus(int(value))
+    return kind(value)
+
+
+@dataclass(frozen=True)
+class CallbackPayload:
+    """
+    Represents the typed content of a button's callback data.
+
+    Packed as "{VERSION}:{action code}:{field}:..." with the fields listed in SCHEMAS.
+    """
+
+    action: Action
+    project_id: int | None = None
+    task_id: int | None = None
+    position: Position | None = None
+    status: TaskStatus | None = None
+    after: int | None = None
+    before: int | None = None
+    target_id: int | None = None
+    version: int | None = None
+    page: int | None = None
+
+    def pack(self) -> str:
+        """
+        Packs the payload into callback data.
+
+        Raises:
+            ValueError: If the callback data does not fit into Telegram's 64 bytes.
+        """
+        parts = [VERSION, self.action.value]
+        parts.extend(_pack_value(getattr(self, name)) for name in SCHEMAS[self.action])
+        data = SEPARATOR.join(parts)
+        if len(data.encode()) > MAX_LENGTH:
+            raise ValueError(f"Callback data is longer than {MAX_LENGTH} bytes: {data}")
+        return data
+
+    @classmethod
+    def unpack(cls, data: str | None):
+        """
+        Unpacks callback data created by `pack`.
+
+        Returns:
+            CallbackPayload | None: The payload, or None if the data was created
+                by another version of the bot or is malformed.
+        """
+        if not data:
+            return None
+        parts = data.split(SEPARATOR)
+        if len(parts) < 2 or parts[0] != VERSION or parts[1] not in _ACTIONS:
+            return None
+        action = _ACTIONS[parts[1]]
+        names = SCHEMAS[action]
+        if len(parts) != len(names) + 2:
+            return None
+        try:
+            values = {
+                name: _unpack_value(name, value)
+                for name, value in zip(names, parts[2:])
+            }
+        except ValueError:
+            return None
+        return cls(action, **values)
+
+    def to(self, action: Action, **changes):
+        """Creates a payload for another action that keeps the fields of this one"""
+        return replace(self, action=action, **changes)
+
+
+def pack(action: Action, **values) -> str:
+    """Packs callback data for an action, a shortcut for CallbackPayload(...).pack()"""
+    return CallbackPayload(action, **values).pack()
+
+
+class CallbackPayloadMiddleware(BaseMiddleware):
+    """
+    Unpacks the callback data of every callback query once
+    and passes it to the handlers as `payload`.
+    """
+
+    async def __call__(self, handler, event: CallbackQuery, data):
+        data["payload"] = CallbackPayload.unpack(event.data)
+        return await handler(event, data)
+
+
+class CallbackTable:
+    """
+    Dispatch table of callback query handlers keyed by action.
+
+    Handlers are called with the callback query, its payload and the FSM context.
+    Routing takes one dictionary lookup no matter how many handlers are registered.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.fallback = None
+
+    def on(self, action: Action):
+        """Registers a handler for the action"""
+
+        def decorator(handler):
+            if action in self.handlers:
+                raise ValueError(f"A handler for {action} is already registered")
+            self.handlers[action] = handler
+            return handler
+
+        return decorator
+
+    def on_unknown(self, handler):
+        """Registers a handler for callback data that could not be unpacked"""
+        self.fallback = handler
+        return handler
+
+    def resolve(self, payload: CallbackPayload | None):
+        """Returns the handler for a payload"""
+        if payload is None:
+            return self.fallback
+        return self.handlers.get(payload.action, self.fallback)
+
+    async def dispatch(self, callback: CallbackQuery, payload, state):
+        """Calls the handler registered for the action of the payload"""
+        return await self.resolve(payload)(callback, payload, state)
@@ -0,0 +1,117 @@
+"""This file contains the in-process caches of data read from the bot database"""
+
+import time
+from collections import OrderedDict
+
+import app.config as config
+
+
+class Versions:
+    """
+    Version counters of the data of every user and project.
+
+    Every write in `requests.py` bumps the counters of the data it changes after the
+    write is committed, so anything cached under an older version is known to be stale.
+    The counters live in the process, which is fine as long as one process writes
+    to the database, like the single writer already requires.
+    """
+
+    def __init__(self):
+        self._users: dict[int, int] = {}
+        self._projects: dict[int, int] = {}
+
+    def bump_user(self, user_id: int):
+        """Marks the projects of the user and the tasks found by searching them as changed"""
+        self._users[user_id] = self._users.get(user_id, 0) + 1
+
+    def bump_project(self, project_id: int):
+        """Marks the project and its tasks as changed"""
+        self._projects[project_id] = self._projects.get(project_id, 0) + 1
+
+    def of(self, user_id: int, project_id: int | None = None) -> tuple[int, int]:
+        """Returns the current version of the data of a user and a project"""
+        project_version = 0 if project_id is None else self._projects.get(project_id, 0)
+        return self._users.get(user_id, 0), project_version
+
+
+class VersionedCache:
+    """
+    LRU cache of values built from the data of a user and, optionally, a project.
+
+    A value is reused only while the versions of that user and project
+    are the same as when the value was built.
+
+    Args:
+        versions (Versions): The version counters the values depend on.
+        size (int): The maximum number of cached values.
+    """
+
+    def __init__(self, versions: Versions, size: int = config.CACHE_SIZE):
+        self.versions = versions
+        self.size = size
+        self._entries: OrderedDict = OrderedDict()
+
+    async def get(self, key, user_id, project_id, build):
+        """
+        Returns the cached value of the key, building it with `build()` if it is stale.
+
+        Args:
+            key (Hashable): The key of the value, must include the user and the project.
+            user_id (int): The TG ID of the user the value depends on.
+            project_id (int | None): The ID of the project the value depends on.
+            build (Callable[[], Awaitable]): Builds the value.
+        """
+        # Read before building: a write committed meanwhile leaves the value stale, not wrong
+        version = self.versions.of(user_id, project_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            return entry[1]
+        value = await build()
+        self._entries[key] = (version, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Drops all cached values"""
+        self._entries.clear()
+
+
+class TTLCache(VersionedCache):
+    """
+    VersionedCache whose values also expire `ttl` seconds after they were built,
+    for values that are not worth keeping even while the data is unchanged.
+
+    Args:
+        versions (Versions): The version counters the values depend on.
+        ttl (float): Seconds a value is reused for.
+        size (int): The maximum number of cached values.
+    """
+
+    def __init__(self, versions: Versions, ttl: float, size: int = config.CACHE_SIZE):
+        super().__init__(versions, size)
+        self.ttl = ttl
+
+    async def get(self, key, user_id, project_id, build):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1][0] < time.monotonic():
+            del self._entries[key]
+
+        async def _build():
+            return time.monotonic() + self.ttl, await build()
+
+        return (await super().get(key, user_id, project_id, _build))[1]
+
+
+versions = Versions()
+
+# Rendered inline keyboards by (user, view, project, page)
+keyboards = VersionedCache(versions)
+
+# Project names and IDs of the "General" projects
+projects = VersionedCache(versions)
+
+# Inline query results by (user, query, offset), every task write bumps the user version
+inline_results = TTLCache(versions, config.INLINE_CACHE_TTL)
@@ -0,0 +1,330 @@
+"""This file contains versioned schema migrations for the bot database"""
+
+import logging
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+)
+
+logger = logging.getLogger(__name__)
+
+version_metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(256), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+# Recomputes the task counters of all projects from the tasks
+RECOUNT_PROJECT_TASKS = """
+UPDATE projects SET
+    tasks_notstarted = (SELECT COUNT(*) FROM tasks
+        WHERE tasks.project_id = projects.id AND tasks.status = 'NOTSTARTED'),
+    tasks_inprogress = (SELECT COUNT(*) FROM tasks
+        WHERE tasks.project_id = projects.id AND tasks.status = 'INPROGRESS'),
+    tasks_completed = (SELECT COUNT(*) FROM tasks
+        WHERE tasks.project_id = projects.id AND tasks.status = 'COMPLETED')
+"""
+
+
+def migration(version):
+    """
+    Registers a function as the schema migration with the given version.
+
+    The function receives a synchronous connection and the metadata of the models.
+    Migrations run on databases created by any earlier version of the bot,
+    including freshly created ones, so they have to tolerate objects that already exist.
+    """
+
+    def decorator(func):
+        MIGRATIONS.append((version, func))
+        return func
+
+    return decorator
+
+
+def create_indexes(conn, metadata, *names):
+    """Creates the model indexes with the given names unless they already exist."""
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names:
+                index.create(conn, checkfirst=True)
+
+
+@migration(1)
+def add_lookup_indexes(conn, metadata):
+    """Add unique lookup indexes on users, projects and tasks"""
+    # Rows violating the new unique indexes could be created by renaming,
+    # keep the oldest row as is and make the names of the others unique.
+    conn.execute(
+        text(
+            "DELETE FROM users WHERE id NOT IN "
+            "(SELECT MIN(id) FROM users GROUP BY tg_id)"
+        )
+    )
+    conn.execute(
+        text(
+            "UPDATE projects SET name = name || ' (' || id || ')' WHERE id NOT IN "
+            "(SELECT MIN(id) FROM projects GROUP BY user_id, name)"
+        )
+    )
+    conn.execute(
+        text(
+            "UPDATE tasks SET name = name || ' (' || id || ')' WHERE id NOT IN "
+            "(SELECT MIN(id) FROM tasks GROUP BY project_id, user_id, name)"
+        )
+    )
+    create_indexes(
+        conn,
+        metadata,
+        "ix_users_tg_id",
+        "ix_projects_user_id_name",
+        "ix_projects_user_id_id",
+        "ix_tasks_project_id_user_id_name",
+        "ix_tasks_project_id_user_id_id",
+    )
+
+
+@migration(2)
+def add_task_versions(conn, metadata):
+    """Add row versions to tasks and derive the status emoji instead of storing it"""
+    columns = {column["name"] for column in inspect(conn).get_columns("tasks")}
+    if "version" not in columns:
+        conn.execute(
+            text("ALTER TABLE tasks ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+        )
+    if "emoji" in columns:
+        conn.execute(text("ALTER TABLE tasks DROP COLUMN emoji"))
+
+
+@migration(3)
+def add_project_task_counters(conn, metadata):
+    """Add per-status task counters to projects"""
+    columns = {column["name"] for column in inspect(conn).get_columns("projects")}
+    for status in ("notstarted", "inprogress", "completed"):
+        if f"tasks_{status}" not in columns:
+            conn.execute(
+                text(
+                    f"ALTER TABLE projects ADD COLUMN tasks_{status} "
+                    "INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+    conn.execute(text(RECOUNT_PROJECT_TASKS))
+
+
+# Full-text index of the names and comments of tasks (SQLite FTS5), kept in sync by triggers.
+# The user_id column scopes a search to one user inside the index itself.
+SQLITE_TASK_SEARCH = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+        user_id, name, comment,
+        content='tasks', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts(rowid, user_id, name, comment)
+        VALUES (new.id, new.user_id, new.name, new.comment);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, user_id, name, comment)
+        VALUES ('delete', old.id, old.user_id, old.name, old.comment);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS tasks_fts_update
+    AFTER UPDATE OF user_id, name, comment ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, user_id, name, comment)
+        VALUES ('delete', old.id, old.user_id, old.name, old.comment);
+        INSERT INTO tasks_fts(rowid, user_id, name, comment)
+        VALUES (new.id, new.user_id, new.name, new.comment);
+    END
+    """,
+    # Matches in names weigh more than matches in comments, user IDs do not count
+    "INSERT INTO tasks_fts(tasks_fts, rank) VALUES ('rank', 'bm25(0.0, 10.0, 1.0)')",
+    "INSERT INTO tasks_fts(tasks_fts) VALUES ('rebuild')",
+)
+
+# PostgreSQL has no FTS5, a GIN index on the same text serves the same queries
+POSTGRESQL_TASK_SEARCH = (
+    """
+    CREATE INDEX IF NOT EXISTS ix_tasks_search ON tasks
+    USING GIN (to_tsvector('simple', name || ' ' || comment))
+    """,
+)
+
+
+@migration(4)
+def add_task_search(conn, metadata):
+    """Add the full-text search index of tasks"""
+    statements = {
+        "sqlite": SQLITE_TASK_SEARCH,
+        "postgresql": POSTGRESQL_TASK_SEARCH,
+    }.get(conn.dialect.name, ())
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+@migration(5)
+def add_task_due_dates(conn, metadata):
+    """Add due dates and pending reminders to tasks"""
+    columns = {column["name"] for column in inspect(conn).get_columns("tasks")}
+    column_type = DateTime().compile(dialect=conn.dialect)
+    for name in ("due_at", "remind_at"):
+        if name not in columns:
+            conn.execute(text(f"ALTER TABLE tasks ADD COLUMN {name} {column_type}"))
+    create_indexes(conn, metadata, "ix_tasks_remind_at")
+
+
+# The search index of migration 4 with the words of each user indexed as terms of their own
+# (see `user_search_words`), a prefix query of one user no longer reads the matching
+# words of all users. The index is contentless since it holds the prefixed words.
+SQLITE_USER_TASK_SEARCH = (
+    "DROP TRIGGER IF EXISTS tasks_fts_insert",
+    "DROP TRIGGER IF EXISTS tasks_fts_delete",
+    "DROP TRIGGER IF EXISTS tasks_fts_update",
+    "DROP TABLE IF EXISTS tasks_fts",
+    """
+    CREATE VIRTUAL TABLE tasks_fts USING fts5(
+        name, comment, content='', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts(rowid, name, comment) VALUES (
+            new.id,
+            user_search_words(new.user_id, new.name),
+            user_search_words(new.user_id, new.comment)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, name, comment) VALUES (
+            'delete',
+            old.id,
+            user_search_words(old.user_id, old.name),
+            user_search_words(old.user_id, old.comment)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER tasks_fts_update AFTER UPDATE OF user_id, name, comment ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, name, comment) VALUES (
+            'delete',
+            old.id,
+            user_search_words(old.user_id, old.name),
+            user_search_words(old.user_id, old.comment)
+        );
+        INSERT INTO tasks_fts(rowid, name, comment) VALUES (
+            new.id,
+            user_search_words(new.user_id, new.name),
+            user_search_words(new.user_id, new.comment)
+        );
+    END
+    """,
+    # Matches in names weigh more than matches in comments
+    "INSERT INTO tasks_fts(tasks_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')",
+    """
+    INSERT INTO tasks_fts(rowid, name, comment)
+    SELECT id, user_search_words(user_id, name), user_search_words(user_id, comment)
+    FROM tasks
+    """,
+)
+
+
+@migration(6)
+def scope_task_search_to_users(conn, metadata):
+    """Index the words of the tasks of each user separately for search"""
+    if conn.dialect.name == "sqlite":
+        for statement in SQLITE_USER_TASK_SEARCH:
+            conn.execute(text(statement))
+
+
+def upgrade(conn, metadata):
+    """
+    Creates missing tables and applies all migrations newer than
+    the schema version stored in the database, each one recorded in `schema_version`.
+
+    Args:
+        conn (Connection): A synchronous connection inside a transaction.
+        metadata (MetaData): The metadata of the bot models.
+    """
+    metadata.create_all(conn)
+    version_metadata.create_all(conn)
+    current = conn.scalar(select(func.max(schema_version.c.version))) or 0
+    for version, apply in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version <= current:
+            continue
+        description = apply.__doc__.strip()
+        logger.info("Applying schema migration %s: %s", version, description)
+        apply(conn, metadata)
+        conn.execute(
+            insert(schema_version).values(
+                version=version,
+                description=description,
+                applied_at=datetime.now(timezone.utc).replace(tzinfo=None),
+            )
+        )
+
+
+def run_upgrade(conn, metadata):
+    """
+    Upgrades the database with `upgrade` in a transaction of its own.
+
+    SQLite enforces foreign keys while migrations rewrite the tables, and the tables
+    of an older database may not even satisfy them yet (tasks referencing users.tg_id
+    before it is unique fail with "foreign key mismatch"), so enforcement is
+    switched off during the upgrade and the database is checked before the commit.
+
+    Args:
+        conn (Connection): A synchronous connection outside of a transaction.
+        metadata (MetaData): The metadata of the bot models.
+    """
+    sqlite = conn.dialect.name == "sqlite"
+    if sqlite:
+        # The pragma is ignored inside a transaction, so it is set on the raw connection
+        # before the engine begins one
+        _set_foreign_keys(conn, False)
+    try:
+        with conn.begin():
+            upgrade(conn, metadata)
+            if sqlite:
+                violations = conn.exec_driver_sql("PRAGMA foreign_key_check").all()
+                for table, rowid, parent, _ in violations:
+                    logger.warning(
+                        "Row %s of %s references a missing row of %s",
+                        rowid,
+                        table,
+                        parent,
+                    )
+    finally:
+        if sqlite:
+            _set_foreign_keys(conn, True)
+
+
+def _set_foreign_keys(conn, enabled):
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA foreign_keys={'ON' if enabled else 'OFF'}")
+    finally:
+        cursor.close()
@@ -1,14 +1,167 @@
 """This file contains all database models for the bot"""
 
+import re
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime
 from enum import Enum
 
-from sqlalchemy import BigInteger, ForeignKey, String
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Column,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    event,
+)
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
-engine = create_async_engine(
-    url="sqlite+aiosqlite:///app/database/db.sqlite3", echo=True
-)
+import app.config as config
+from app.database.migrations import run_upgrade
+from app.database.slow_queries import SlowQueryLog
+
+# Words of task texts and search queries, separated like the FTS5 tokenizer separates them
+SEARCH_WORD = re.compile(r"[^\W_]+")
+
+
+def user_search_term(user_id, word):
+    """Returns a word of a task of the user as it is indexed for full-text search"""
+    return f"{user_id}x{word}"
+
+
+def user_search_words(user_id, text):
+    """
+    Returns the text of a task of the user as it is indexed for full-text search.
+
+    Every word is prefixed with the user ID, so the words of each user are terms
+    of their own and a search reads only the terms of one user. The search index
+    triggers call it as an SQL function, the index has to be rebuilt if it changes.
+    """
+    return " ".join(
+        user_search_term(user_id, word) for word in SEARCH_WORD.findall(text.lower())
+    )
+
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    """
+    Makes SQLite enforce foreign keys and ON DELETE CASCADE like PostgreSQL does,
+    lets readers work while a write is in progress (WAL), makes writers wait
+    for the lock instead of failing with "database is locked" and registers
+    `user_search_words` for the triggers of the search index.
+    """
+    # The driver's own transaction handling breaks SAVEPOINT, BEGIN is emitted in _begin_sqlite
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={config.DB_BUSY_TIMEOUT}")
+    cursor.close()
+    dbapi_connection.create_function(
+        "user_search_words", 2, user_search_words, deterministic=True
+    )
+
+
+def _begin_sqlite(conn):
+    conn.exec_driver_sql("BEGIN")
+
+
+@dataclass
+class QueryStats:
+    """
+    Database work done while `query_stats` is set, usually while handling one update.
+
+    Attributes:
+        checkouts (int): Connections checked out of the pool, one per session transaction.
+        statements (int): Statements executed.
+        rows_changed (int): Rows inserted, updated or deleted by the statements.
+        db_time (float): Seconds spent executing the statements.
+    """
+
+    checkouts: int = 0
+    statements: int = 0
+    rows_changed: int = 0
+    db_time: float = 0.0
+
+
+# Collects the database work of the current task, nothing is collected while it is None
+query_stats: ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    stats = query_stats.get()
+    if stats is not None:
+        stats.checkouts += 1
+
+
+slow_query_log = SlowQueryLog()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"]
+    stats = query_stats.get()
+    if stats is not None:
+        stats.db_time += elapsed
+        stats.statements += 1
+        # The DB-API row count, -1 for statements that change no rows like SELECT
+        if cursor.rowcount > 0:
+            stats.rows_changed += cursor.rowcount
+    slow_query_log(conn, statement, parameters, elapsed, executemany)
+
+
+def create_engine(
+    url=config.DATABASE_URL,
+    pool_size=config.DB_POOL_SIZE,
+    max_overflow=config.DB_MAX_OVERFLOW,
+    pool_recycle=config.DB_POOL_RECYCLE,
+    pool_pre_ping=config.DB_POOL_PRE_PING,
+    echo=config.DB_ECHO,
+):
+    """
+    Creates the async engine of the bot database.
+
+    Supports SQLite through aiosqlite and PostgreSQL through asyncpg.
+
+    Args:
+        url (str): The SQLAlchemy URL of the database.
+        pool_size (int): The number of connections kept open in the pool.
+        max_overflow (int): The number of connections allowed above `pool_size`.
+        pool_recycle (int): Seconds after which a pooled connection is replaced.
+        pool_pre_ping (bool): Whether to test every connection before it is used,
+            an extra round trip per checkout; `pool_recycle` already replaces
+            connections before servers drop them.
+        echo (bool): Whether to log every SQL statement, for debugging.
+            Slow statements are logged by `slow_query_log` either way.
+    """
+    url = make_url(url)
+    options = {"echo": echo, "pool_pre_ping": pool_pre_ping}
+    if url.get_backend_name() != "sqlite" or url.database not in (None, "", ":memory:"):
+        options.update(
+            pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle
+        )
+    new_engine = create_async_engine(url, **options)
+    event.listen(new_engine.sync_engine.pool, "checkout", _count_checkout)
+    event.listen(
+        new_engine.sync_engine, "before_cursor_execute", _before_cursor_execute
+    )
+    event.listen(new_engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    if url.get_backend_name() == "sqlite":
+        event.listen(new_engine.sync_engine, "connect", _configure_sqlite_connection)
+        event.listen(new_engine.sync_engine, "begin", _begin_sqlite)
+    return new_engine
+
+
+engine = create_engine()
 
 
 async_session = async_sessionmaker(engine)
@@ -32,6 +185,7 @@ class User(Base):
     """
 
     __tablename__ = "users"
+    __table_args__ = (Index("ix_users_tg_id", "tg_id", unique=True),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     tg_id = mapped_column(BigInteger)
@@ -45,13 +199,25 @@ class Project(Base):
         id (int): A unique identifier for the project.
         name (str): The name of the project.
         user_id (BigInteger): The TG ID of the user who created the project.
+        tasks_notstarted (int): The number of tasks that have not been started.
+        tasks_inprogress (int): The number of tasks in progress.
+        tasks_completed (int): The number of completed tasks.
+            The counters are kept up to date by the writes in `requests.py`
+            and recomputed by `recount_project_tasks`.
     """
 
     __tablename__ = "projects"
+    __table_args__ = (
+        Index("ix_projects_user_id_name", "user_id", "name", unique=True),
+        Index("ix_projects_user_id_id", "user_id", "id"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(256))
     user_id: Mapped[BigInteger] = mapped_column(ForeignKey("users.tg_id"))
+    tasks_notstarted: Mapped[int] = mapped_column(default=0, server_default="0")
+    tasks_inprogress: Mapped[int] = mapped_column(default=0, server_default="0")
+    tasks_completed: Mapped[int] = mapped_column(default=0, server_default="0")
 
     children = relationship(
         "Task",
@@ -60,6 +226,11 @@ class Project(Base):
         passive_deletes=True,
     )
 
+    @property
+    def tasks_total(self) -> int:
+        """The number of tasks of the project"""
+        return self.tasks_notstarted + self.tasks_inprogress + self.tasks_completed
+
 
 class TaskStatus(Enum):
     """
@@ -76,6 +247,21 @@ class TaskStatus(Enum):
     COMPLETED = 2
 
 
+# Emoji shown next to the name of a task in each status
+STATUS_EMOJI = {
+    TaskStatus.NOTSTARTED: "🟣",
+    TaskStatus.INPROGRESS: "🔵",
+    TaskStatus.COMPLETED: "🟢",
+}
+
+# Counter column of the project for the tasks in each status
+PROJECT_COUNTERS = {
+    TaskStatus.NOTSTARTED: Project.tasks_notstarted,
+    TaskStatus.INPROGRESS: Project.tasks_inprogress,
+    TaskStatus.COMPLETED: Project.tasks_completed,
+}
+
+
 class Task(Base):
     """
     Represents a task in the database.
@@ -85,9 +271,25 @@ class Task(Base):
         name (str): Name of the task.
         project_id (int): ID of the project that the task belongs to.
         user_id (BigInteger): TG ID of the user who created the task.
+        version (int): Incremented by every change of the task, detects changes
+            made since a screen showing the task was rendered.
+        due_at (datetime | None): The due date of the task in UTC.
+        remind_at (datetime | None): When the owner is reminded of the task in UTC,
+            cleared once the reminder is sent. Read in order by `app/scheduler.py`.
     """
 
     __tablename__ = "tasks"
+    __table_args__ = (
+        Index(
+            "ix_tasks_project_id_user_id_name",
+            "project_id",
+            "user_id",
+            "name",
+            unique=True,
+        ),
+        Index("ix_tasks_project_id_user_id_id", "project_id", "user_id", "id"),
+        Index("ix_tasks_remind_at", "remind_at"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(256))
@@ -96,15 +298,132 @@ class Task(Base):
     )
     user_id: Mapped[BigInteger] = mapped_column(ForeignKey("users.tg_id"))
     status: Mapped[TaskStatus] = mapped_column(default=TaskStatus.NOTSTARTED)
-    emoji: Mapped[str] = mapped_column(default="🟣")
     comment: Mapped[str] = mapped_column(default="")
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+    due_at: Mapped[datetime | None]
+    remind_at: Mapped[datetime | None]
 
     parent = relationship("Project", back_populates="children")
 
+    @property
+    def emoji(self) -> str:
+        """The emoji of the status of the task"""
+        return STATUS_EMOJI[self.status]
+
+
+# FTS5 index of tasks created by migration 6 on SQLite, kept out of Base.metadata
+# since create_all can not create virtual tables. Queried by `search_tasks`.
+tasks_fts = Table(
+    "tasks_fts",
+    MetaData(),
+    Column("rowid", Integer, primary_key=True),
+    # The hidden column named after the table, the left operand of MATCH
+    Column("tasks_fts", String),
+    Column("rank"),
+)
+
+
+class BroadcastKind(Enum):
+    """
+    Represents what a broadcast sends.
+
+    Attributes:
+        MESSAGE (int): The text of the broadcast, to every user.
+        DIGEST (int): The open tasks of every user who has some, rendered when sent.
+    """
+
+    MESSAGE = 0
+    DIGEST = 1
+
+
+class Broadcast(Base):
+    """
+    Represents a message sent to many users through `app/outbox.py`.
+
+    Attributes:
+        id (int): Unique identifier for the broadcast.
+        kind (BroadcastKind): What the broadcast sends.
+        text (str): The text of a MESSAGE broadcast.
+        created_by (BigInteger | None): TG ID of the admin who started it, told when it ends.
+        created_at (datetime): The time it was started in UTC.
+        finished_at (datetime | None): The time its last delivery was attempted in UTC.
+    """
+
+    __tablename__ = "broadcasts"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[BroadcastKind]
+    text: Mapped[str] = mapped_column(default="")
+    created_by = mapped_column(BigInteger, nullable=True)
+    created_at: Mapped[datetime]
+    finished_at: Mapped[datetime | None] = mapped_column(index=True)
+
+
+class DeliveryStatus(Enum):
+    """
+    Represents the progress of a delivery.
+
+    Attributes:
+        PENDING (int): Not attempted yet.
+        SENT (int): Sent.
+        FAILED (int): Rejected by Telegram, e.g. the user blocked the bot.
+        SKIPPED (int): Nothing to send any more, e.g. no open tasks for a digest.
+    """
+
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+    SKIPPED = 3
+
+
+class Delivery(Base):
+    """
+    Represents the delivery of a broadcast to one user.
+    Pending deliveries are what is left to send after a restart.
+
+    Attributes:
+        id (int): Unique identifier for the delivery.
+        broadcast_id (int): ID of the broadcast.
+        user_id (BigInteger): TG ID of the recipient.
+        status (DeliveryStatus): The progress of the delivery.
+    """
+
+    __tablename__ = "deliveries"
+    __table_args__ = (
+        Index("ix_deliveries_broadcast_id_status_id", "broadcast_id", "status", "id"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    broadcast_id: Mapped[int] = mapped_column(
+        ForeignKey("broadcasts.id", ondelete="CASCADE")
+    )
+    user_id = mapped_column(BigInteger)
+    status: Mapped[DeliveryStatus] = mapped_column(default=DeliveryStatus.PENDING)
+
+
+class FSMRecord(Base):
+    """
+    Represents the FSM state and data of a user in a chat.
+
+    Attributes:
+        key (str): The storage key built from the bot, chat and user IDs.
+        state (str | None): The current state.
+        data (dict): The data stored for the current flow.
+        updated_at (datetime): The time of the last change in UTC, used to expire abandoned flows.
+    """
+
+    __tablename__ = "fsm_states"
+
+    key: Mapped[str] = mapped_column(String(256), primary_key=True)
+    state: Mapped[str | None] = mapped_column(String(256))
+    data: Mapped[dict] = mapped_column(JSON, default=dict)
+    updated_at: Mapped[datetime] = mapped_column(index=True)
+
 
 async def async_main():
     """
-    Asynchronous function that creates all tables in the database.
+    Asynchronous function that creates missing tables in the database
+    and upgrades the schema of an existing database to the latest version.
     """
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    async with engine.connect() as conn:
+        await conn.run_sync(run_upgrade, Base.metadata)
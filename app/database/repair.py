@@ -0,0 +1,62 @@
+"""This file contains the job repairing the task counters of projects
+
+Run `python -m app.database.repair` to recount all projects once.
+"""
+
+import asyncio
+import logging
+
+import app.config as config
+from app.database.models import async_main
+from app.database.requests import recount_project_tasks
+
+logger = logging.getLogger(__name__)
+
+
+class CounterRepair:
+    """
+    Recomputes the task counters of all projects every `interval` seconds,
+    in case a write outside `requests.py` changed tasks without updating them.
+
+    Args:
+        interval (float): Seconds between two recounts, 0 disables the job.
+    """
+
+    def __init__(self, interval: float = config.COUNTERS_REPAIR_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    async def start(self):
+        """Starts the job"""
+        if self.interval and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops the job"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                recounted = await recount_project_tasks()
+            except Exception:
+                logger.exception("Failed to recount the tasks of projects")
+            else:
+                logger.info("Recounted the tasks of %s projects", recounted)
+
+
+repair = CounterRepair()
+
+
+async def main():
+    await async_main()
+    print(f"Recounted the tasks of {await recount_project_tasks()} projects")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
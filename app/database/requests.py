@@ -1,137 +1,362 @@
 """This file contains all database requests for the bot"""
 
-from sqlalchemy import BigInteger, delete, select, update
+from collections import Counter
+from datetime import datetime, timezone
 
-from app.database.models import Project, Task, User, async_session
+from sqlalchemy import (
+    BigInteger,
+    delete,
+    exists,
+    func,
+    insert,
+    literal,
+    literal_column,
+    select,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+import app.config as config
+from app.database.cache import keyboards, projects as project_cache, versions
+from app.database.models import (
+    PROJECT_COUNTERS,
+    SEARCH_WORD,
+    Broadcast,
+    BroadcastKind,
+    Delivery,
+    DeliveryStatus,
+    Project,
+    Task,
+    TaskStatus,
+    User,
+    async_session,
+    engine,
+    tasks_fts,
+    user_search_term,
+)
+from app.database.writer import writer
+
+
+def _insert(model):
+    """INSERT statement of the dialect of the bot database, which supports ON CONFLICT"""
+    if engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+async def _count_tasks(session, project_id, changes):
+    """
+    Adds changes of the numbers of tasks by status to the counters of a project,
+        in the transaction of the write that changed the tasks.
+
+    Args:
+        changes (Mapping[TaskStatus, int]): The change of the number of tasks in each status.
+    """
+    values = {
+        PROJECT_COUNTERS[status].key: PROJECT_COUNTERS[status] + change
+        for status, change in changes.items()
+        if change
+    }
+    if values:
+        await session.execute(
+            update(Project).where(Project.id == project_id).values(values)
+        )
+
+
+def _recount_query(project_ids=None):
+    """UPDATE statement recomputing the task counters of projects from their tasks"""
+    query = update(Project).values(
+        {
+            counter.key: select(func.count())
+            .where(Task.project_id == Project.id, Task.status == status)
+            .scalar_subquery()
+            for status, counter in PROJECT_COUNTERS.items()
+        }
+    )
+    if project_ids is not None:
+        query = query.where(Project.id.in_(project_ids))
+    return query
+
+
+async def recount_project_tasks(project_ids=None):
+    """
+    Asynchronously recomputes the task counters of projects from their tasks
+        with one statement, repairing counters that went out of sync.
+
+    Args:
+        project_ids (Iterable[int] | None): The projects to recount, None for all of them.
+
+    Returns:
+        int: The number of recounted projects.
+    """
+
+    async def _write(session):
+        result = await session.execute(_recount_query(project_ids))
+        return result.rowcount
+
+    recounted = await writer.submit(_write)
+    # The counters are shown in the project lists
+    keyboards.clear()
+    return recounted
 
 
 async def add_user(tg_id: int):
     """
-    Asynchronously sets a user in the database.
+    Asynchronously sets a user in the database with a single upsert.
 
     Args:
         tg_id (int): The Telegram ID of the user.
+
+    Returns:
+        Row: The `id` and `tg_id` of the new or existing user.
     """
-    async with async_session() as session:
-        user = await session.scalar(select(User).where(User.tg_id == tg_id))
+    query = _insert(User).values(tg_id=tg_id)
+    # A no-op update instead of DO NOTHING, so RETURNING yields the existing row too
+    query = query.on_conflict_do_update(
+        index_elements=["tg_id"], set_={"tg_id": query.excluded.tg_id}
+    ).returning(User.id, User.tg_id)
 
-        if not user:
-            session.add(User(tg_id=tg_id))
-            await session.commit()
+    async def _write(session):
+        return (await session.execute(query)).one()
 
+    user = await writer.submit(_write)
+    versions.bump_user(tg_id)
+    return user
 
-async def add_project(user_id: BigInteger, name: str) -> None:
+
+async def add_project(user_id: BigInteger, name: str):
     """
-    Asynchronously adds a project to the database.
+    Asynchronously adds a project to the database with a single upsert.
 
     Args:
         user_id (BigInteger): The TG ID of the user who created the project.
         name (str): The name of the project.
+
+    Returns:
+        Row: The `id`, `name` and `user_id` of the new or existing project.
     """
-    async with async_session() as session:
-        project = await session.scalar(
-            select(Project).where(Project.name == name, Project.user_id == user_id)
-        )
+    query = _insert(Project).values(name=name, user_id=user_id)
+    query = query.on_conflict_do_update(
+        index_elements=["user_id", "name"], set_={"name": query.excluded.name}
+    ).returning(Project.id, Project.name, Project.user_id)
 
-        if not project:
-            session.add(Project(name=name, user_id=user_id))
-            await session.commit()
+    async def _write(session):
+        return (await session.execute(query)).one()
 
+    project = await writer.submit(_write)
+    versions.bump_user(user_id)
+    return project
 
-async def add_task(project_id: int, name: str, user_id: BigInteger) -> None:
+
+async def add_task(project_id: int, name: str, user_id: BigInteger):
     """
-    Asynchronously adds a task to the database.
+    Asynchronously adds a task to the database with a single insert
+        unless the project already has a task with the name.
 
     Args:
         project_id (int): The ID of the project that the task belongs to.
         name (str): The name of the task.
+
+    Returns:
+        Row: The `id`, `name`, `status`, `comment`, `version` and `project_id`
+            of the new or existing task.
     """
-    async with async_session() as session:
-        task = await session.scalar(
-            select(Task).where(
-                Task.name == name,
-                Task.project_id == project_id,
-                Task.user_id == user_id,
-            )
-        )
+    columns = (
+        Task.id,
+        Task.name,
+        Task.status,
+        Task.comment,
+        Task.version,
+        Task.project_id,
+    )
+    # DO NOTHING returns no row for an existing task, so only new tasks are counted
+    query = (
+        _insert(Task)
+        .values(name=name, project_id=project_id, user_id=user_id)
+        .on_conflict_do_nothing(index_elements=["project_id", "user_id", "name"])
+        .returning(*columns)
+    )
+
+    async def _write(session):
+        task = (await session.execute(query)).one_or_none()
+        if task is None:
+            return (
+                await session.execute(
+                    select(*columns).where(
+                        Task.name == name,
+                        Task.project_id == project_id,
+                        Task.user_id == user_id,
+                    )
+                )
+            ).one()
+        await _count_tasks(session, project_id, {task.status: 1})
+        return task
+
+    task = await writer.submit(_write)
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
+    return task
+
+
+def _keyset_page(query, key, after=None, before=None, limit=None):
+    """
+    Applies keyset pagination over the `key` column to a select query.
 
-        if not task:
-            session.add(Task(name=name, project_id=project_id, user_id=user_id))
-            await session.commit()
+    Args:
+        query (Select): The query to paginate.
+        key (Column): A unique, ordered column to paginate by.
+        after (int | None): Return rows with the key greater than this value.
+        before (int | None): Return rows with the key less than this value.
+        limit (int | None): The maximum number of rows to return.
+    """
+    if before is not None:
+        query = query.where(key < before).order_by(key.desc())
+    else:
+        if after is not None:
+            query = query.where(key > after)
+        query = query.order_by(key)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
 
 
-async def get_projects(user_id):
+async def get_projects(user_id, after=None, before=None, limit=None):
     """
-    Asynchronously retrieves all projects associated with the given user ID.
+    Asynchronously retrieves projects associated with the given user ID,
+        except the "General" one, in ascending order of ID.
+
+    Args:
+        user_id (int): The TG ID of the user.
+        after (int | None): Keyset cursor, return projects with an ID greater than it.
+        before (int | None): Keyset cursor, return projects with an ID less than it.
+        limit (int | None): The maximum number of projects to return.
+
+    Returns:
+        list[Project]: The requested page of projects.
     """
     async with async_session() as session:
-        return await session.scalars(select(Project).where(Project.user_id == user_id))
+        projects = await session.scalars(
+            _keyset_page(
+                select(Project).where(
+                    Project.user_id == user_id, Project.name != "General"
+                ),
+                Project.id,
+                after,
+                before,
+                limit,
+            )
+        )
+        return sorted(projects, key=lambda project: project.id)
 
 
-async def get_project_tasks(project_id, user_id):
+async def get_project_tasks(project_id, user_id, after=None, before=None, limit=None):
     """
-    Asynchronously retrieves all tasks associated with the given project ID and user ID.
+    Asynchronously retrieves tasks associated with the given project ID and user ID
+        in ascending order of ID.
+
+    Args:
+        project_id (int): The ID of the project.
+        user_id (int): The TG ID of the user.
+        after (int | None): Keyset cursor, return tasks with an ID greater than it.
+        before (int | None): Keyset cursor, return tasks with an ID less than it.
+        limit (int | None): The maximum number of tasks to return.
+
+    Returns:
+        list[Task]: The requested page of tasks.
     """
     async with async_session() as session:
-        return await session.scalars(
-            select(Task).where(Task.project_id == project_id, Task.user_id == user_id)
+        tasks = await session.scalars(
+            _keyset_page(
+                select(Task).where(
+                    Task.project_id == project_id, Task.user_id == user_id
+                ),
+                Task.id,
+                after,
+                before,
+                limit,
+            )
         )
+        return sorted(tasks, key=lambda task: task.id)
 
 
 async def get_project_name(project_id, user_id):
     """
     Asynchronously retrieves the name of a project
         based on its ID and the ID of the user who owns it.
+        Names are cached until the project changes.
     """
-    async with async_session() as session:
-        project = await session.scalar(
-            select(Project).where(Project.id == project_id, Project.user_id == user_id)
-        )
 
-        return project.name
+    async def _read():
+        async with async_session() as session:
+            project = await session.scalar(
+                select(Project).where(
+                    Project.id == project_id, Project.user_id == user_id
+                )
+            )
+
+            return project.name
 
+    return await project_cache.get(
+        ("name", user_id, project_id), user_id, project_id, _read
+    )
 
-async def get_task_name(task_id, project_id, user_id):
+
+async def get_task_view(task_id, project_id, user_id):
     """
-    Asynchronously retrieves the name of a task based on its ID, project ID, and user ID.
+    Asynchronously retrieves everything needed to render a task screen
+        (task name, status, comment, version, due date and project name)
+        with a single joined query.
+
+    Args:
+        task_id (int): The ID of the task.
+        project_id (int): The ID of the project that the task belongs to.
+        user_id (int): The TG ID of the user who owns the task.
+
+    Returns:
+        Row | None: A row with `id`, `name`, `status`, `comment`, `version`, `due_at`,
+            `project_id` and `project_name` attributes, or None if the task does not exist.
     """
     async with async_session() as session:
-        task = await session.scalar(
-            select(Task).where(
+        result = await session.execute(
+            select(
+                Task.id,
+                Task.name,
+                Task.status,
+                Task.comment,
+                Task.version,
+                Task.due_at,
+                Project.id.label("project_id"),
+                Project.name.label("project_name"),
+            )
+            .join(Project, Task.project_id == Project.id)
+            .where(
                 Task.id == task_id,
                 Task.project_id == project_id,
                 Task.user_id == user_id,
             )
         )
-        return task.name
+        return result.one_or_none()
 
 
 async def get_general_project_id(user_id):
     """
     Asynchronously retrieves the ID of the "General" project associated with the given user ID.
+        IDs are cached until the projects of the user change.
     """
-    async with async_session() as session:
-        project = await session.scalar(
-            select(Project).where(Project.user_id == user_id, Project.name == "General")
-        )
 
-        return project.id
-
-
-async def get_task_id(task_name, project_id, user_id):
-    """
-    Asynchronously retrieves the ID of a task based on its name, project ID, and user ID.
-    """
-    async with async_session() as session:
-        task = await session.scalar(
-            select(Task).where(
-                Task.name == task_name,
-                Task.project_id == project_id,
-                Task.user_id == user_id,
+    async def _read():
+        async with async_session() as session:
+            project = await session.scalar(
+                select(Project).where(
+                    Project.user_id == user_id, Project.name == "General"
+                )
             )
-        )
 
-        return task.id
+            return project.id
+
+    return await project_cache.get(("general", user_id), user_id, None, _read)
 
 
 async def project_is_general(project_id, user_id):
@@ -157,41 +382,287 @@ async def project_is_general(project_id, user_id):
         return bool(project)
 
 
-async def get_task_status(task_id, project_id, user_id):
+async def change_task_status(task_id, project_id, user_id, new_status, version=None):
     """
-    Asynchronously retrieves the status of a task given its ID, project ID, and user ID.
+    Asynchronously changes the status of a task and the task counters of its project.
+
+    Args:
+        task_id (int): The ID of the task.
+        project_id (int): The ID of the project that the task belongs to.
+        user_id (int): The TG ID of the user who owns the task.
+        new_status (TaskStatus): The new status.
+        version (int | None): The version of the task the change is based on,
+            the task is not changed if it has been changed since. None changes it anyway.
+
+    Returns:
+        Row | None: The `id`, `name`, `status`, `comment`, `version`, `due_at`,
+            `project_id` and `project_name` of the changed task, or None if the task
+            does not exist, has another version or already has the new status.
     """
-    async with async_session() as session:
-        task = await session.scalar(
-            select(Task).where(
+    condition = [
+        Task.id == task_id,
+        Task.user_id == user_id,
+        Task.project_id == project_id,
+        Task.status != new_status,
+    ]
+    if version is not None:
+        condition.append(Task.version == version)
+
+    async def _write(session):
+        # The task row is locked first, like the other task writes lock tasks before
+        # their project. RETURNING only has the new values, so the old status the
+        # counters need is read with the lock. SQLite has no FOR UPDATE, its write
+        # transaction already serializes the writes.
+        old_status = await session.scalar(
+            select(Task.status).where(*condition).with_for_update()
+        )
+        if old_status is None:
+            return None
+        task = (
+            await session.execute(
+                update(Task)
+                .where(*condition)
+                .values(status=new_status, version=Task.version + 1)
+                .returning(
+                    Task.id,
+                    Task.name,
+                    Task.status,
+                    Task.comment,
+                    Task.version,
+                    Task.due_at,
+                    Task.project_id,
+                    select(Project.name)
+                    .where(Project.id == Task.project_id)
+                    .scalar_subquery()
+                    .label("project_name"),
+                )
+            )
+        ).one()
+        await _count_tasks(session, project_id, {old_status: -1, new_status: 1})
+        return task
+
+    task = await writer.submit(_write)
+    if task is not None:
+        versions.bump_user(user_id)
+        versions.bump_project(project_id)
+    return task
+
+
+async def delete_project_tasks(project_id, user_id):
+    """Asynchronously deletes all tasks associated with the given project ID and user ID."""
+
+    async def _write(session):
+        await session.execute(
+            delete(Task).where(Task.project_id == project_id, Task.user_id == user_id)
+        )
+        await session.execute(
+            update(Project)
+            .where(Project.id == project_id)
+            .values({counter.key: 0 for counter in PROJECT_COUNTERS.values()})
+        )
+
+    await writer.submit(_write)
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
+
+
+async def delete_project(project_id, user_id):
+    """Asynchronously deletes a project and its tasks from the database."""
+
+    async def _write(session):
+        await session.execute(
+            delete(Task).where(Task.project_id == project_id, Task.user_id == user_id)
+        )
+        await session.execute(
+            delete(Project).where(Project.id == project_id, Project.user_id == user_id)
+        )
+
+    await writer.submit(_write)
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
+
+
+async def delete_task(task_id, project_id, user_id):
+    """Asynchronously deletes a task from the database."""
+
+    async def _write(session):
+        status = await session.scalar(
+            delete(Task)
+            .where(
                 Task.id == task_id,
                 Task.project_id == project_id,
                 Task.user_id == user_id,
             )
+            .returning(Task.status)
         )
-        return task.status
+        if status is not None:
+            await _count_tasks(session, project_id, {status: -1})
 
+    await writer.submit(_write)
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
 
-async def get_task_emoji(task_id, project_id, user_id):
+
+async def change_tasks_status(task_ids, project_id, user_id, new_status):
     """
-    Asynchronously retrieves the emoji of a task given its ID, project ID, and user ID.
+    Asynchronously changes the status of several tasks of a project with one statement
+        and the task counters of the project.
+
+    Returns:
+        int: The number of changed tasks.
     """
-    async with async_session() as session:
-        task = await session.scalar(
-            select(Task).where(
-                Task.id == task_id,
-                Task.project_id == project_id,
-                Task.user_id == user_id,
+    condition = (
+        Task.id.in_(task_ids),
+        Task.project_id == project_id,
+        Task.user_id == user_id,
+        Task.status != new_status,
+    )
+
+    async def _write(session):
+        old_statuses = Counter(
+            dict(
+                (
+                    await session.execute(
+                        select(Task.status, func.count())
+                        .where(*condition)
+                        .group_by(Task.status)
+                    )
+                ).all()
             )
         )
-        return task.emoji
+        changed = sum(old_statuses.values())
+        if not changed:
+            return 0
+        await session.execute(
+            update(Task)
+            .where(*condition)
+            .values(status=new_status, version=Task.version + 1)
+        )
+        old_statuses.subtract({new_status: changed})
+        await _count_tasks(
+            session,
+            project_id,
+            {status: -count for status, count in old_statuses.items()},
+        )
+        return changed
+
+    changed = await writer.submit(_write)
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
+    return changed
 
 
-async def change_task_status_to_inprogress(task_id, project_id, user_id, new_status):
+async def delete_tasks(task_ids, project_id, user_id):
     """
-    Asynchronously changes the status of a task to "in progress" in the database.
+    Asynchronously deletes several tasks of a project with one statement.
+
+    Returns:
+        int: The number of deleted tasks.
     """
-    async with async_session() as session:
+
+    async def _write(session):
+        statuses = Counter(
+            await session.scalars(
+                delete(Task)
+                .where(
+                    Task.id.in_(task_ids),
+                    Task.project_id == project_id,
+                    Task.user_id == user_id,
+                )
+                .returning(Task.status)
+            )
+        )
+        await _count_tasks(
+            session, project_id, {status: -count for status, count in statuses.items()}
+        )
+        return sum(statuses.values())
+
+    deleted = await writer.submit(_write)
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
+    return deleted
+
+
+async def move_tasks(task_ids, project_id, target_project_id, user_id):
+    """
+    Asynchronously moves several tasks to another project of the same user with one statement.
+        Tasks whose names are already taken in the target project stay where they are.
+
+    Returns:
+        int: The number of moved tasks.
+    """
+    same_name = aliased(Task)
+
+    async def _write(session):
+        statuses = Counter(
+            await session.scalars(
+                update(Task)
+                .where(
+                    Task.id.in_(task_ids),
+                    Task.project_id == project_id,
+                    Task.user_id == user_id,
+                    exists().where(
+                        Project.id == target_project_id, Project.user_id == user_id
+                    ),
+                    ~exists().where(
+                        same_name.project_id == target_project_id,
+                        same_name.user_id == user_id,
+                        same_name.name == Task.name,
+                    ),
+                )
+                .values(project_id=target_project_id, version=Task.version + 1)
+                .returning(Task.status)
+            )
+        )
+        await _count_tasks(
+            session, project_id, {status: -count for status, count in statuses.items()}
+        )
+        await _count_tasks(session, target_project_id, statuses)
+        return sum(statuses.values())
+
+    moved = await writer.submit(_write)
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
+    versions.bump_project(target_project_id)
+    return moved
+
+
+async def rename_project(project_id, user_id, new_name):
+    """
+    Asynchronously renames a project in the database.
+
+    Returns:
+        bool: False if the user already has a project with the new name.
+    """
+
+    async def _write(session):
+        await session.execute(
+            update(Project)
+            .where(
+                Project.id == project_id,
+                Project.user_id == user_id,
+            )
+            .values(name=new_name)
+        )
+
+    try:
+        await writer.submit(_write)
+    except IntegrityError:
+        return False
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
+    return True
+
+
+async def rename_task(task_id, project_id, user_id, new_name):
+    """
+    Asynchronously renames a task in the database.
+
+    Returns:
+        bool: False if the project already has a task with the new name.
+    """
+
+    async def _write(session):
         await session.execute(
             update(Task)
             .where(
@@ -199,19 +670,22 @@ async def change_task_status_to_inprogress(task_id, project_id, user_id, new_sta
                 Task.user_id == user_id,
                 Task.project_id == project_id,
             )
-            .values(
-                emoji="🔵",
-                status=new_status,
-            )
+            .values(name=new_name, version=Task.version + 1)
         )
-        await session.commit()
 
+    try:
+        await writer.submit(_write)
+    except IntegrityError:
+        return False
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
+    return True
 
-async def change_task_status_to_notstarted(task_id, project_id, user_id, new_status):
-    """
-    Asynchronously changes the status of a task to "not started" in the database.
-    """
-    async with async_session() as session:
+
+async def chgange_task_comment(task_id, project_id, user_id, comment):
+    """Asynchronously adds a comment to a task in the database."""
+
+    async def _write(session):
         await session.execute(
             update(Task)
             .where(
@@ -219,117 +693,461 @@ async def change_task_status_to_notstarted(task_id, project_id, user_id, new_sta
                 Task.user_id == user_id,
                 Task.project_id == project_id,
             )
-            .values(
-                emoji="🟣",
-                status=new_status,
-            )
+            .values(comment=comment, version=Task.version + 1)
         )
-        await session.commit()
+
+    await writer.submit(_write)
+    versions.bump_user(user_id)
+    versions.bump_project(project_id)
 
 
-async def change_task_status_to_completed(task_id, project_id, user_id, new_status):
+async def set_task_due(task_id, project_id, user_id, due_at):
     """
-    Asynchronously changes the status of a task to "completed" in the database.
+    Asynchronously sets the due date of a task and schedules its reminder for that time.
+
+    Args:
+        task_id (int): The ID of the task.
+        project_id (int): The ID of the project that the task belongs to.
+        user_id (int): The TG ID of the user who owns the task.
+        due_at (datetime | None): The due date in UTC, None removes it and its reminder.
+
+    Returns:
+        Row | None: The `id` and `remind_at` of the task, or None if it does not exist.
     """
-    async with async_session() as session:
-        await session.execute(
+
+    async def _write(session):
+        result = await session.execute(
             update(Task)
             .where(
                 Task.id == task_id,
                 Task.user_id == user_id,
                 Task.project_id == project_id,
             )
-            .values(
-                emoji="🟢",
-                status=new_status,
-            )
+            .values(due_at=due_at, remind_at=due_at, version=Task.version + 1)
+            .returning(Task.id, Task.remind_at)
         )
-        await session.commit()
+        return result.one_or_none()
 
+    task = await writer.submit(_write)
+    if task is not None:
+        versions.bump_user(user_id)
+        versions.bump_project(project_id)
+    return task
 
-async def delete_project_tasks(project_id, user_id):
-    """Asynchronously deletes all tasks associated with the given project ID and user ID."""
+
+async def get_next_reminders(limit):
+    """
+    Asynchronously retrieves the earliest pending reminders with the remind_at index,
+        including the ones that should have been sent while the bot was stopped.
+
+    Returns:
+        list[Row]: Rows with `id` and `remind_at` attributes, earliest first.
+    """
     async with async_session() as session:
-        await session.execute(
-            delete(Task).where(Task.project_id == project_id, Task.user_id == user_id)
+        result = await session.execute(
+            select(Task.id, Task.remind_at)
+            .where(Task.remind_at.is_not(None))
+            .order_by(Task.remind_at, Task.id)
+            .limit(limit)
         )
-        await session.commit()
+        return result.all()
 
 
-async def delete_project(project_id, user_id):
-    """Asynchronously deletes a project from the database."""
+async def get_due_reminders(task_ids, now):
+    """
+    Asynchronously retrieves the reminders of tasks that are due by `now`.
+
+    Tasks whose reminder was removed or moved to a later time are skipped.
+
+    Args:
+        task_ids (Iterable[int]): The IDs of the tasks.
+        now (datetime): The current time in UTC.
+
+    Returns:
+        list[Row]: Rows with `id`, `name`, `status`, `due_at` and `user_id` attributes.
+    """
     async with async_session() as session:
-        await delete_project_tasks(project_id, user_id)
-        await session.execute(
-            delete(Project).where(Project.id == project_id, Project.user_id == user_id)
+        result = await session.execute(
+            select(Task.id, Task.name, Task.status, Task.due_at, Task.user_id).where(
+                Task.id.in_(task_ids),
+                Task.remind_at.is_not(None),
+                Task.remind_at <= now,
+            )
         )
-        await session.commit()
+        return result.all()
 
 
-async def delete_task(task_id, project_id, user_id):
-    """Asynchronously deletes a task from the database."""
+async def settle_reminders(done_ids, retry_ids, now, retry_at):
+    """
+    Asynchronously clears the reminders that were sent or are not to be sent anymore,
+        and moves the ones that failed to `retry_at`, in one transaction.
+
+    Reminders set again since `now` are left as they are.
+
+    Args:
+        done_ids (Iterable[int]): The IDs of the tasks whose reminder is cleared.
+        retry_ids (Iterable[int]): The IDs of the tasks whose reminder is retried.
+        now (datetime): The time the reminders were due by in UTC.
+        retry_at (datetime): The time of the next attempt in UTC.
+    """
+
+    async def _write(session):
+        for task_ids, remind_at in ((done_ids, None), (retry_ids, retry_at)):
+            if task_ids:
+                await session.execute(
+                    update(Task)
+                    .where(
+                        Task.id.in_(task_ids),
+                        Task.remind_at.is_not(None),
+                        Task.remind_at <= now,
+                    )
+                    .values(remind_at=remind_at)
+                )
+
+    await writer.submit(_write)
+
+
+async def stream_user_tasks(user_id, batch_size=config.EXPORT_BATCH_SIZE):
+    """
+    Asynchronously yields all projects and tasks of a user, ordered by project and task ID,
+        fetching `batch_size` rows at a time with a server-side cursor.
+
+    Yields:
+        Row: (project, name, status, comment) of every task,
+            projects without tasks are yielded once with the other fields set to None.
+    """
     async with async_session() as session:
-        await session.execute(
-            delete(Task).where(
-                Task.id == task_id,
-                Task.project_id == project_id,
-                Task.user_id == user_id,
+        result = await session.stream(
+            select(Project.name, Task.name, Task.status, Task.comment)
+            .outerjoin(
+                Task, (Task.project_id == Project.id) & (Task.user_id == user_id)
             )
+            .where(Project.user_id == user_id)
+            .order_by(Project.id, Task.id)
+            .execution_options(yield_per=batch_size)
         )
-        await session.commit()
+        async for row in result:
+            yield row
 
 
-async def rename_project(project_id, user_id, new_name):
-    """Asynchronously renames a project in the database."""
+async def import_tasks(user_id, records):
+    """
+    Asynchronously adds projects and tasks of a user with one multi-row statement each.
+        Existing projects are reused, tasks whose names are already taken are skipped.
+
+    Args:
+        user_id (int): The TG ID of the user.
+        records (list[tuple]): (project, name, status, comment) of every task,
+            the name is None for a project without tasks.
+
+    Returns:
+        int: The number of added tasks, -1 if the driver does not report it.
+    """
+    names = {record[0] for record in records}
+
+    async def _write(session):
+        conn = await session.connection()
+        await conn.execute(
+            _insert(Project).on_conflict_do_nothing(index_elements=["user_id", "name"]),
+            [{"name": name, "user_id": user_id} for name in names],
+        )
+        project_ids = dict(
+            (
+                await conn.execute(
+                    select(Project.name, Project.id).where(
+                        Project.user_id == user_id, Project.name.in_(names)
+                    )
+                )
+            ).all()
+        )
+        tasks = [
+            {
+                "name": name,
+                "project_id": project_ids[project],
+                "user_id": user_id,
+                "status": status,
+                "comment": comment,
+            }
+            for project, name, status, comment in records
+            if name is not None
+        ]
+        added = 0
+        if tasks:
+            result = await conn.execute(
+                _insert(Task).on_conflict_do_nothing(
+                    index_elements=["project_id", "user_id", "name"]
+                ),
+                tasks,
+            )
+            added = result.rowcount
+        # Skipped duplicates are not reported, so the counters are recomputed
+        await conn.execute(_recount_query(project_ids.values()))
+        return project_ids.values(), added
+
+    project_ids, added = await writer.submit(_write)
+    versions.bump_user(user_id)
+    for project_id in project_ids:
+        versions.bump_project(project_id)
+    return added
+
+
+MAX_SEARCH_WORDS = 8
+
+
+def _task_search_document():
+    """
+    The text searched on PostgreSQL, the expression of the GIN index created by
+    migration 4. It is built from constants instead of bound parameters,
+    the planner uses the index only for the very same expression.
+    """
+    return func.to_tsvector(
+        literal_column("'simple'"), Task.name + literal_column("' '") + Task.comment
+    )
+
+
+def search_words(query: str) -> list[str]:
+    """
+    Returns the words of a search query that are searched for,
+    the rest is dropped so input can never form query syntax.
+    """
+    return SEARCH_WORD.findall(query.lower())[:MAX_SEARCH_WORDS]
+
+
+async def search_tasks(user_id, query, limit=None, offset=0):
+    """
+    Asynchronously searches the names and comments of the tasks of a user
+        with the full-text index, every word of the query matching a word prefix.
+
+    Results are ranked by relevance, matches in names weigh more than in comments.
+
+    Args:
+        user_id (int): The TG ID of the user.
+        query (str): The search query.
+        limit (int | None): The maximum number of tasks to return.
+        offset (int): The number of best matches to skip.
+
+    Returns:
+        list[Row]: Rows with `id`, `name`, `status`, `comment`, `version`,
+            `project_id` and `project_name` attributes, best matches first.
+    """
+    words = search_words(query)
+    if not words:
+        return []
+    columns = (
+        Task.id,
+        Task.name,
+        Task.status,
+        Task.comment,
+        Task.version,
+        Task.project_id,
+        Project.name.label("project_name"),
+    )
+    if engine.dialect.name == "postgresql":
+        document = _task_search_document()
+        tsquery = func.to_tsquery("simple", " & ".join(f"{word}:*" for word in words))
+        search = (
+            select(*columns)
+            .where(Task.user_id == user_id, document.bool_op("@@")(tsquery))
+            .order_by(func.ts_rank(document, tsquery).desc(), Task.id)
+        )
+    else:
+        # The index holds the words of each user as terms of their own,
+        # a prefix of them matches only the words of this user
+        phrases = " ".join(f'"{user_search_term(user_id, word)}"*' for word in words)
+        match = f"{{name comment}}: ({phrases})"
+        search = (
+            select(*columns)
+            .join(tasks_fts, tasks_fts.c.rowid == Task.id)
+            .where(tasks_fts.c.tasks_fts.match(match), Task.user_id == user_id)
+            .order_by(tasks_fts.c.rank, Task.id)
+        )
+    search = (
+        search.join(Project, Task.project_id == Project.id).limit(limit).offset(offset)
+    )
     async with async_session() as session:
-        await session.execute(
-            update(Project)
-            .where(
-                Project.id == project_id,
-                Project.user_id == user_id,
+        return (await session.execute(search)).all()
+
+
+async def create_broadcast(kind, text="", created_by=None):
+    """
+    Asynchronously creates a broadcast with a pending delivery to each of its recipients,
+        every user for a MESSAGE and every user with open tasks for a DIGEST.
+
+    Args:
+        kind (BroadcastKind): What the broadcast sends.
+        text (str): The text of a MESSAGE broadcast.
+        created_by (int | None): The TG ID of the admin who started it.
+
+    Returns:
+        tuple[int, int]: The ID of the broadcast and the number of its recipients.
+    """
+
+    async def _write(session):
+        broadcast_id = await session.scalar(
+            insert(Broadcast)
+            .values(
+                kind=kind,
+                text=text,
+                created_by=created_by,
+                created_at=datetime.now(timezone.utc).replace(tzinfo=None),
             )
-            .values(name=new_name)
+            .returning(Broadcast.id)
         )
-        await session.commit()
+        if kind == BroadcastKind.DIGEST:
+            recipients = (
+                select(literal(broadcast_id), Task.user_id)
+                .where(Task.status != TaskStatus.COMPLETED)
+                .distinct()
+            )
+        else:
+            recipients = select(literal(broadcast_id), User.tg_id)
+        result = await session.execute(
+            insert(Delivery).from_select(["broadcast_id", "user_id"], recipients)
+        )
+        return broadcast_id, result.rowcount
 
+    return await writer.submit(_write)
 
-async def rename_task(task_id, project_id, user_id, new_name):
-    """Asynchronously renames a task in the database."""
+
+async def get_unfinished_broadcast():
+    """
+    Asynchronously retrieves the oldest broadcast that still has deliveries to attempt.
+
+    Returns:
+        Broadcast | None: The broadcast, or None if all of them are finished.
+    """
     async with async_session() as session:
-        await session.execute(
-            update(Task)
-            .where(
-                Task.id == task_id,
-                Task.user_id == user_id,
-                Task.project_id == project_id,
-            )
-            .values(name=new_name)
+        return await session.scalar(
+            select(Broadcast)
+            .where(Broadcast.finished_at.is_(None))
+            .order_by(Broadcast.id)
+            .limit(1)
         )
-        await session.commit()
 
 
-async def chgange_task_comment(task_id, project_id, user_id, comment):
-    """Asynchronously adds a comment to a task in the database."""
+async def get_pending_deliveries(broadcast_id, limit):
+    """
+    Asynchronously retrieves the next pending deliveries of a broadcast.
+
+    Returns:
+        list[Row]: Rows with `id` and `user_id` attributes, in order of ID.
+    """
     async with async_session() as session:
-        await session.execute(
-            update(Task)
+        result = await session.execute(
+            select(Delivery.id, Delivery.user_id)
             .where(
-                Task.id == task_id,
-                Task.user_id == user_id,
-                Task.project_id == project_id,
+                Delivery.broadcast_id == broadcast_id,
+                Delivery.status == DeliveryStatus.PENDING,
             )
-            .values(comment=comment)
+            .order_by(Delivery.id)
+            .limit(limit)
+        )
+        return result.all()
+
+
+async def set_delivery_statuses(statuses):
+    """
+    Asynchronously records the outcome of deliveries, one UPDATE per status.
+
+    Args:
+        statuses (dict[DeliveryStatus, list[int]]): IDs of the deliveries by outcome.
+    """
+
+    async def _write(session):
+        for status, delivery_ids in statuses.items():
+            if delivery_ids:
+                await session.execute(
+                    update(Delivery)
+                    .where(Delivery.id.in_(delivery_ids))
+                    .values(status=status)
+                )
+
+    await writer.submit(_write)
+
+
+async def finish_broadcast(broadcast_id):
+    """
+    Asynchronously marks a broadcast as finished.
+
+    Returns:
+        dict[DeliveryStatus, int]: The number of deliveries by status.
+    """
+
+    async def _write(session):
+        await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id)
+            .values(finished_at=datetime.now(timezone.utc).replace(tzinfo=None))
+        )
+        result = await session.execute(
+            select(Delivery.status, func.count())
+            .where(Delivery.broadcast_id == broadcast_id)
+            .group_by(Delivery.status)
+        )
+        return dict(result.all())
+
+    return await writer.submit(_write)
+
+
+async def delete_old_deliveries(before):
+    """
+    Asynchronously deletes the deliveries of the broadcasts finished before `before`,
+        the broadcasts themselves are kept.
+
+    Args:
+        before (datetime): The time in UTC.
+
+    Returns:
+        int: The number of deliveries deleted.
+    """
+    finished = select(Broadcast.id).where(Broadcast.finished_at < before)
+
+    async def _write(session):
+        result = await session.execute(
+            delete(Delivery).where(Delivery.broadcast_id.in_(finished))
         )
-        await session.commit()
+        return result.rowcount
 
+    return await writer.submit(_write)
 
-async def get_task_comment(task_id, project_id, user_id):
+
+async def get_last_broadcast_time(kind):
+    """Asynchronously retrieves when the last broadcast of a kind was started, or None"""
     async with async_session() as session:
-        task = await session.scalar(
-            select(Task).where(
-                Task.id == task_id,
-                Task.project_id == project_id,
-                Task.user_id == user_id,
+        return await session.scalar(
+            select(func.max(Broadcast.created_at)).where(Broadcast.kind == kind)
+        )
+
+
+async def get_open_tasks(user_id, limit):
+    """
+    Asynchronously retrieves the open tasks of a user for the digest,
+        the ones with the nearest due date first, then the oldest.
+
+    Returns:
+        tuple[int, list[Row]]: The number of open tasks, from the project counters,
+            and at most `limit` rows with `name`, `status`, `due_at` and `project_name`.
+    """
+    async with async_session() as session:
+        count = await session.scalar(
+            select(
+                func.coalesce(
+                    func.sum(Project.tasks_notstarted + Project.tasks_inprogress), 0
+                )
+            ).where(Project.user_id == user_id)
+        )
+        if not count:
+            return 0, []
+        result = await session.execute(
+            select(
+                Task.name,
+                Task.status,
+                Task.due_at,
+                Project.name.label("project_name"),
             )
+            .join(Project, Task.project_id == Project.id)
+            .where(Task.user_id == user_id, Task.status != TaskStatus.COMPLETED)
+            .order_by(Task.due_at.is_(None), Task.due_at, Task.id)
+            .limit(limit)
         )
-        return task.comment
+        return count, result.all()
@@ -0,0 +1,133 @@
+"""This file contains the slow query log of the bot database"""
+
+import logging
+import os
+import sys
+import time
+
+import greenlet
+
+import app.config as config
+
+logger = logging.getLogger(__name__)
+
+# Statements worth explaining, transaction control and pragmas are not
+_EXPLAINABLE = ("select", "insert", "update", "delete", "with")
+
+_APP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Functions of these files run the statements but are not where they come from
+_INFRASTRUCTURE = {
+    os.path.join(_APP_DIRECTORY, "database", "models.py"),
+    os.path.join(_APP_DIRECTORY, "database", "writer.py"),
+    os.path.join(_APP_DIRECTORY, "database", "slow_queries.py"),
+}
+
+
+def _frames():
+    """
+    Yields the frames of the current call stack, innermost first.
+
+    Statements run in a greenlet whose stack ends where SQLAlchemy switched
+    into it, the async code awaiting them is on the stacks of the parent greenlets.
+    """
+    current = greenlet.getcurrent()
+    frame = sys._getframe(1)
+    while True:
+        while frame is not None:
+            yield frame
+            frame = frame.f_back
+        current = current.parent
+        if current is None:
+            return
+        frame = current.gr_frame
+
+
+def _caller():
+    """
+    Returns the innermost function of the bot the current statement comes from,
+    e.g. "app.database.requests.get_project_tasks".
+    """
+    for frame in _frames():
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(_APP_DIRECTORY) and filename not in _INFRASTRUCTURE:
+            module = os.path.relpath(filename, os.path.dirname(_APP_DIRECTORY))
+            module = os.path.splitext(module)[0].replace(os.sep, ".")
+            name = getattr(frame.f_code, "co_qualname", frame.f_code.co_name)
+            # Write operations are closures, e.g. "add_task.<locals>._write"
+            return f"{module}.{name.split('.<locals>')[0]}"
+    return None
+
+
+def _explain(conn, statement, parameters):
+    """Returns the query plan of a statement, lines joined with newlines"""
+    if not statement.lstrip().lower().startswith(_EXPLAINABLE):
+        return None
+    dialect = conn.dialect.name
+    if dialect == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    elif dialect == "postgresql":
+        prefix = "EXPLAIN "
+    else:
+        return None
+    # A raw DBAPI cursor does not fire the engine events again
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+    except Exception as error:
+        return f"unavailable: {error}"
+    finally:
+        cursor.close()
+    if dialect == "sqlite":
+        # (id, parent, notused, detail)
+        return "\n".join(str(row[-1]) for row in rows)
+    return "\n".join(str(row[0]) for row in rows)
+
+
+class SlowQueryLog:
+    """
+    Logs statements that take at least `threshold` seconds with their parameters,
+    the function of the bot they come from and their query plan.
+
+    Every statement is logged at most once per `interval` seconds,
+    the next report tells how many slow executions were skipped.
+
+    Args:
+        threshold (float): Seconds after which a statement is slow, 0 disables the log.
+        interval (float): Seconds between reports of the same statement.
+        explain (bool): Whether to capture the query plan of slow statements.
+    """
+
+    def __init__(
+        self,
+        threshold: float = config.DB_SLOW_QUERY_MS / 1000,
+        interval: float = config.DB_SLOW_QUERY_INTERVAL,
+        explain: bool = config.DB_SLOW_QUERY_EXPLAIN,
+    ):
+        self.threshold = threshold
+        self.interval = interval
+        self.explain = explain
+        # statement -> (time of the last report, slow executions since then)
+        self._reports: dict[str, tuple[float, int]] = {}
+
+    def __call__(self, conn, statement, parameters, elapsed, executemany):
+        if not self.threshold or elapsed < self.threshold:
+            return
+        now = time.monotonic()
+        reported_at, skipped = self._reports.get(statement, (None, 0))
+        if reported_at is not None and now - reported_at < self.interval:
+            self._reports[statement] = (reported_at, skipped + 1)
+            return
+        self._reports[statement] = (now, 0)
+        plan = None
+        if self.explain and not executemany:
+            plan = _explain(conn, statement, parameters)
+        logger.warning(
+            "Slow query (%.1f ms) from %s%s:\n%s\nParameters: %r%s",
+            elapsed * 1000,
+            _caller() or "unknown caller",
+            f", {skipped} more since the last report" if skipped else "",
+            statement,
+            parameters,
+            f"\nQuery plan:\n{plan}" if plan else "",
+        )
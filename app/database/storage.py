@@ -0,0 +1,222 @@
+"""This file contains the FSM storage of the bot backed by the bot database"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Mapping
+
+from aiogram import Dispatcher
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.middleware import FSMContextMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseStorage,
+    DefaultKeyBuilder,
+    KeyBuilder,
+    StateType,
+    StorageKey,
+)
+from sqlalchemy import delete, func, select, update
+
+import app.config as config
+from app.database.models import FSMRecord, async_session
+from app.database.writer import writer
+
+logger = logging.getLogger(__name__)
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class DatabaseStorage(BaseStorage):
+    """
+    FSM storage that keeps states in the `fsm_states` table, so unfinished flows
+    survive restarts, with an in-process LRU cache of at most `cache_size` records in front of it.
+
+    Records untouched for longer than `ttl` seconds belong to abandoned flows:
+    they are read as empty and deleted from the table every `cleanup_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        ttl: int = config.FSM_TTL,
+        cache_size: int = config.FSM_CACHE_SIZE,
+        cleanup_interval: int = config.FSM_CLEANUP_INTERVAL,
+        key_builder: KeyBuilder | None = None,
+    ):
+        self.ttl = timedelta(seconds=ttl)
+        self.cache_size = cache_size
+        self.cleanup_interval = cleanup_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(
+            with_bot_id=True, with_business_connection_id=True, with_destiny=True
+        )
+        # key -> (state, data, updated_at), absent records are cached as (None, {}, None)
+        self._cache: OrderedDict[str, tuple[str | None, dict, datetime | None]] = (
+            OrderedDict()
+        )
+        self._cleanup_task = None
+
+    async def start(self):
+        """Starts the periodic deletion of expired records"""
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self) -> None:
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                await self.cleanup()
+            except Exception:
+                logger.exception("Failed to delete expired FSM states")
+
+    async def cleanup(self) -> int:
+        """
+        Deletes the records of abandoned flows from the table and the cache.
+
+        Returns:
+            int: The number of deleted rows.
+        """
+        expired = _now() - self.ttl
+        for key, (_, _, updated_at) in list(self._cache.items()):
+            if updated_at is not None and updated_at < expired:
+                del self._cache[key]
+
+        async def _write(session):
+            result = await session.execute(
+                delete(FSMRecord).where(FSMRecord.updated_at < expired)
+            )
+            return result.rowcount
+
+        return await writer.submit(_write)
+
+    async def count_states(self) -> dict[str, int]:
+        """
+        Counts the unexpired records by state.
+
+        Returns:
+            dict[str, int]: The number of records in every state.
+        """
+        async with async_session() as session:
+            rows = await session.execute(
+                select(FSMRecord.state, func.count())
+                .where(
+                    FSMRecord.state.is_not(None),
+                    FSMRecord.updated_at >= _now() - self.ttl,
+                )
+                .group_by(FSMRecord.state)
+            )
+        return dict(rows.all())
+
+    def _remember(self, key, record):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key: str):
+        record = self._cache.get(key)
+        if record is None:
+            async with async_session() as session:
+                row = await session.get(FSMRecord, key)
+            if row is None:
+                record = (None, {}, None)
+            else:
+                record = (row.state, row.data, row.updated_at)
+        if record[2] is not None and record[2] < _now() - self.ttl:
+            record = (None, {}, None)
+        self._remember(key, record)
+        return record
+
+    async def _save(self, key: str, state: str | None, data: dict):
+        if state is None and not data:
+            if self._cache.get(key) == (None, {}, None):
+                # Clearing an empty record, e.g. on every Back or Cancel tap
+                return
+            record = (None, {}, None)
+        else:
+            record = (state, data, _now())
+
+        async def _write(session):
+            if record[2] is None:
+                await session.execute(delete(FSMRecord).where(FSMRecord.key == key))
+                return
+            result = await session.execute(
+                update(FSMRecord)
+                .where(FSMRecord.key == key)
+                .values(state=state, data=data, updated_at=record[2])
+            )
+            if result.rowcount == 0:
+                session.add(
+                    FSMRecord(key=key, state=state, data=data, updated_at=record[2])
+                )
+
+        await writer.submit(_write)
+        self._remember(key, record)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        _, data, _ = await self._load(storage_key)
+        state = state.state if isinstance(state, State) else state
+        await self._save(storage_key, state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        storage_key = self.key_builder.build(key)
+        state, _, _ = await self._load(storage_key)
+        await self._save(storage_key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data, _ = await self._load(self.key_builder.build(key))
+        return data.copy()
+
+    async def clear(self, key: StorageKey) -> None:
+        """Drops the state and the data of a key with one write"""
+        await self._save(self.key_builder.build(key), None, {})
+
+
+class DatabaseFSMContext(FSMContext):
+    """
+    FSM context whose `clear` deletes the record of the flow in one write,
+    instead of saving the state and the data one after the other.
+    """
+
+    async def clear(self) -> None:
+        await self.storage.clear(self.key)
+
+
+class DatabaseFSMContextMiddleware(FSMContextMiddleware):
+    """FSM middleware that gives handlers a DatabaseFSMContext"""
+
+    def get_context(self, *args, **kwargs) -> FSMContext:
+        context = super().get_context(*args, **kwargs)
+        return DatabaseFSMContext(storage=context.storage, key=context.key)
+
+
+def use_database_context(dispatcher: Dispatcher):
+    """
+    Replaces the FSM middleware of a dispatcher with DatabaseStorage by
+    DatabaseFSMContextMiddleware. Call it right after creating the dispatcher,
+    before other outer update middlewares are registered, to keep their order.
+    """
+    fsm = dispatcher.fsm
+    dispatcher.update.outer_middleware.unregister(fsm)
+    dispatcher.fsm = DatabaseFSMContextMiddleware(
+        storage=fsm.storage,
+        events_isolation=fsm.events_isolation,
+        strategy=fsm.strategy,
+    )
+    dispatcher.update.outer_middleware(dispatcher.fsm)
@@ -0,0 +1,102 @@
+"""This file contains the single writer that applies all database writes of the bot"""
+
+import asyncio
+import logging
+
+import app.config as config
+from app.database.models import async_session, query_stats
+
+logger = logging.getLogger(__name__)
+
+
+class Writer:
+    """
+    Applies database writes from a single task with group commit.
+
+    A write operation is a coroutine function that takes a session and returns a result.
+    While the writer is running, operations are queued; the writer task drains up to
+    `batch_size` of them, runs each one in its own savepoint of a shared transaction,
+    commits the transaction once and resolves the future of every caller.
+    When the writer is not running, operations are applied directly in their own transaction.
+    Statements of an operation are counted in the `query_stats` of the caller.
+    """
+
+    def __init__(self, batch_size: int = config.DB_WRITE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue()
+        self._task = None
+
+    async def start(self):
+        """Starts the writer task"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Applies the queued operations and stops the writer task"""
+        if self._task is None:
+            return
+        await self.queue.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def submit(self, operation):
+        """
+        Applies a write operation and waits for it to be committed.
+
+        Args:
+            operation (Callable[[AsyncSession], Awaitable]): The write operation.
+
+        Returns:
+            The result of the operation. Exceptions raised by the operation
+            or by the commit are raised here.
+        """
+        if self._task is None:
+            async with async_session() as session:
+                result = await operation(session)
+                await session.commit()
+            return result
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((operation, future, query_stats.get()))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self._apply(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _apply(self, batch):
+        outcomes = []
+        try:
+            async with async_session() as session:
+                async with session.begin():
+                    for operation, future, stats in batch:
+                        token = query_stats.set(stats)
+                        try:
+                            async with session.begin_nested():
+                                result = await operation(session)
+                        except Exception as error:
+                            outcomes.append((future, None, error))
+                        else:
+                            outcomes.append((future, result, None))
+                        finally:
+                            query_stats.reset(token)
+        except Exception as error:
+            logger.exception("Failed to commit a batch of %s writes", len(batch))
+            outcomes = [(future, None, error) for _, future, _ in batch]
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+writer = Writer()
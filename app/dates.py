@@ -0,0 +1,64 @@
+"""This file contains the parsing and formatting of the due dates of tasks"""
+
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import app.config as config
+
+# Time zone due dates are entered and shown in
+ZONE = ZoneInfo(config.TIMEZONE)
+
+# Formats of entered due dates, the ones without a year are the next time the date comes
+DUE_FORMATS = ("%d.%m.%Y %H:%M", "%d.%m %H:%M", "%d.%m.%Y", "%d.%m")
+
+# Years to look ahead for a date without a year, 29.02 comes every four years
+YEARS_AHEAD = 4
+
+
+def parse_due(text, now=None):
+    """
+    Parses an entered due date, dates without a time are due at the end of the day.
+
+    Args:
+        text (str): The entered date.
+        now (datetime | None): The local time dates without a year are compared to,
+            the current time by default.
+
+    Returns:
+        datetime | None: The due date in UTC, or None if the text is not a date.
+    """
+    text = " ".join(text.split())
+    if now is None:
+        now = datetime.now(ZONE).replace(tzinfo=None)
+    date, _, time = text.partition(" ")
+    for due_format in DUE_FORMATS:
+        if "%Y" in due_format:
+            candidates = [text]
+        else:
+            # strptime fills in 1900 for a missing year, which has no 29.02,
+            # so the year is added before parsing
+            due_format = due_format.replace("%m", "%m.%Y")
+            candidates = [
+                f"{date}.{year} {time}".strip()
+                for year in range(now.year, now.year + YEARS_AHEAD + 1)
+            ]
+        for candidate in candidates:
+            try:
+                due = datetime.strptime(candidate, due_format)
+            except ValueError:
+                continue
+            if "%H" not in due_format:
+                due = due.replace(hour=23, minute=59)
+            if candidate is text or due >= now:
+                return (
+                    due.replace(tzinfo=ZONE)
+                    .astimezone(timezone.utc)
+                    .replace(tzinfo=None)
+                )
+    return None
+
+
+def format_due(due_at):
+    """Formats a due date in UTC for the user"""
+    local = due_at.replace(tzinfo=timezone.utc).astimezone(ZONE)
+    return local.strftime("%d.%m.%Y %H:%M")
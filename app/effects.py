@@ -0,0 +1,114 @@
+"""This file contains the executor of the Telegram side effects of handlers"""
+
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramBadRequest
+
+import app.config as config
+
+logger = logging.getLogger(__name__)
+
+
+async def gather(*awaitables):
+    """
+    Runs independent API calls and database reads concurrently.
+
+    Returns:
+        list: The results, in the order of the awaitables. The first exception
+            cancels the others and is raised.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+class Effects:
+    """
+    Takes the side effects the user does not wait for off the critical path of handlers.
+
+    `spawn` starts an effect the user sees, like answering a callback query,
+    without waiting for it. `cleanup` queues an effect nobody waits for,
+    like deleting the messages of the user, for a few workers. When more than
+    `size` cleanups are queued new ones are dropped instead of piling up during
+    a flood wait. Failures of both are logged.
+
+    Args:
+        size (int): The maximum number of queued cleanups.
+        workers (int): The number of cleanups run at once.
+    """
+
+    def __init__(
+        self,
+        size: int = config.CLEANUP_QUEUE_SIZE,
+        workers: int = config.CLEANUP_WORKERS,
+    ):
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(size)
+        self._workers: list[asyncio.Task] = []
+        # Spawned effects still running, referenced so they are not collected
+        self._spawned: set[asyncio.Task] = set()
+
+    async def start(self):
+        """Starts the cleanup workers"""
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._work()) for _ in range(self.workers)
+            ]
+
+    async def close(self):
+        """Stops the cleanup workers, queued cleanups are dropped"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, *self._spawned, return_exceptions=True)
+        self._workers = []
+
+    async def wait(self):
+        """Waits for the spawned effects and the queued cleanups, e.g. in benchmarks"""
+        while self._spawned:
+            await asyncio.gather(*self._spawned, return_exceptions=True)
+        if self._workers:
+            await self._queue.join()
+
+    def spawn(self, awaitable):
+        """Starts an effect without waiting for it"""
+        task = asyncio.ensure_future(awaitable)
+        self._spawned.add(task)
+        task.add_done_callback(self._spawned.discard)
+        task.add_done_callback(_log_failure)
+
+    def cleanup(self, function, *args):
+        """Queues a call of `function(*args)`, an async function, for the workers"""
+        try:
+            self._queue.put_nowait((function, args))
+        except asyncio.QueueFull:
+            logger.warning("Cleanup queue is full, dropped %s", function.__qualname__)
+
+    def delete(self, message):
+        """Queues the deletion of a message"""
+        self.cleanup(message.delete)
+
+    async def _work(self):
+        while True:
+            function, args = await self._queue.get()
+            try:
+                await function(*args)
+            except TelegramBadRequest as error:
+                # E.g. a message that is already deleted or too old to be deleted
+                logger.debug("Cleanup %s failed: %s", function.__qualname__, error)
+            except Exception:
+                logger.exception("Cleanup %s failed", function.__qualname__)
+            finally:
+                self._queue.task_done()
+
+
+def _log_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Side effect failed", exc_info=task.exception())
+
+
+effects = Effects()
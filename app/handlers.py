@@ -1,17 +1,53 @@
 """This file contains all message handlers for the bot"""
 
+import asyncio
+from datetime import datetime, timezone
+
 from aiogram import F, Router
-from aiogram.types import Message, CallbackQuery
-from aiogram.filters import CommandStart
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    CallbackQuery,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent,
+    Message,
+)
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 
+import app.config as config
 import app.text as t
 import app.kb as kb
 import app.database.requests as rq
-
+from app.database.cache import inline_results
+from app.callbacks import (
+    Action,
+    CallbackPayload,
+    CallbackPayloadMiddleware,
+    CallbackTable,
+    Position,
+)
+from app.database.models import STATUS_EMOJI, BroadcastKind
+from app.middlewares import MetricsMiddleware, QueryStatsMiddleware
+from app.outbox import outbox
+from app.dates import format_due, parse_due
+from app.effects import effects, gather
+from app.scheduler import scheduler
+from app.transfer import ExportFile, import_file
 
 router = Router()
+router.callback_query.outer_middleware(CallbackPayloadMiddleware())
+
+callbacks = CallbackTable()
+
+router.message.middleware(QueryStatsMiddleware())
+router.message.middleware(MetricsMiddleware())
+router.callback_query.middleware(QueryStatsMiddleware(callbacks))
+router.callback_query.middleware(MetricsMiddleware(callbacks))
+router.inline_query.middleware(QueryStatsMiddleware())
+router.inline_query.middleware(MetricsMiddleware())
 
 
 class States(StatesGroup):
@@ -33,6 +69,106 @@ class States(StatesGroup):
 
     waiting_for_comment = State()
 
+    selecting_tasks = State()
+
+    waiting_for_import_file = State()
+
+    waiting_for_search_query = State()
+
+    waiting_for_due_date = State()
+
+
+def task_text(view, position, project_name=None):
+    """
+    Text of the task management screen built from a task view,
+    or from a task row and the name of its project
+    """
+    emoji = STATUS_EMOJI[view.status]
+    comment = view.comment or "Комментарий пока не добавлен"
+    due = f"\nСрок: {format_due(view.due_at)}" if view.due_at else ""
+    if position == Position.GENERAL:
+        return f'Вы выбрали задачу "{emoji} {view.name}" в общих задачах\n\nКомментарий: "{comment}"{due}'
+    project_name = project_name or view.project_name
+    return f'Вы выбрали задачу "{emoji} {view.name}" в проекте "{project_name}"\n\nКомментарий: "{comment}"{due}'
+
+
+async def show_menu(message: Message, menu_id, text, reply_markup=None):
+    """
+    Shows a screen in the menu message of the chat, the prompt a text input answers,
+    by editing it in place. A new menu message is sent if the old one can not be
+    edited any more, e.g. it was deleted.
+
+    Returns:
+        int: The ID of the menu message.
+    """
+    try:
+        await message.bot.edit_message_text(
+            text,
+            chat_id=message.chat.id,
+            message_id=menu_id,
+            reply_markup=reply_markup,
+        )
+        return menu_id
+    except TelegramBadRequest as error:
+        if "message is not modified" in error.message:
+            return menu_id
+    answer = await message.answer(text, reply_markup=reply_markup)
+    return answer.message_id
+
+
+def task_position(position):
+    """Task screens are opened either from the general tasks or from a project task list"""
+    if position == Position.GENERAL:
+        return Position.GENERAL
+    return Position.LIST
+
+
+async def task_list(project_id, user_id, position):
+    """Text and keyboard of the general task list or of a project task list"""
+    if position == Position.GENERAL:
+        return "Список общих задач", await kb.general_tasks(project_id, user_id)
+    project_name, keyboard = await gather(
+        rq.get_project_name(project_id, user_id), kb.project_tasks(project_id, user_id)
+    )
+    return f'Список задач проекта "{project_name}"', keyboard
+
+
+# Answer to a button or an input of a task that was deleted or moved meanwhile
+TASK_NOT_FOUND = "Задача не найдена, возможно, она уже удалена или перенесена"
+
+
+async def task_not_found(callback: CallbackQuery, state: FSMContext):
+    """Stale task button: alert the user and show the main menu again"""
+    await state.clear()
+    effects.spawn(callback.answer(TASK_NOT_FOUND, show_alert=True))
+    await callback.message.edit_text(
+        "Главное меню", reply_markup=await kb.starting_kb(callback.from_user.id)
+    )
+
+
+def answer_unchanged_status(callback: CallbackQuery, payload: CallbackPayload, view):
+    """
+    Answers a status button that changed nothing although the task still exists.
+    Returns whether the task changed since the button was shown and has to be
+    shown again, otherwise it already has the status the button sets.
+    """
+    if view.version == payload.version or payload.version is None:
+        effects.spawn(callback.answer("У задачи уже такой статус"))
+        return False
+    effects.spawn(callback.answer("Задача уже изменилась, проверьте её статус"))
+    return True
+
+
+async def task_input_not_found(message: Message, state: FSMContext, menu_id):
+    """Input for a task that no longer exists: show the main menu in the menu message"""
+    await state.clear()
+    await show_menu(
+        message,
+        menu_id,
+        f"{TASK_NOT_FOUND}\n\nГлавное меню",
+        reply_markup=await kb.starting_kb(message.from_user.id),
+    )
+
 
 @router.message(CommandStart())
 async def cmd_start(message: Message):
@@ -46,6 +182,279 @@ async def cmd_start(message: Message):
     )
 
 
+@router.message(Command("broadcast"), F.from_user.id.in_(config.ADMIN_IDS))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    """Command /broadcast: sending a message to all users, for admins only"""
+    if not command.args:
+        await message.answer(
+            "Напишите текст рассылки после команды: /broadcast <текст>"
+        )
+        return
+    broadcast_id, recipients = await rq.create_broadcast(
+        BroadcastKind.MESSAGE, command.args, message.from_user.id
+    )
+    outbox.wake()
+    await message.answer(
+        f"Рассылка #{broadcast_id} запущена, получателей: {recipients}. "
+        "Когда она завершится, придёт отчёт"
+    )
+
+
+# Largest file the Bot API lets bots download
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+
+IMPORT_PROMPT = "Отправьте файл .jsonl, полученный через /export"
+
+
+@router.message(Command("export"))
+async def cmd_export(message: Message):
+    """Command /export: sending all projects and tasks as a JSON Lines file"""
+    # The file has at least the "General" project then, Telegram rejects empty files
+    await rq.add_user(message.from_user.id)
+    await rq.add_project(message.from_user.id, "General")
+    await message.answer_document(
+        ExportFile(message.from_user.id),
+        caption="Ваши проекты и задачи, загрузите файл через /import, чтобы перенести их",
+    )
+
+
+@router.message(Command("import"))
+async def cmd_import(message: Message, state: FSMContext):
+    """Command /import: asking for the file"""
+    await rq.add_user(message.from_user.id)
+    await rq.add_project(message.from_user.id, "General")
+    answer = await message.answer(
+        IMPORT_PROMPT, reply_markup=await kb.cancel(None, Position.GENERAL)
+    )
+    await state.set_state(States.waiting_for_import_file)
+    await state.update_data(message_id=answer.message_id)
+
+
+@router.message(States.waiting_for_import_file, F.document)
+async def receive_import_file(message: Message, state: FSMContext):
+    """Command /import: receiving the file"""
+    data = await state.get_data()
+    error = None
+    if (message.document.file_size or 0) > MAX_IMPORT_FILE_SIZE:
+        error = "Ошибка: файл слишком большой, максимальный размер — 20 МБ"
+    else:
+        try:
+            file = await message.bot.download(message.document)
+        except TelegramBadRequest:
+            error = "Ошибка: не удалось загрузить файл"
+    effects.delete(message)
+    if error is not None:
+        # Asked again, the flow goes on in the menu message
+        menu_id = await show_menu(
+            message,
+            data["message_id"],
+            f"{error}\n\n{IMPORT_PROMPT}",
+            reply_markup=await kb.cancel(None, Position.GENERAL),
+        )
+        await state.update_data(message_id=menu_id)
+        return
+    await state.clear()
+    result = await import_file(message.from_user.id, file)
+    text = f"Импорт завершён, задач в файле: {result.tasks}"
+    if result.added >= 0:
+        text += f", добавлено новых: {result.added}"
+    if result.invalid:
+        text += f"\nПропущено некорректных строк: {result.invalid}"
+    await show_menu(
+        message,
+        data["message_id"],
+        text,
+        reply_markup=await kb.starting_kb(message.from_user.id),
+    )
+
+
+async def search_results(user_id, query, page=0):
+    """Text and keyboard of a page of the results of a search"""
+    found, reply_markup = await kb.search_results(user_id, query, page)
+    if not found:
+        return f'По запросу "{query}" ничего не найдено', reply_markup
+    return f'Результаты поиска по запросу "{query}"', reply_markup
+
+
+@router.message(Command("search"))
+async def cmd_search(message: Message, state: FSMContext, command: CommandObject):
+    """Command /search: searching tasks, the query can follow the command"""
+    if command.args:
+        await state.clear()
+        await state.update_data(search_query=command.args)
+        text, reply_markup = await search_results(message.from_user.id, command.args)
+        await message.answer(text, reply_markup=reply_markup)
+        return
+    answer = await message.answer(
+        "Введите, что найти в названиях и комментариях задач",
+        reply_markup=await kb.cancel(None, Position.GENERAL),
+    )
+    await state.set_state(States.waiting_for_search_query)
+    await state.update_data(message_id=answer.message_id)
+
+
+@callbacks.on(Action.SEARCH)
+async def search(callback: CallbackQuery, payload: CallbackPayload, state: FSMContext):
+    """Search tasks: asking for the query"""
+    effects.spawn(callback.answer("Поиск задач"))
+    await state.set_state(States.waiting_for_search_query)
+    await state.update_data(message_id=callback.message.message_id)
+    await callback.message.edit_text(
+        "Введите, что найти в названиях и комментариях задач",
+        reply_markup=await kb.cancel(None, Position.GENERAL),
+    )
+
+
+@router.message(States.waiting_for_search_query, F.text)
+async def search_query(message: Message, state: FSMContext):
+    """Search tasks: receiving the query"""
+    data = await state.get_data()
+    effects.delete(message)
+    # Kept without a state for the page buttons of the results
+    await state.clear()
+    await state.update_data(search_query=message.text)
+    text, reply_markup = await search_results(message.from_user.id, message.text)
+    await show_menu(message, data["message_id"], text, reply_markup)
+
+
+@callbacks.on(Action.SEARCH_PAGE)
+async def search_page(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Show another page of the results of the last search"""
+    query = (await state.get_data()).get("search_query")
+    if query is None:
+        await outdated_button(callback, payload, state)
+        return
+    effects.spawn(callback.answer())
+    text, reply_markup = await search_results(
+        callback.from_user.id, query, payload.page
+    )
+    await callback.message.edit_text(text, reply_markup=reply_markup)
+
+
+# Inline mode, `@Taskzilla <query>` in any chat
+
+# Results per answer, the next ones are asked for with the offset
+INLINE_PAGE_SIZE = 20
+
+
+def shared_task_text(task, project_name=None):
+    """
+    Text of a task shared to a chat from an inline query, built from a task view
+    or from a task row and the name of its project
+    """
+    emoji = STATUS_EMOJI[task.status]
+    project_name = project_name or task.project_name
+    if project_name == "General":
+        text = f"{emoji} {task.name}\nОбщие задачи"
+    else:
+        text = f'{emoji} {task.name}\nПроект "{project_name}"'
+    if task.comment:
+        text += f"\n\nКомментарий: {task.comment}"
+    return text
+
+
+async def inline_answer(user_id, query, offset):
+    """Inline query results of a page of the tasks found by a query and the next offset"""
+    tasks = await rq.search_tasks(user_id, query, INLINE_PAGE_SIZE + 1, offset)
+    results = []
+    for task in tasks[:INLINE_PAGE_SIZE]:
+        emoji = STATUS_EMOJI[task.status]
+        project = (
+            "Общие задачи" if task.project_name == "General" else task.project_name
+        )
+        results.append(
+            InlineQueryResultArticle(
+                id=str(task.id),
+                title=f"{emoji} {task.name}",
+                description=f"{project} · {task.comment}" if task.comment else project,
+                input_message_content=InputTextMessageContent(
+                    message_text=shared_task_text(task)
+                ),
+                reply_markup=await kb.inline_task(
+                    task.project_id, task.id, task.version
+                ),
+            )
+        )
+    next_offset = (
+        str(offset + INLINE_PAGE_SIZE) if len(tasks) > INLINE_PAGE_SIZE else ""
+    )
+    return results, next_offset
+
+
+@router.inline_query()
+async def inline_query(inline_query: InlineQuery):
+    """Inline mode: searching the tasks of the user from any chat"""
+    user_id = inline_query.from_user.id
+    words = rq.search_words(inline_query.query)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    results, next_offset = [], ""
+    cache_time = config.INLINE_CACHE_TIME
+    if words:
+        # Queries differing only in case and punctuation share their results
+        query = " ".join(words)
+        try:
+            results, next_offset = await asyncio.wait_for(
+                inline_results.get(
+                    (user_id, query, offset),
+                    user_id,
+                    None,
+                    lambda: inline_answer(user_id, query, offset),
+                ),
+                config.INLINE_QUERY_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            # Answered before Telegram gives up on the query, not worth caching
+            cache_time = 0
+    button = None
+    if not results and not offset:
+        button = InlineQueryResultsButton(
+            text="Открыть Taskzilla", start_parameter="inline"
+        )
+    await inline_query.answer(
+        results,
+        cache_time=cache_time,
+        is_personal=True,
+        next_offset=next_offset,
+        button=button,
+    )
+
+
+@callbacks.on(Action.INLINE_STATUS)
+async def inline_status(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Change the status of a task shared from an inline query"""
+    # Anyone in the chat can press the buttons, the task is only found for its owner
+    user_id = callback.from_user.id
+    project_id = payload.project_id
+    task_id = payload.task_id
+    task = await rq.change_task_status(
+        task_id, project_id, user_id, payload.status, payload.version
+    )
+    if task is None:
+        # Nothing changed, find out why
+        task = await rq.get_task_view(task_id, project_id, user_id)
+        if task is None:
+            effects.spawn(
+                callback.answer(
+                    "Задача удалена или принадлежит не вам", show_alert=True
+                )
+            )
+            return
+        if not answer_unchanged_status(callback, payload, task):
+            return
+    else:
+        effects.spawn(callback.answer("Статус задачи изменен"))
+    # Messages sent in inline mode are edited by their ID, the callback has no message
+    await callback.bot.edit_message_text(
+        shared_task_text(task),
+        inline_message_id=callback.inline_message_id,
+        reply_markup=await kb.inline_task(project_id, task_id, task.version),
+    )
+
+
 @router.message(
     F.content_type.in_(
         {
@@ -83,23 +492,49 @@ async def cmd_start(message: Message):
 )
 async def filter_trash(message: Message):
     """Filter trash messages"""
-    await message.delete()
+    effects.delete(message)
+
+
+@router.callback_query()
+async def callback_query(
+    callback: CallbackQuery, payload: CallbackPayload | None, state: FSMContext
+):
+    """Route every callback query to its handler in the callback table"""
+    await callbacks.dispatch(callback, payload, state)
+
+
+@callbacks.on_unknown
+async def outdated_button(
+    callback: CallbackQuery, payload: CallbackPayload | None, state: FSMContext
+):
+    """Buttons of messages sent by an older version of the bot lead to the main menu"""
+    await state.clear()
+    if callback.message is None:
+        # Messages sent in inline mode belong to another chat, there is no menu to show
+        effects.spawn(callback.answer("Кнопка устарела", show_alert=True))
+        return
+    effects.spawn(callback.answer("Кнопка устарела, возвращаю в главное меню"))
+    await callback.message.edit_text(
+        "Главное меню", reply_markup=await kb.starting_kb(callback.from_user.id)
+    )
 
 
 # Handling messages related to TASKS
-@router.callback_query(F.data.startswith("new_task_"))
-async def new_task(callback: CallbackQuery, state: FSMContext):
+@callbacks.on(Action.NEW_TASK)
+async def new_task(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Create a new task: asking for task name"""
-    await callback.answer("Создание новой задачи")
+    effects.spawn(callback.answer("Создание новой задачи"))
     await state.set_state(States.waiting_for_task_name)
-    project_id = callback.data.split("_")[2]
-    position = callback.data.split("_")[3]
     await state.update_data(
-        project_id=project_id, message_id=callback.message.message_id, position=position
+        project_id=payload.project_id,
+        message_id=callback.message.message_id,
+        position=payload.position.value,
     )
     await callback.message.edit_text(
         "Введите название задачи",
-        reply_markup=await kb.cancel(callback.from_user.id, project_id, position),
+        reply_markup=await kb.cancel(payload.project_id, payload.position),
     )
 
 
@@ -107,107 +542,106 @@ async def new_task(callback: CallbackQuery, state: FSMContext):
 async def create_new_task(message: Message, state: FSMContext):
     """Create a new task: receiving task name"""
     data = await state.get_data()
-    project_name = await rq.get_project_name(data["project_id"], message.from_user.id)
     project_id = data["project_id"]
-    await rq.add_task(project_id, f"{message.text}", message.from_user.id)
-    task_id = await rq.get_task_id(message.text, project_id, message.from_user.id)
-    task_emoji = await rq.get_task_emoji(task_id, project_id, message.from_user.id)
-    await message.delete()
-    await message.bot.delete_message(message.chat.id, message_id=data["message_id"])
-    if data["position"] == "general":
-        await message.answer(
+    position = Position(data["position"])
+    project_name = None
+    if position != Position.GENERAL:
+        # Read before the insert, which makes the cached name stale
+        project_name = await rq.get_project_name(project_id, message.from_user.id)
+    task = await rq.add_task(project_id, f"{message.text}", message.from_user.id)
+    task_emoji = STATUS_EMOJI[task.status]
+    effects.delete(message)
+    if position == Position.GENERAL:
+        await show_menu(
+            message,
+            data["message_id"],
             f'Задача "{task_emoji} {message.text}" в общих задачах создана',
             reply_markup=await kb.general_tasks(project_id, message.from_user.id),
         )
-    elif data["position"] == "list":
-        await message.answer(
+    elif position == Position.LIST:
+        await show_menu(
+            message,
+            data["message_id"],
             f'Задача "{task_emoji} {message.text}" в проекте "{project_name}" создана',
             reply_markup=await kb.project_tasks(project_id, message.from_user.id),
         )
-    elif data["position"] == "project":
-        await message.answer(
+    elif position == Position.PROJECT:
+        await show_menu(
+            message,
+            data["message_id"],
             f'Задача "{task_emoji} {message.text}" в проекте "{project_name}" создана',
             reply_markup=await kb.manage_project(project_id),
         )
     await state.clear()
 
 
-@router.callback_query(F.data.startswith("task_"))
-async def task(callback: CallbackQuery):
+@callbacks.on(Action.TASK)
+async def task(callback: CallbackQuery, payload: CallbackPayload, state: FSMContext):
     """Manage a task"""
-    project_id = callback.data.split("_")[2]
-    task_id = callback.data.split("_")[3]
-    task_name = await rq.get_task_name(task_id, project_id, callback.from_user.id)
-    task_emoji = await rq.get_task_emoji(task_id, project_id, callback.from_user.id)
-    project_name = await rq.get_project_name(project_id, callback.from_user.id)
-    position = callback.data.split("_")[-1]
-    comment = await rq.get_task_comment(task_id, project_id, callback.from_user.id)
-    if not comment:
-        comment = "Комментарий пока не добавлен"
-    if position == "general":
-        back_callback_data = "list_general_tasks"
-        answer = f'Вы выбрали задачу "{task_emoji} {task_name}" в общих задачаx\n\nКомментарий: "{comment}"'
-    elif position == "list":
-        back_callback_data = f"list_tasks_{project_id}"
-        answer = f'Вы выбрали задачу "{task_emoji} {task_name}" в проекте "{project_name}"\n\nКомментарий: "{comment}"'
-    await callback.answer(answer)
+    position = task_position(payload.position)
+    view = await rq.get_task_view(
+        payload.task_id, payload.project_id, callback.from_user.id
+    )
+    if view is None:
+        await task_not_found(callback, state)
+        return
+    answer = task_text(view, position)
+    effects.spawn(callback.answer(answer))
     await callback.message.edit_text(
         answer,
         reply_markup=await kb.manage_task(
-            project_id, task_id, back_callback_data, position
+            payload.project_id, payload.task_id, position, view.version
         ),
     )
 
 
-@router.callback_query(F.data.startswith("add_comment_"))
-async def add_comment(callback: CallbackQuery, state: FSMContext):
+@callbacks.on(Action.ADD_COMMENT)
+async def add_comment(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Add comment"""
-    project_id = callback.data.split("_")[2]
-    task_id = callback.data.split("_")[3]
-    position = callback.data.split("_")[4]
-    task_name = await rq.get_task_name(task_id, project_id, callback.from_user.id)
-    await callback.answer("Добавление комментария")
+    view = await rq.get_task_view(
+        payload.task_id, payload.project_id, callback.from_user.id
+    )
+    if view is None:
+        await task_not_found(callback, state)
+        return
+    effects.spawn(callback.answer("Добавление комментария"))
     await state.set_state(States.waiting_for_comment)
     await state.update_data(
-        project_id=project_id,
-        task_id=task_id,
+        project_id=payload.project_id,
+        task_id=payload.task_id,
         message_id=callback.message.message_id,
-        position=position,
+        position=payload.position.value,
     )
     await callback.message.edit_text(
-        f'Введите комментарий для задачи "{task_name}"',
-        reply_markup=await kb.cancel_changing_comment(project_id, task_id, position),
+        f'Введите комментарий для задачи "{view.name}"',
+        reply_markup=await kb.cancel_changing_comment(
+            payload.project_id, payload.task_id, payload.position
+        ),
     )
 
 
-@router.callback_query(F.data.startswith("cancelChangingComment_"))
-async def cancel_changing_comment(callback: CallbackQuery, state: FSMContext):
+@callbacks.on(Action.CANCEL_COMMENT)
+async def cancel_changing_comment(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Cancel changing comment"""
     await state.clear()
-    project_id = callback.data.split("_")[1]
-    task_id = callback.data.split("_")[2]
-    position = callback.data.split("_")[3]
-    task_name = await rq.get_task_name(task_id, project_id, callback.from_user.id)
-    task_emoji = await rq.get_task_emoji(task_id, project_id, callback.from_user.id)
-    comment = await rq.get_task_comment(task_id, project_id, callback.from_user.id)
-    if not comment:
-        comment = "Комментарий пока не добавлен"
-    await callback.answer("Отмена")
-    if position == "general":
-        await callback.message.edit_text(
-            f'Вы выбрали задачу "{task_emoji} {task_name}" в общих задачах\n\nКомментарий: "{comment}"',
-            reply_markup=await kb.manage_task(
-                project_id, task_id, "list_general_tasks", "general"
-            ),
-        )
-    else:
-        project_name = await rq.get_project_name(project_id, callback.from_user.id)
-        await callback.message.edit_text(
-            f'Вы выбрали задачу "{task_emoji} {task_name}" в проекте "{project_name}"\n\nКомментарий: "{comment}"',
-            reply_markup=await kb.manage_task(
-                project_id, task_id, "list_tasks_" + project_id, "list"
-            ),
-        )
+    position = task_position(payload.position)
+    view = await rq.get_task_view(
+        payload.task_id, payload.project_id, callback.from_user.id
+    )
+    if view is None:
+        await task_not_found(callback, state)
+        return
+    effects.spawn(callback.answer("Отмена"))
+    await callback.message.edit_text(
+        task_text(view, position),
+        reply_markup=await kb.manage_task(
+            payload.project_id, payload.task_id, position, view.version
+        ),
+    )
 
 
 @router.message(States.waiting_for_comment)
@@ -216,80 +650,162 @@ async def add_comment_name(message: Message, state: FSMContext):
     data = await state.get_data()
     task_id = data["task_id"]
     project_id = data["project_id"]
-    position = data["position"]
-    project_name = await rq.get_project_name(project_id, message.from_user.id)
-    task_name = await rq.get_task_name(task_id, project_id, message.from_user.id)
-    task_emoji = await rq.get_task_emoji(task_id, project_id, message.from_user.id)
-    comment = message.text
-    await rq.chgange_task_comment(task_id, project_id, message.from_user.id, comment)
-    await message.delete()
-    await message.bot.delete_message(message.chat.id, message_id=data["message_id"])
-    if position == "general":
-        back_callback_data = "list_general_tasks"
-        answer = f'Вы выбрали задачу "{task_emoji} {task_name}" в общих задачаx\n\nКомментарий: "{comment}"'
-    else:
-        back_callback_data = f"list_tasks_{project_id}"
-        answer = f'Вы выбрали задачу "{task_emoji} {task_name}" в проекте "{project_name}"\n\nКомментарий: "{comment}"'
-    await message.answer(
-        answer,
-        reply_markup=await kb.manage_task(
-            project_id, task_id, back_callback_data, position
+    position = task_position(Position(data["position"]))
+    await rq.chgange_task_comment(
+        task_id, project_id, message.from_user.id, message.text
+    )
+    view = await rq.get_task_view(task_id, project_id, message.from_user.id)
+    effects.delete(message)
+    if view is None:
+        await task_input_not_found(message, state, data["message_id"])
+        return
+    await show_menu(
+        message,
+        data["message_id"],
+        task_text(view, position),
+        reply_markup=await kb.manage_task(project_id, task_id, position, view.version),
+    )
+    await state.clear()
+
+
+def due_date_prompt(name):
+    """Text asking for the due date of a task"""
+    return (
+        f'Введите срок задачи "{name}" в формате ДД.ММ.ГГГГ ЧЧ:ММ или ДД.ММ, '
+        'или "-", чтобы убрать срок'
+    )
+
+
+@callbacks.on(Action.DUE_DATE)
+async def due_date(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Set due date"""
+    view = await rq.get_task_view(
+        payload.task_id, payload.project_id, callback.from_user.id
+    )
+    if view is None:
+        await task_not_found(callback, state)
+        return
+    effects.spawn(callback.answer("Срок задачи"))
+    await state.set_state(States.waiting_for_due_date)
+    await state.update_data(
+        project_id=payload.project_id,
+        task_id=payload.task_id,
+        message_id=callback.message.message_id,
+        position=payload.position.value,
+    )
+    # Canceling works like for comments, both return to the task
+    await callback.message.edit_text(
+        due_date_prompt(view.name),
+        reply_markup=await kb.cancel_changing_comment(
+            payload.project_id, payload.task_id, payload.position
         ),
     )
+
+
+@router.message(States.waiting_for_due_date, F.text)
+async def due_date_value(message: Message, state: FSMContext):
+    """Set due date: receiving the date"""
+    data = await state.get_data()
+    task_id = data["task_id"]
+    project_id = data["project_id"]
+    position = task_position(Position(data["position"]))
+    user_id = message.from_user.id
+    due_at = None
+    error = None
+    if message.text.strip() != "-":
+        due_at = parse_due(message.text)
+        if due_at is None:
+            error = f'Ошибка: "{message.text}" не похоже на дату'
+        elif due_at <= datetime.now(timezone.utc).replace(tzinfo=None):
+            error = "Ошибка: этот срок уже прошёл"
+    effects.delete(message)
+    if error is not None:
+        # Asked again, the flow goes on in the menu message
+        view = await rq.get_task_view(task_id, project_id, user_id)
+        if view is None:
+            await task_input_not_found(message, state, data["message_id"])
+            return
+        menu_id = await show_menu(
+            message,
+            data["message_id"],
+            f"{error}\n\n{due_date_prompt(view.name)}",
+            reply_markup=await kb.cancel_changing_comment(
+                project_id, task_id, Position(data["position"])
+            ),
+        )
+        await state.update_data(message_id=menu_id)
+        return
+    task = await rq.set_task_due(task_id, project_id, user_id, due_at)
+    if task is not None:
+        scheduler.schedule(task.id, task.remind_at)
+    view = await rq.get_task_view(task_id, project_id, user_id)
+    if view is None:
+        await task_input_not_found(message, state, data["message_id"])
+        return
+    await show_menu(
+        message,
+        data["message_id"],
+        task_text(view, position),
+        reply_markup=await kb.manage_task(project_id, task_id, position, view.version),
+    )
     await state.clear()
 
 
-@router.callback_query(F.data.startswith("change_task_"))
-async def change_task(callback: CallbackQuery):
+@callbacks.on(Action.CHANGE_TASK)
+async def change_task(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Change task"""
-    project_id = callback.data.split("_")[2]
-    task_id = callback.data.split("_")[3]
-    position = callback.data.split("_")[4]
-    await callback.answer("Изменение задачи")
+    effects.spawn(callback.answer("Изменение задачи"))
     await callback.message.edit_reply_markup(
         reply_markup=await kb.change_task_kb(
-            callback.from_user.id, project_id, task_id, position
+            payload.project_id, payload.task_id, payload.position
         )
     )
 
 
-@router.callback_query(F.data.startswith("delete_task_"))
-async def delete_task(callback: CallbackQuery):
+@callbacks.on(Action.DELETE_TASK)
+async def delete_task(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Delete task"""
-    project_id = callback.data.split("_")[2]
-    task_id = callback.data.split("_")[3]
-    position = callback.data.split("_")[4]
-    await callback.answer("Удаление задачи")
-    await rq.delete_task(task_id, project_id, callback.from_user.id)
-    project_name = await rq.get_project_name(project_id, callback.from_user.id)
-    if position == "general":
+    project_id = payload.project_id
+    effects.spawn(callback.answer("Удаление задачи"))
+    await rq.delete_task(payload.task_id, project_id, callback.from_user.id)
+    if payload.position == Position.GENERAL:
         text = "Cписок общих задач"
         keyboard = await kb.general_tasks(project_id, callback.from_user.id)
     else:
-        keyboard = await kb.project_tasks(project_id, callback.from_user.id)
+        project_name, keyboard = await gather(
+            rq.get_project_name(project_id, callback.from_user.id),
+            kb.project_tasks(project_id, callback.from_user.id),
+        )
         text = f'Список задач проекта "{project_name}"'
     await callback.message.edit_text(text=text, reply_markup=keyboard)
 
 
-@router.callback_query(F.data.startswith("rename_task_"))
-async def rename_task(callback: CallbackQuery, state: FSMContext):
+@callbacks.on(Action.RENAME_TASK)
+async def rename_task(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Rename task: asking for new task name"""
-    project_id = callback.data.split("_")[2]
-    task_id = callback.data.split("_")[3]
-    position = callback.data.split("_")[4]
-    await callback.answer("Переименование задачи")
+    effects.spawn(callback.answer("Переименование задачи"))
     await state.set_state(States.waiting_for_new_task_name)
     await state.update_data(
         {
-            "project_id": project_id,
-            "task_id": task_id,
-            "position": position,
+            "project_id": payload.project_id,
+            "task_id": payload.task_id,
+            "position": payload.position.value,
             "message_id": callback.message.message_id,
         }
     )
     await callback.message.edit_text(
         "Введите новое название задачи",
-        reply_markup=await kb.cancel_renaming_task(project_id, task_id, position),
+        reply_markup=await kb.cancel_renaming_task(
+            payload.project_id, payload.task_id, payload.position
+        ),
     )
 
 
@@ -297,141 +813,274 @@ async def rename_task(callback: CallbackQuery, state: FSMContext):
 async def rename_task_name(message: Message, state: FSMContext):
     """Rename task: receiving new task name"""
     data = await state.get_data()
-    position = data["position"]
-    await rq.rename_task(
+    position = Position(data["position"])
+    renamed = await rq.rename_task(
         data["task_id"], data["project_id"], message.from_user.id, message.text
     )
-    if position == "general":
-        await message.delete()
-        await message.bot.delete_message(message.chat.id, message_id=data["message_id"])
-        await message.answer(
-            f'Список общих задач\n\nЗадача "{message.text}" переименована',
+    if renamed:
+        result = f'Задача "{message.text}" переименована'
+    else:
+        result = f'Ошибка: Задача "{message.text}" уже существует'
+    effects.delete(message)
+    if position == Position.GENERAL:
+        await show_menu(
+            message,
+            data["message_id"],
+            f"Список общих задач\n\n{result}",
             reply_markup=await kb.general_tasks(
                 data["project_id"], message.from_user.id
             ),
         )
     else:
-        project_name = await rq.get_project_name(
-            data["project_id"], message.from_user.id
+        text, keyboard = await task_list(
+            data["project_id"], message.from_user.id, Position.LIST
         )
-        await message.delete()
-        await message.bot.delete_message(message.chat.id, message_id=data["message_id"])
-        await message.answer(
-            f'Список задач проекта "{project_name}"\n\nЗадача "{message.text}" переименована',
-            reply_markup=await kb.project_tasks(
-                data["project_id"], message.from_user.id
-            ),
+        await show_menu(
+            message, data["message_id"], f"{text}\n\n{result}", reply_markup=keyboard
         )
     await state.clear()
 
 
-@router.callback_query(F.data.startswith("cancelRenamingTask_"))
-async def cancel_renaming_task(callback: CallbackQuery, state: FSMContext):
+@callbacks.on(Action.CANCEL_RENAME_TASK)
+async def cancel_renaming_task(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Cancel renaming task"""
     await state.clear()
-    project_id = callback.data.split("_")[1]
-    task_id = callback.data.split("_")[2]
-    position = callback.data.split("_")[3]
-    task_name = await rq.get_task_name(task_id, project_id, callback.from_user.id)
-    task_emoji = await rq.get_task_emoji(task_id, project_id, callback.from_user.id)
-    comment = await rq.get_task_comment(task_id, project_id, callback.from_user.id)
-    if not comment:
-        comment = "Комментарий пока не добавлен"
-    await callback.answer("Отмена")
-    if position == "general":
-        await callback.message.edit_text(
-            f'Вы выбрали задачу "{task_emoji} {task_name}" в общих задачах\n\nКомментарий: "{comment}"',
-            reply_markup=await kb.manage_task(
-                project_id, task_id, "list_general_tasks", "general"
-            ),
-        )
-    else:
-        project_name = await rq.get_project_name(project_id, callback.from_user.id)
-        await callback.message.edit_text(
-            f'Вы выбрали задачу "{task_emoji} {task_name}" в проекте "{project_name}"\n\nКомментарий: "{comment}"',
-            reply_markup=await kb.manage_task(
-                project_id, task_id, "list_tasks_" + project_id, "list"
-            ),
-        )
+    position = task_position(payload.position)
+    view = await rq.get_task_view(
+        payload.task_id, payload.project_id, callback.from_user.id
+    )
+    if view is None:
+        await task_not_found(callback, state)
+        return
+    effects.spawn(callback.answer("Отмена"))
+    await callback.message.edit_text(
+        task_text(view, position),
+        reply_markup=await kb.manage_task(
+            payload.project_id, payload.task_id, position, view.version
+        ),
+    )
 
 
-@router.callback_query(F.data == "list_general_tasks")
-async def list_general_tasks(callback: CallbackQuery):
-    """List all general tasks"""
-    await callback.answer("Список общих задач")
+@callbacks.on(Action.GENERAL_TASKS)
+async def list_general_tasks(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """List a page of general tasks"""
+    effects.spawn(callback.answer("Список общих задач"))
     general_project_id = await rq.get_general_project_id(callback.from_user.id)
     await callback.message.edit_text(
         "Список общих задач",
-        reply_markup=await kb.general_tasks(general_project_id, callback.from_user.id),
+        reply_markup=await kb.general_tasks(
+            general_project_id, callback.from_user.id, payload.after, payload.before
+        ),
     )
 
 
-@router.callback_query(F.data.startswith("list_tasks_"))
-async def list_tasks(callback: CallbackQuery):
-    """List all tasks"""
-    project_id = callback.data.split("_")[2]
-    project_name = await rq.get_project_name(project_id, callback.from_user.id)
-    await callback.answer("Список задач")
+@callbacks.on(Action.PROJECT_TASKS)
+async def list_tasks(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """List a page of project tasks"""
+    effects.spawn(callback.answer("Список задач"))
+    project_name, keyboard = await gather(
+        rq.get_project_name(payload.project_id, callback.from_user.id),
+        kb.project_tasks(
+            payload.project_id, callback.from_user.id, payload.after, payload.before
+        ),
+    )
     await callback.message.edit_text(
-        f'Список задач проекта "{project_name}"',
-        reply_markup=await kb.project_tasks(project_id, callback.from_user.id),
+        f'Список задач проекта "{project_name}"', reply_markup=keyboard
     )
 
 
-@router.callback_query(F.data.startswith("status_"))
-async def status(callback: CallbackQuery):
+@callbacks.on(Action.TASK_STATUS)
+async def status(callback: CallbackQuery, payload: CallbackPayload, state: FSMContext):
     """Change task status"""
-    callback_data_list = callback.data.split("_")
-    new_status = callback_data_list[1]
-    project_id = callback_data_list[2]
-    task_id = callback_data_list[3]
-    position = callback_data_list[4]
-    task_name = await rq.get_task_name(task_id, project_id, callback.from_user.id)
-    project_name = await rq.get_project_name(project_id, callback.from_user.id)
-    comment = await rq.get_task_comment(task_id, project_id, callback.from_user.id)
-    if not comment:
-        comment = "Комментарий пока не добавлен"
-    await callback.answer("Статус задачи изменен")
-    if new_status == "NOTSTARTED":
-        await rq.change_task_status_to_notstarted(
-            task_id, project_id, callback.from_user.id, new_status
-        )
-    if new_status == "INPROGRESS":
-        await rq.change_task_status_to_inprogress(
-            task_id, project_id, callback.from_user.id, new_status
-        )
-    if new_status == "COMPLETED":
-        await rq.change_task_status_to_completed(
-            task_id, project_id, callback.from_user.id, new_status
-        )
-    task_emoji = await rq.get_task_emoji(task_id, project_id, callback.from_user.id)
-    if position == "general":
-        await callback.message.edit_text(
-            f'Вы выбрали задачу "{task_emoji} {task_name}" в общих задачах\n\nКомментарий: "{comment}"',
-            reply_markup=await kb.manage_task(
-                project_id, task_id, "list_general_tasks", "general"
-            ),
-        )
+    user_id = callback.from_user.id
+    project_id = payload.project_id
+    task_id = payload.task_id
+    position = task_position(payload.position)
+    view = await rq.change_task_status(
+        task_id, project_id, user_id, payload.status, payload.version
+    )
+    if view is None:
+        # Nothing changed, find out why
+        view = await rq.get_task_view(task_id, project_id, user_id)
+        if view is None:
+            effects.spawn(callback.answer("Задача уже удалена"))
+            text, reply_markup = await task_list(project_id, user_id, position)
+            await callback.message.edit_text(text, reply_markup=reply_markup)
+            return
+        if not answer_unchanged_status(callback, payload, view):
+            return
     else:
-        await callback.message.edit_text(
-            f'Вы выбрали задачу "{task_emoji} {task_name}" в проекте "{project_name}"\n\nКомментарий: "{comment}"',
-            reply_markup=await kb.manage_task(
-                project_id, task_id, f"list_tasks_{project_id}", "list"
-            ),
-        )
+        effects.spawn(callback.answer("Статус задачи изменен"))
+    await callback.message.edit_text(
+        task_text(view, position),
+        reply_markup=await kb.manage_task(project_id, task_id, position, view.version),
+    )
+
+
+# Multi-select mode of the task lists
+async def get_selection(state: FSMContext, project_id):
+    """Returns the IDs of the selected tasks, starting a new selection if there is none"""
+    data = await state.get_data()
+    if (
+        await state.get_state() == States.selecting_tasks.state
+        and data.get("project_id") == project_id
+    ):
+        return set(data["selected"])
+    await state.set_state(States.selecting_tasks)
+    await state.set_data({"project_id": project_id, "selected": []})
+    return set()
+
+
+async def show_selection(callback: CallbackQuery, payload: CallbackPayload, selected):
+    """Shows a page of tasks with checkboxes"""
+    await callback.message.edit_text(
+        f"Выберите задачи\n\nВыбрано: {len(selected)}",
+        reply_markup=await kb.select_tasks(
+            payload.project_id,
+            callback.from_user.id,
+            selected,
+            task_position(payload.position),
+            payload.after,
+            payload.before,
+        ),
+    )
+
+
+async def finish_selection(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext, result
+):
+    """Leaves the multi-select mode and shows the task list with the result"""
+    await state.clear()
+    text, keyboard = await task_list(
+        payload.project_id, callback.from_user.id, task_position(payload.position)
+    )
+    await callback.message.edit_text(f"{text}\n\n{result}", reply_markup=keyboard)
+
+
+@callbacks.on(Action.SELECT_TASKS)
+async def select_tasks(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Multi-select mode: showing a page of tasks to select"""
+    selected = await get_selection(state, payload.project_id)
+    effects.spawn(callback.answer("Выбор задач"))
+    await show_selection(callback, payload, selected)
+
+
+@callbacks.on(Action.TOGGLE_TASK)
+async def toggle_task(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Multi-select mode: selecting or unselecting a task"""
+    selected = await get_selection(state, payload.project_id)
+    selected ^= {payload.task_id}
+    await state.update_data(selected=sorted(selected))
+    effects.spawn(callback.answer())
+    await show_selection(callback, payload, selected)
+
+
+@callbacks.on(Action.BULK_STATUS)
+async def bulk_status(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Multi-select mode: changing the status of the selected tasks"""
+    selected = await get_selection(state, payload.project_id)
+    if not selected:
+        effects.spawn(callback.answer("Задачи не выбраны"))
+        return
+    changed = await rq.change_tasks_status(
+        list(selected), payload.project_id, callback.from_user.id, payload.status
+    )
+    effects.spawn(callback.answer("Статус задач изменен"))
+    await finish_selection(
+        callback, payload, state, f"Статус изменен у задач: {changed}"
+    )
+
+
+@callbacks.on(Action.BULK_DELETE)
+async def bulk_delete(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Multi-select mode: deleting the selected tasks"""
+    selected = await get_selection(state, payload.project_id)
+    if not selected:
+        effects.spawn(callback.answer("Задачи не выбраны"))
+        return
+    deleted = await rq.delete_tasks(
+        list(selected), payload.project_id, callback.from_user.id
+    )
+    effects.spawn(callback.answer("Удаление задач"))
+    await finish_selection(callback, payload, state, f"Удалено задач: {deleted}")
+
+
+@callbacks.on(Action.BULK_MOVE)
+async def bulk_move(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Multi-select mode: asking for the project to move the selected tasks to"""
+    selected = await get_selection(state, payload.project_id)
+    if not selected:
+        effects.spawn(callback.answer("Задачи не выбраны"))
+        return
+    effects.spawn(callback.answer("Перемещение задач"))
+    await callback.message.edit_text(
+        f"Выберите проект, в который переместить задачи ({len(selected)})",
+        reply_markup=await kb.move_targets(
+            payload.project_id,
+            callback.from_user.id,
+            task_position(payload.position),
+            payload.after,
+            payload.before,
+        ),
+    )
+
+
+@callbacks.on(Action.BULK_MOVE_TO)
+async def bulk_move_to(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Multi-select mode: moving the selected tasks to the chosen project"""
+    selected = await get_selection(state, payload.project_id)
+    if not selected:
+        effects.spawn(callback.answer("Задачи не выбраны"))
+        return
+    moved = await rq.move_tasks(
+        list(selected), payload.project_id, payload.target_id, callback.from_user.id
+    )
+    result = f"Перемещено задач: {moved} из {len(selected)}"
+    if moved < len(selected):
+        result += "\nЗадачи с такими же названиями уже есть в выбранном проекте"
+    effects.spawn(callback.answer("Задачи перемещены"))
+    await finish_selection(callback, payload, state, result)
+
+
+@callbacks.on(Action.CANCEL_SELECT)
+async def cancel_selection(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """Leave the multi-select mode"""
+    effects.spawn(callback.answer("Отмена"))
+    await finish_selection(callback, payload, state, "Выбор задач отменен")
 
 
 # Handling messages related to PROJECTS
-@router.callback_query(F.data.startswith("new_project_"))
-async def new_project(callback: CallbackQuery, state: FSMContext):
+@callbacks.on(Action.NEW_PROJECT)
+async def new_project(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Create a new project: asking for project name"""
-    await callback.answer("Создание нового проекта")
+    effects.spawn(callback.answer("Создание нового проекта"))
     await state.set_state(States.waiting_for_project_name)
     await state.update_data(message_id=callback.message.message_id)
-    position = callback.data.split("_")[-1]
     await callback.message.edit_text(
         "Введите название проекта",
-        reply_markup=await kb.cancel(callback.from_user.id, None, position),
+        reply_markup=await kb.cancel(None, payload.position),
     )
 
 
@@ -440,78 +1089,89 @@ async def create_new_project(message: Message, state: FSMContext):
     """Create a new project: receiving project name"""
     data = await state.get_data()
     project_name = message.text
+    effects.delete(message)
     if project_name == "General":
         await state.clear()
-        await message.delete()
-        await message.bot.delete_message(message.chat.id, message_id=data["message_id"])
-        await message.answer(
+        await show_menu(
+            message,
+            data["message_id"],
             "Cписок проектов\n\nОшибка: Нельзя использовать название 'General'",
             reply_markup=await kb.projects(message.from_user.id),
         )
     else:
         await rq.add_project(message.from_user.id, message.text)
         await state.clear()
-        await message.delete()
-        await message.bot.delete_message(message.chat.id, message_id=data["message_id"])
-        await message.answer(
+        await show_menu(
+            message,
+            data["message_id"],
             f'Проект "{project_name}" создан',
             reply_markup=await kb.projects(message.from_user.id),
         )
 
 
-@router.callback_query(F.data == "list_projects")
-async def list_projects(callback: CallbackQuery):
-    """List all projects"""
-    await callback.answer("Список проектов")
+@callbacks.on(Action.PROJECTS)
+async def list_projects(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
+    """List a page of projects"""
+    effects.spawn(callback.answer("Список проектов"))
     await callback.message.edit_text(
-        "Список проектов", reply_markup=await kb.projects(callback.from_user.id)
+        "Список проектов",
+        reply_markup=await kb.projects(
+            callback.from_user.id, payload.after, payload.before
+        ),
     )
 
 
-@router.callback_query(F.data.startswith("project_"))
-async def manage_project(callback: CallbackQuery):
+@callbacks.on(Action.PROJECT)
+async def manage_project(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Manage a project"""
-    project_id = callback.data.split("_")[2]
-    project_name = await rq.get_project_name(project_id, callback.from_user.id)
-    await callback.answer(f'Вы выбрали проект "{project_name}"')
+    project_name = await rq.get_project_name(payload.project_id, callback.from_user.id)
+    effects.spawn(callback.answer(f'Вы выбрали проект "{project_name}"'))
     await callback.message.edit_text(
-        f"Проект: {project_name}", reply_markup=await kb.manage_project(project_id)
+        f"Проект: {project_name}",
+        reply_markup=await kb.manage_project(payload.project_id),
     )
 
 
-@router.callback_query(F.data.startswith("change_project_"))
-async def change_project(callback: CallbackQuery):
+@callbacks.on(Action.CHANGE_PROJECT)
+async def change_project(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Change project"""
-    project_id = callback.data.split("_")[2]
-    await callback.answer("Изменение проекта")
+    effects.spawn(callback.answer("Изменение проекта"))
     await callback.message.edit_reply_markup(
-        reply_markup=await kb.change_project_kb(project_id, callback.from_user.id)
+        reply_markup=await kb.change_project_kb(payload.project_id)
     )
 
 
-@router.callback_query(F.data.startswith("delete_project_"))
-async def delete_project(callback: CallbackQuery):
+@callbacks.on(Action.DELETE_PROJECT)
+async def delete_project(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Delete project"""
-    project_id = callback.data.split("_")[2]
-    await callback.answer("Удаление проекта")
-    await rq.delete_project(project_id, callback.from_user.id)
+    effects.spawn(callback.answer("Удаление проекта"))
+    await rq.delete_project(payload.project_id, callback.from_user.id)
     await callback.message.edit_text(
         "Список проектов", reply_markup=await kb.projects(callback.from_user.id)
     )
 
 
-@router.callback_query(F.data.startswith("rename_project_"))
-async def rename_project(callback: CallbackQuery, state: FSMContext):
+@callbacks.on(Action.RENAME_PROJECT)
+async def rename_project(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Rename project: asking for new project name"""
-    project_id = callback.data.split("_")[2]
-    await callback.answer("Переименование проекта")
+    effects.spawn(callback.answer("Переименование проекта"))
     await state.set_state(States.waiting_for_new_project_name)
     await state.update_data(
-        project_id=project_id, message_id=callback.message.message_id
+        project_id=payload.project_id, message_id=callback.message.message_id
     )
     await callback.message.edit_text(
         "Введите новое название проекта",
-        reply_markup=await kb.cancel_renaming_project(project_id),
+        reply_markup=await kb.cancel_renaming_project(payload.project_id),
     )
 
 
@@ -519,39 +1179,47 @@ async def rename_project(callback: CallbackQuery, state: FSMContext):
 async def rename_project_name(message: Message, state: FSMContext):
     """Rename project: receiving new project name"""
     data = await state.get_data()
-    await rq.rename_project(data["project_id"], message.from_user.id, message.text)
-    await message.delete()
-    await message.bot.delete_message(message.chat.id, message_id=data["message_id"])
-    await message.answer(
-        f'Проект "{message.text}" переименован',
+    renamed = await rq.rename_project(
+        data["project_id"], message.from_user.id, message.text
+    )
+    effects.delete(message)
+    if renamed:
+        result = f'Проект "{message.text}" переименован'
+    else:
+        result = f'Cписок проектов\n\nОшибка: Проект "{message.text}" уже существует'
+    await show_menu(
+        message,
+        data["message_id"],
+        result,
         reply_markup=await kb.projects(message.from_user.id),
     )
     await state.clear()
 
 
-@router.callback_query(F.data.startswith("cancelRenamingProject_"))
-async def cancel_renaming_project(callback: CallbackQuery):
+@callbacks.on(Action.CANCEL_RENAME_PROJECT)
+async def cancel_renaming_project(
+    callback: CallbackQuery, payload: CallbackPayload, state: FSMContext
+):
     """Cancel renaming project"""
-    project_id = callback.data.split("_")[1]
-    project_name = await rq.get_project_name(project_id, callback.from_user.id)
-    await callback.answer("Отмена")
+    project_name = await rq.get_project_name(payload.project_id, callback.from_user.id)
+    effects.spawn(callback.answer("Отмена"))
     await callback.message.edit_text(
         f'Вы выбрали проект "{project_name}"',
-        reply_markup=await kb.manage_project(project_id),
+        reply_markup=await kb.manage_project(payload.project_id),
     )
 
 
-@router.callback_query(F.data.startswith("cancel_"))
-async def cancel(callback: CallbackQuery):
+@callbacks.on(Action.CANCEL)
+async def cancel(callback: CallbackQuery, payload: CallbackPayload, state: FSMContext):
     """Cancel"""
-    cancel_callback = callback.data.split("_")
-    user_id = cancel_callback[1]
-    project_callback = cancel_callback[2]
-    position = cancel_callback[3]
-    await callback.answer("Отмена")
-
-    if project_callback == "none":
-        if position == "list":
+    await state.clear()
+    user_id = callback.from_user.id
+    project_id = payload.project_id
+    position = payload.position
+    effects.spawn(callback.answer("Отмена"))
+
+    if project_id is None:
+        if position == Position.LIST:
             await callback.message.edit_text(
                 "Список проектов", reply_markup=await kb.projects(user_id)
             )
@@ -560,33 +1228,25 @@ async def cancel(callback: CallbackQuery):
                 "Главное меню", reply_markup=await kb.starting_kb(user_id)
             )
     else:
-        if position == "general":
+        if position == Position.GENERAL:
             await callback.message.edit_text(
                 "Главное меню", reply_markup=await kb.starting_kb(user_id)
             )
-        elif position == "list":
-            project_name = await rq.get_project_name(project_callback, user_id)
-            await callback.message.edit_text(
-                f'Список задач проекта "{project_name}"',
-                reply_markup=await kb.project_tasks(project_callback, user_id),
-            )
-        elif position == "project":
-            project_name = await rq.get_project_name(project_callback, user_id)
+        elif position == Position.LIST:
+            text, keyboard = await task_list(project_id, user_id, position)
+            await callback.message.edit_text(text, reply_markup=keyboard)
+        elif position == Position.PROJECT:
+            project_name = await rq.get_project_name(project_id, user_id)
             await callback.message.edit_text(
                 f'Вы выбрали проект "{project_name}"',
-                reply_markup=await kb.manage_project(project_callback),
-            )
-        else:
-            await callback.message.edit_text(
-                "Список общих задач",
-                reply_markup=await kb.general_tasks(project_callback, user_id),
+                reply_markup=await kb.manage_project(project_id),
             )
 
 
-@router.callback_query(F.data == "to_start_kb")
-async def go_back(callback: CallbackQuery):
+@callbacks.on(Action.MAIN_MENU)
+async def go_back(callback: CallbackQuery, payload: CallbackPayload, state: FSMContext):
     """Go back to the main menu"""
-    await callback.answer("Возвращаю в главное меню")
+    effects.spawn(callback.answer("Возвращаю в главное меню"))
     await callback.message.edit_text(
         "Главное меню", reply_markup=await kb.starting_kb(callback.from_user.id)
     )
@@ -601,4 +1261,4 @@ async def go_back(callback: CallbackQuery):
 )
 async def filter_trash_text(message: Message):
     """Filter trash messages"""
-    await message.delete()
+    effects.delete(message)
@@ -6,70 +6,95 @@ from aiogram.types import (
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from app.callbacks import Action, Position, pack
+from app.database.cache import keyboards
+from app.database.models import STATUS_EMOJI, TaskStatus
 from app.database.requests import (
     get_projects,
     get_project_tasks,
     get_general_project_id,
-    get_task_emoji,
+    search_tasks,
 )
 
 
+PAGE_SIZE = 10
+
+
 # General keyboard
 async def starting_kb(user_id):
     """
     Asynchronously creates an inline keyboard markup with buttons to create a new task,
-    a new project, or list general tasks or projects. The callback data for each button is
-    dynamically generated using the provided user_id.
+    a new project, or list general tasks or projects. The new task button creates
+    a task in the "General" project of the user with the provided user_id.
+    The keyboard is cached until the projects of the user change.
     """
-    project_id = await get_general_project_id(user_id)
-    start_kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="📝Новая задача",
-                    callback_data=f"new_task_{project_id}_general",
-                ),
-                InlineKeyboardButton(
-                    text="📚Новый проект", callback_data="new_project_general"
-                ),
-            ],
-            [
-                InlineKeyboardButton(
-                    text="✅Список общих задач", callback_data="list_general_tasks"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    text="☑️Список проектов", callback_data="list_projects"
-                )
+
+    async def _build():
+        project_id = await get_general_project_id(user_id)
+        start_kb = InlineKeyboardMarkup(
+            inline_keyboard=[
+                [
+                    InlineKeyboardButton(
+                        text="📝Новая задача",
+                        callback_data=pack(
+                            Action.NEW_TASK,
+                            project_id=project_id,
+                            position=Position.GENERAL,
+                        ),
+                    ),
+                    InlineKeyboardButton(
+                        text="📚Новый проект",
+                        callback_data=pack(
+                            Action.NEW_PROJECT, position=Position.GENERAL
+                        ),
+                    ),
+                ],
+                [
+                    InlineKeyboardButton(
+                        text="✅Список общих задач",
+                        callback_data=pack(Action.GENERAL_TASKS),
+                    )
+                ],
+                [
+                    InlineKeyboardButton(
+                        text="☑️Список проектов", callback_data=pack(Action.PROJECTS)
+                    )
+                ],
+                [
+                    InlineKeyboardButton(
+                        text="🔍Поиск задач", callback_data=pack(Action.SEARCH)
+                    )
+                ],
             ],
-        ],
-    )
-    return start_kb
+        )
+        return start_kb
+
+    return await keyboards.get((user_id, "start"), user_id, None, _build)
 
 
-async def change_task_kb(user_id, project_id, task_id, position):
+async def change_task_kb(project_id, task_id, position):
     """
     Asynchronously creates an inline keyboard markup with buttons to rename or delete a task,
     and a back button. The callback data for each button is dynamically generated using the
-    provided project_id.
+    provided project_id, task_id and position.
     """
+    task = {"project_id": project_id, "task_id": task_id, "position": position}
     change_t_kb = InlineKeyboardMarkup(
         inline_keyboard=[
             [
                 InlineKeyboardButton(
                     text="📝Переименовать задачу",
-                    callback_data=f"rename_task_{project_id}_{task_id}_{position}",
+                    callback_data=pack(Action.RENAME_TASK, **task),
                 ),
                 InlineKeyboardButton(
                     text="❌Удалить",
-                    callback_data=f"delete_task_{project_id}_{task_id}_{position}",
+                    callback_data=pack(Action.DELETE_TASK, **task),
                 ),
             ],
             [
                 InlineKeyboardButton(
                     text="🔙Назад",
-                    callback_data=f"task_{user_id}_{project_id}_{task_id}_{position}",
+                    callback_data=pack(Action.TASK, **task),
                 )
             ],
         ],
@@ -78,27 +103,28 @@ async def change_task_kb(user_id, project_id, task_id, position):
     return change_t_kb
 
 
-async def change_project_kb(project_id, user_id):
+async def change_project_kb(project_id):
     """
     Asynchronously creates an inline keyboard markup with buttons to rename or delete a project,
     and a back button. The callback data for each button is dynamically generated using the
-    provided project_id and user_id.
+    provided project_id.
     """
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [
                 InlineKeyboardButton(
                     text="📝Переименовать проект",
-                    callback_data=f"rename_project_{project_id}",
+                    callback_data=pack(Action.RENAME_PROJECT, project_id=project_id),
                 ),
                 InlineKeyboardButton(
                     text="❌Удалить",
-                    callback_data=f"delete_project_{project_id}",
+                    callback_data=pack(Action.DELETE_PROJECT, project_id=project_id),
                 ),
             ],
             [
                 InlineKeyboardButton(
-                    text="🔙Назад", callback_data=f"project_{user_id}_{project_id}"
+                    text="🔙Назад",
+                    callback_data=pack(Action.PROJECT, project_id=project_id),
                 )
             ],
         ],
@@ -107,35 +133,56 @@ async def change_project_kb(project_id, user_id):
 
 
 # Keyboards to interact with tasks
-async def manage_task(project_id, task_id, back_callback_data, position):
+async def manage_task(project_id, task_id, position, version=None):
     """
     Asynchronously creates an inline keyboard markup for managing a task.
+    The back button leads to the task list the task was opened from.
+    The status buttons carry the version of the task shown, so taps on an outdated
+    screen are detected.
     """
+    task = {"project_id": project_id, "task_id": task_id, "position": position}
+    status = {"version": version, **task}
+    if position == Position.GENERAL:
+        back_callback_data = pack(Action.GENERAL_TASKS)
+    else:
+        back_callback_data = pack(Action.PROJECT_TASKS, project_id=project_id)
 
     task_kb = InlineKeyboardMarkup(
         inline_keyboard=[
             [
                 InlineKeyboardButton(
                     text="🟣Не начата",
-                    callback_data=f"status_NOTSTARTED_{project_id}_{task_id}_{position}",
+                    callback_data=pack(
+                        Action.TASK_STATUS, status=TaskStatus.NOTSTARTED, **status
+                    ),
                 ),
                 InlineKeyboardButton(
                     text="🔵В процессе",
-                    callback_data=f"status_INPROGRESS_{project_id}_{task_id}_{position}",
+                    callback_data=pack(
+                        Action.TASK_STATUS, status=TaskStatus.INPROGRESS, **status
+                    ),
                 ),
                 InlineKeyboardButton(
                     text="🟢Завершена",
-                    callback_data=f"status_COMPLETED_{project_id}_{task_id}_{position}",
+                    callback_data=pack(
+                        Action.TASK_STATUS, status=TaskStatus.COMPLETED, **status
+                    ),
                 ),
             ],
             [
                 InlineKeyboardButton(
                     text="✏️Изменить задачу",
-                    callback_data=f"change_task_{project_id}_{task_id}_{position}",
+                    callback_data=pack(Action.CHANGE_TASK, **task),
                 ),
                 InlineKeyboardButton(
                     text="📖Изменить комментарий",
-                    callback_data=f"add_comment_{project_id}_{task_id}_{position}",
+                    callback_data=pack(Action.ADD_COMMENT, **task),
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    text="⏰Срок задачи",
+                    callback_data=pack(Action.DUE_DATE, **task),
                 ),
             ],
             [InlineKeyboardButton(text="🔙Назад", callback_data=back_callback_data)],
@@ -154,132 +201,303 @@ async def manage_project(project_id):
             [
                 InlineKeyboardButton(
                     text="📃Перейти к списку задач",
-                    callback_data=f"list_tasks_{project_id}",
+                    callback_data=pack(Action.PROJECT_TASKS, project_id=project_id),
                 )
             ],
             [
                 InlineKeyboardButton(
                     text="✏️Изменить проект",
-                    callback_data=f"change_project_{project_id}",
+                    callback_data=pack(Action.CHANGE_PROJECT, project_id=project_id),
                 ),
                 InlineKeyboardButton(
                     text="➕Новая задача",
-                    callback_data=f"new_task_{project_id}_project",
+                    callback_data=pack(
+                        Action.NEW_TASK,
+                        project_id=project_id,
+                        position=Position.PROJECT,
+                    ),
                 ),
             ],
-            [InlineKeyboardButton(text="🔙Назад", callback_data="list_projects")],
+            [
+                InlineKeyboardButton(
+                    text="🔙Назад", callback_data=pack(Action.PROJECTS)
+                )
+            ],
         ],
     )
     return project_kb
 
 
-async def projects(user_id):
+def _paginate(rows, after, before):
     """
-    Asynchronously retrieves all projects associated with the given user ID,
-    creates an inline keyboard with the project names and a back button,
-    and returns the keyboard markup.
+    Trims a page fetched with one extra row and works out
+    whether there are previous and next pages.
     """
-    all_projects = await get_projects(user_id)
-    keyboard = InlineKeyboardBuilder()
-    for project in all_projects:
-        if project.name != "General":
+    has_more = len(rows) > PAGE_SIZE
+    if before is not None:
+        return rows[-PAGE_SIZE:], has_more, True
+    return rows[:PAGE_SIZE], after is not None, has_more
+
+
+def _page_buttons(rows, has_prev, has_next, action, **values):
+    """Creates previous/next page buttons for a paginated list"""
+    buttons = []
+    if rows and has_prev:
+        buttons.append(
+            InlineKeyboardButton(
+                text="⬅️", callback_data=pack(action, before=rows[0].id, **values)
+            )
+        )
+    if rows and has_next:
+        buttons.append(
+            InlineKeyboardButton(
+                text="➡️", callback_data=pack(action, after=rows[-1].id, **values)
+            )
+        )
+    return buttons
+
+
+def project_text(project):
+    """Name of a project with the number of completed tasks, read from its counters"""
+    if not project.tasks_total:
+        return project.name
+    return f"{project.name} {project.tasks_completed}/{project.tasks_total} ✅"
+
+
+async def projects(user_id, after=None, before=None):
+    """
+    Asynchronously retrieves a page of projects associated with the given user ID,
+    creates an inline keyboard with the project names and progress ("Website 12/30 ✅"),
+    page navigation and a back button, and returns the keyboard markup.
+    The keyboard is cached until the projects of the user change.
+    """
+
+    async def _build():
+        page = await get_projects(user_id, after, before, PAGE_SIZE + 1)
+        page, has_prev, has_next = _paginate(page, after, before)
+        keyboard = InlineKeyboardBuilder()
+        for project in page:
+            keyboard.add(
+                InlineKeyboardButton(
+                    text=project_text(project),
+                    callback_data=pack(Action.PROJECT, project_id=project.id),
+                )
+            )
+        keyboard.adjust(1)
+        keyboard.row(*_page_buttons(page, has_prev, has_next, Action.PROJECTS))
+        keyboard.row(
+            InlineKeyboardButton(
+                text="➕Новый проект",
+                callback_data=pack(Action.NEW_PROJECT, position=Position.LIST),
+            )
+        )
+        keyboard.row(
+            InlineKeyboardButton(text="🔙Назад", callback_data=pack(Action.MAIN_MENU))
+        )
+        return keyboard.as_markup()
+
+    key = (user_id, "projects", None, after, before)
+    return await keyboards.get(key, user_id, None, _build)
+
+
+async def project_tasks(
+    project_id, user_id, after=None, before=None, position=Position.LIST
+):
+    """
+    Asynchronously retrieves a page of tasks associated with the given project ID and user ID,
+    and creates an inline keyboard with the task names, page navigation and a back button.
+    The keyboard is cached until the project or its tasks change.
+    """
+
+    async def _build():
+        page = await get_project_tasks(
+            project_id, user_id, after, before, PAGE_SIZE + 1
+        )
+        page, has_prev, has_next = _paginate(page, after, before)
+        keyboard = InlineKeyboardBuilder()
+        for task in page:
+            keyboard.add(
+                InlineKeyboardButton(
+                    text=f"{task.emoji} {task.name}",
+                    callback_data=pack(
+                        Action.TASK,
+                        project_id=project_id,
+                        task_id=task.id,
+                        position=position,
+                    ),
+                )
+            )
+        keyboard.adjust(1)
+        if position == Position.GENERAL:
+            keyboard.row(*_page_buttons(page, has_prev, has_next, Action.GENERAL_TASKS))
+            back_callback_data = pack(Action.MAIN_MENU)
+        else:
+            keyboard.row(
+                *_page_buttons(
+                    page,
+                    has_prev,
+                    has_next,
+                    Action.PROJECT_TASKS,
+                    project_id=project_id,
+                )
+            )
+            back_callback_data = pack(Action.PROJECT, project_id=project_id)
+        keyboard.row(
+            InlineKeyboardButton(
+                text="➕Новая задача",
+                callback_data=pack(
+                    Action.NEW_TASK, project_id=project_id, position=position
+                ),
+            )
+        )
+        if page:
             keyboard.add(
                 InlineKeyboardButton(
-                    text=project.name, callback_data=f"project_{user_id}_{project.id}"
+                    text="☑️Выбрать",
+                    callback_data=pack(
+                        Action.SELECT_TASKS,
+                        project_id=project_id,
+                        position=position,
+                        after=after,
+                        before=before,
+                    ),
                 )
             )
-    keyboard.add(
-        InlineKeyboardButton(text="➕Новый проект", callback_data="new_project_list")
+        keyboard.row(
+            InlineKeyboardButton(text="🔙Назад", callback_data=back_callback_data)
+        )
+        return keyboard.as_markup()
+
+    key = (user_id, position.value, project_id, after, before)
+    return await keyboards.get(key, user_id, project_id, _build)
+
+
+async def general_tasks(project_id, user_id, after=None, before=None):
+    """
+    Asynchronously creates the task list keyboard of the "General" project,
+    which leads back to the main menu instead of the project menu.
+    """
+    return await project_tasks(
+        project_id, user_id, after, before, position=Position.GENERAL
     )
-    keyboard.add(InlineKeyboardButton(text="🔙Назад", callback_data="to_start_kb"))
-    return keyboard.adjust(1).as_markup()
 
 
-async def project_tasks(project_id, user_id):
+async def select_tasks(
+    project_id, user_id, selected, position, after=None, before=None
+):
     """
-    Asynchronously retrieves all tasks associated with the given project ID and user ID,
-    and creates an inline keyboard with the task names and a back button.
+    Asynchronously creates the multi-select keyboard of a page of project tasks:
+    tasks with checkboxes toggling their selection, page navigation,
+    and a bar of actions applied to all selected tasks at once.
     """
-    all_tasks = await get_project_tasks(project_id, user_id)
+    page = await get_project_tasks(project_id, user_id, after, before, PAGE_SIZE + 1)
+    page, has_prev, has_next = _paginate(page, after, before)
+    selection = {"project_id": project_id, "position": position}
     keyboard = InlineKeyboardBuilder()
-    for task in all_tasks:
-        task_emoji = await get_task_emoji(task.id, project_id, user_id)
+    for task in page:
+        checkbox = "✅" if task.id in selected else "⬜"
         keyboard.add(
             InlineKeyboardButton(
-                text=f"{task_emoji} {task.name}",
-                callback_data=f"task_{user_id}_{project_id}_{task.id}_list",
+                text=f"{checkbox} {task.emoji} {task.name}",
+                callback_data=pack(
+                    Action.TOGGLE_TASK,
+                    task_id=task.id,
+                    after=after,
+                    before=before,
+                    **selection,
+                ),
             )
         )
-    keyboard.add(
-        InlineKeyboardButton(
-            text="➕Новая задача", callback_data=f"new_task_{project_id}_list"
+    keyboard.adjust(1)
+    keyboard.row(
+        *_page_buttons(page, has_prev, has_next, Action.SELECT_TASKS, **selection)
+    )
+    keyboard.row(
+        *(
+            InlineKeyboardButton(
+                text=text,
+                callback_data=pack(Action.BULK_STATUS, status=status, **selection),
+            )
+            for text, status in (
+                ("🟣Не начаты", TaskStatus.NOTSTARTED),
+                ("🔵В процессе", TaskStatus.INPROGRESS),
+                ("🟢Завершены", TaskStatus.COMPLETED),
+            )
         )
     )
-    keyboard.add(
+    keyboard.row(
         InlineKeyboardButton(
-            text="🔙Назад", callback_data=f"project_{user_id}_{project_id}"
+            text="📦Переместить", callback_data=pack(Action.BULK_MOVE, **selection)
+        ),
+        InlineKeyboardButton(
+            text="❌Удалить", callback_data=pack(Action.BULK_DELETE, **selection)
+        ),
+    )
+    keyboard.row(
+        InlineKeyboardButton(
+            text="✖️Отмена", callback_data=pack(Action.CANCEL_SELECT, **selection)
         )
     )
-    return keyboard.adjust(1).as_markup()
+    return keyboard.as_markup()
 
 
-async def general_tasks(project_id, user_id):
+async def move_targets(project_id, user_id, position, after=None, before=None):
     """
-    Asynchronously retrieves the project tasks for the given project ID and user ID,
-    modifies the callback data of the "🔙Назад" button to "to_start_kb",
-    and returns the modified keyboard markup.
+    Asynchronously creates a keyboard with a page of the projects
+    the selected tasks of a project can be moved to, the general tasks first.
     """
-    keyboard = await project_tasks(project_id, user_id)
-
-    # Create a new list to store the modified rows
-    new_inline_keyboard = []
-
-    for row in keyboard.inline_keyboard:
-        new_row = []
-        for button in row:
-            # Check if this is the "🔙Назад" button
-            if button.callback_data == f"project_{user_id}_{project_id}":
-                # Replace the callback_data with "to_start_kb"
-                new_button = InlineKeyboardButton(
-                    text=button.text, callback_data="to_start_kb"
-                )
-                new_row.append(new_button)
-            elif button.callback_data == f"new_task_{project_id}_list":
-                new_button = InlineKeyboardButton(
-                    text=button.text, callback_data=f"new_task_{project_id}_general"
-                )
-                new_row.append(new_button)
-            else:
-                new_callback_data = button.callback_data + "_general"
-                new_button = InlineKeyboardButton(
-                    text=button.text, callback_data=new_callback_data
-                )
-                new_row.append(new_button)
-        new_inline_keyboard.append(new_row)
-
-    # Create a new InlineKeyboardMarkup with the modified buttons
-    new_keyboard = InlineKeyboardMarkup(inline_keyboard=new_inline_keyboard)
-    return new_keyboard
+    page = await get_projects(user_id, after, before, PAGE_SIZE + 1)
+    page, has_prev, has_next = _paginate(page, after, before)
+    selection = {"project_id": project_id, "position": position}
+    keyboard = InlineKeyboardBuilder()
+    general_project_id = await get_general_project_id(user_id)
+    if after is None and before is None and general_project_id != project_id:
+        keyboard.add(
+            InlineKeyboardButton(
+                text="Общие задачи",
+                callback_data=pack(
+                    Action.BULK_MOVE_TO, target_id=general_project_id, **selection
+                ),
+            )
+        )
+    for project in page:
+        if project.id == project_id:
+            continue
+        keyboard.add(
+            InlineKeyboardButton(
+                text=project.name,
+                callback_data=pack(
+                    Action.BULK_MOVE_TO, target_id=project.id, **selection
+                ),
+            )
+        )
+    keyboard.adjust(1)
+    keyboard.row(
+        *_page_buttons(page, has_prev, has_next, Action.BULK_MOVE, **selection)
+    )
+    keyboard.row(
+        InlineKeyboardButton(
+            text="🔙Назад", callback_data=pack(Action.SELECT_TASKS, **selection)
+        )
+    )
+    return keyboard.as_markup()
 
 
-async def cancel(user_id, project_id, position):
+async def cancel(project_id, position):
     """
-    Asynchronously creates an inline keyboard markup with a cancel button that has a callback data
-    generated using the provided user_id and project_id. The callback data is in the format
-    "cancel_{user_id}_{project_id}". The keyboard has a single row with a single button. The button
-    text is "✖️Отмена" (which translates to "✖️Cancel" in English).
+    Asynchronously creates an inline keyboard markup with a cancel button that returns
+    to the screen the flow was started from, given by the project_id (None when the flow
+    is not related to a project) and the position. The keyboard has a single row with
+    a single button. The button text is "✖️Отмена" (which translates to "✖️Cancel" in English).
     """
-    if not project_id:
-        project_callback = "none"
-    else:
-        project_callback = f"{project_id}"
-
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
             [
                 InlineKeyboardButton(
                     text="✖️Отмена",
-                    callback_data=f"cancel_{user_id}_{project_callback}_{position}",
+                    callback_data=pack(
+                        Action.CANCEL, project_id=project_id, position=position
+                    ),
                 ),
             ],
         ],
@@ -297,7 +515,12 @@ async def cancel_renaming_task(project_id, task_id, position):
             [
                 InlineKeyboardButton(
                     text="✖️Отмена",
-                    callback_data=f"cancelRenamingTask_{project_id}_{task_id}_{position}",
+                    callback_data=pack(
+                        Action.CANCEL_RENAME_TASK,
+                        project_id=project_id,
+                        task_id=task_id,
+                        position=position,
+                    ),
                 ),
             ],
         ],
@@ -315,7 +538,12 @@ async def cancel_changing_comment(project_id, task_id, position):
             [
                 InlineKeyboardButton(
                     text="✖️Отмена",
-                    callback_data=f"cancelChangingComment_{project_id}_{task_id}_{position}",
+                    callback_data=pack(
+                        Action.CANCEL_COMMENT,
+                        project_id=project_id,
+                        task_id=task_id,
+                        position=position,
+                    ),
                 ),
             ],
         ],
@@ -333,9 +561,83 @@ async def cancel_renaming_project(project_id):
             [
                 InlineKeyboardButton(
                     text="✖️Отмена",
-                    callback_data=f"cancelRenamingProject_{project_id}",
+                    callback_data=pack(
+                        Action.CANCEL_RENAME_PROJECT, project_id=project_id
+                    ),
                 ),
             ],
         ],
     )
     return keyboard
+
+
+async def search_results(user_id, query, page=0):
+    """
+    Asynchronously searches the tasks of the user and creates a keyboard with a page
+    of the results, best matches first, each leading to its task,
+    page navigation, a new search button and a back button.
+
+    Returns:
+        tuple[int, InlineKeyboardMarkup]: The number of results on the page and the keyboard.
+    """
+    results = await search_tasks(user_id, query, PAGE_SIZE + 1, page * PAGE_SIZE)
+    has_next = len(results) > PAGE_SIZE
+    results = results[:PAGE_SIZE]
+    keyboard = InlineKeyboardBuilder()
+    for task in results:
+        general = task.project_name == "General"
+        project_name = "Общие задачи" if general else task.project_name
+        keyboard.add(
+            InlineKeyboardButton(
+                text=f"{STATUS_EMOJI[task.status]} {task.name} · {project_name}",
+                callback_data=pack(
+                    Action.TASK,
+                    project_id=task.project_id,
+                    task_id=task.id,
+                    position=Position.GENERAL if general else Position.LIST,
+                ),
+            )
+        )
+    keyboard.adjust(1)
+    buttons = []
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton(
+                text="⬅️", callback_data=pack(Action.SEARCH_PAGE, page=page - 1)
+            )
+        )
+    if has_next:
+        buttons.append(
+            InlineKeyboardButton(
+                text="➡️", callback_data=pack(Action.SEARCH_PAGE, page=page + 1)
+            )
+        )
+    keyboard.row(*buttons)
+    keyboard.row(
+        InlineKeyboardButton(text="🔍Новый поиск", callback_data=pack(Action.SEARCH)),
+        InlineKeyboardButton(text="🔙Назад", callback_data=pack(Action.MAIN_MENU)),
+    )
+    return len(results), keyboard.as_markup()
+
+
+async def inline_task(project_id, task_id, version):
+    """
+    Asynchronously creates the keyboard of a task shared from an inline query,
+    with buttons changing its status. Only the owner of the task can use them.
+    """
+    task = {"project_id": project_id, "task_id": task_id, "version": version}
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text=text,
+                    callback_data=pack(Action.INLINE_STATUS, status=status, **task),
+                )
+                for text, status in (
+                    ("🟣Не начата", TaskStatus.NOTSTARTED),
+                    ("🔵В процессе", TaskStatus.INPROGRESS),
+                    ("🟢Завершена", TaskStatus.COMPLETED),
+                )
+            ]
+        ]
+    )
@@ -0,0 +1,265 @@
+"""This file contains the metrics of the bot and the HTTP endpoint exposing them"""
+
+import logging
+import math
+import time
+
+from aiohttp import web
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+import app.config as config
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return f"{{{pairs}}}"
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics, a value for every combination of label values.
+
+    Args:
+        name (str): The name of the metric.
+        documentation (str): The help text of the metric.
+        labelnames (tuple[str, ...]): The names of the labels of the metric.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        """Forgets the values of all label combinations"""
+        self._values.clear()
+
+    def samples(self):
+        """Yields (name, labels, value) of every sample of the metric"""
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is set to the current measurement"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts observed values in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        self._values[key] = (counts, total + value)
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", key + (
+                    ("le", _format_value(bound)),
+                ), count
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, counts[-1]
+
+
+REGISTRY: list[Metric] = []
+
+# Called before every scrape to refresh the metrics that are read from elsewhere
+COLLECTORS = []
+
+HANDLER_DURATION = Histogram(
+    "taskzilla_handler_duration_seconds",
+    "Time spent handling an update",
+    ("handler",),
+)
+HANDLER_ERRORS = Counter(
+    "taskzilla_handler_errors_total",
+    "Updates whose handler raised an exception",
+    ("handler",),
+)
+HANDLER_DB_DURATION = Histogram(
+    "taskzilla_handler_db_duration_seconds",
+    "Time spent executing SQL statements while handling an update",
+    ("handler",),
+)
+HANDLER_DB_STATEMENTS = Counter(
+    "taskzilla_handler_db_statements_total",
+    "SQL statements executed while handling updates",
+    ("handler",),
+)
+TELEGRAM_DURATION = Histogram(
+    "taskzilla_telegram_request_duration_seconds",
+    "Time spent on Telegram Bot API requests",
+    ("method",),
+)
+TELEGRAM_ERRORS = Counter(
+    "taskzilla_telegram_request_errors_total",
+    "Failed Telegram Bot API requests",
+    ("method", "error"),
+)
+UPDATE_LAG = Histogram(
+    "taskzilla_update_lag_seconds",
+    "Time from sending a message to the start of its handling",
+    ("mode",),
+    buckets=LAG_BUCKETS,
+)
+FSM_STATES = Gauge(
+    "taskzilla_fsm_states",
+    "Users in an unfinished dialog by the state of the dialog",
+    ("state",),
+)
+
+
+async def render() -> str:
+    """Returns all metrics in the Prometheus text exposition format"""
+    for collector in COLLECTORS:
+        try:
+            await collector()
+        except Exception:
+            logger.exception("Failed to collect metrics with %s", collector)
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Bot session middleware measuring Bot API requests by method"""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as error:
+            TELEGRAM_ERRORS.inc(method=name, error=type(error).__name__)
+            raise
+        finally:
+            TELEGRAM_DURATION.observe(time.perf_counter() - started, method=name)
+
+
+def update_lag(update) -> float | None:
+    """Seconds since the message of the update was sent, None for updates without a date"""
+    event = update.message or update.edited_message
+    if event is None:
+        return None
+    return max(time.time() - event.date.timestamp(), 0.0)
+
+
+async def observe_update_lag(handler, update, data):
+    """Dispatcher outer middleware recording the lag of incoming updates"""
+    lag = update_lag(update)
+    if lag is not None:
+        UPDATE_LAG.observe(lag, mode=config.BOT_MODE)
+    return await handler(update, data)
+
+
+def fsm_state_collector(storage):
+    """Creates a collector that refreshes the FSM state counts from the storage"""
+
+    async def collect():
+        counts = await storage.count_states()
+        FSM_STATES.clear()
+        for state, count in counts.items():
+            FSM_STATES.set(count, state=state)
+
+    return collect
+
+
+class MetricsServer:
+    """
+    Serves the metrics on http://{host}:{port}/metrics.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on, the server is not started when it is 0.
+    """
+
+    def __init__(
+        self, host: str = config.METRICS_HOST, port: int = config.METRICS_PORT
+    ):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=(await render()).encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def start(self):
+        """Starts the HTTP server"""
+        if not self.port or self._runner is not None:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Serving metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def close(self):
+        """Stops the HTTP server"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+server = MetricsServer()
@@ -0,0 +1,147 @@
+"""This file contains the middlewares of the bot"""
+
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass, fields
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery
+
+import app.config as config
+import app.metrics as metrics
+from app.database.models import QueryStats, query_stats
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class HandlerStats:
+    """
+    Database work of a handler summed over all updates it handled.
+
+    Attributes:
+        updates (int): Updates handled.
+        checkouts (int): Connections checked out of the pool.
+        statements (int): Statements executed.
+        rows_changed (int): Rows inserted, updated or deleted by the statements.
+        db_time (float): Seconds spent executing the statements.
+        max_statements (int): Most statements executed for one update.
+    """
+
+    updates: int = 0
+    checkouts: int = 0
+    statements: int = 0
+    rows_changed: int = 0
+    db_time: float = 0.0
+    max_statements: int = 0
+
+    def add(self, stats: QueryStats):
+        """Adds the database work done for one update"""
+        self.updates += 1
+        for field in fields(stats):
+            setattr(
+                self, field.name, getattr(self, field.name) + getattr(stats, field.name)
+            )
+        self.max_statements = max(self.max_statements, stats.statements)
+
+
+_handler_stats: defaultdict[str, HandlerStats] = defaultdict(HandlerStats)
+
+
+def handler_stats() -> dict[str, HandlerStats]:
+    """Returns the database work of every handler since the start or the last reset"""
+    return dict(_handler_stats)
+
+
+def reset_handler_stats():
+    """Forgets the collected database work"""
+    _handler_stats.clear()
+
+
+def handler_name(event, data, callbacks=None) -> str:
+    """
+    Returns the name of the handler an event is routed to.
+
+    Args:
+        callbacks (CallbackTable | None): The table callback queries are dispatched with,
+            used to name the handler a callback query is routed to.
+    """
+    if callbacks is not None and isinstance(event, CallbackQuery):
+        handler = callbacks.resolve(data.get("payload"))
+        if handler is not None:
+            return handler.__name__
+    return data["handler"].callback.__name__
+
+
+class QueryStatsMiddleware(BaseMiddleware):
+    """
+    Counts connection checkouts, statements, changed rows and database time of every handled update,
+    logs them and adds them to `handler_stats()` under the name of the handler.
+
+    Updates that execute more than `config.DB_STATEMENTS_WARNING` statements are logged
+    as warnings, since that usually means a query is run once per row of a list.
+
+    Args:
+        callbacks (CallbackTable | None): The table callback queries are dispatched with,
+            used to name the handler a callback query is routed to.
+    """
+
+    def __init__(self, callbacks=None):
+        self.callbacks = callbacks
+
+    async def __call__(self, handler, event, data):
+        stats = QueryStats()
+        token = query_stats.set(stats)
+        try:
+            return await handler(event, data)
+        finally:
+            query_stats.reset(token)
+            name = handler_name(event, data, self.callbacks)
+            _handler_stats[name].add(stats)
+            level = (
+                logging.WARNING
+                if stats.statements > config.DB_STATEMENTS_WARNING
+                else logging.DEBUG
+            )
+            logger.log(
+                level,
+                "%s: %s checkouts, %s statements, %s rows changed, %.1f ms in the database",
+                name,
+                stats.checkouts,
+                stats.statements,
+                stats.rows_changed,
+                stats.db_time * 1000,
+            )
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Records the duration, errors and database work of every handled update
+    in the handler metrics of `app.metrics`.
+
+    Must be registered after QueryStatsMiddleware to see the database work.
+
+    Args:
+        callbacks (CallbackTable | None): The table callback queries are dispatched with.
+    """
+
+    def __init__(self, callbacks=None):
+        self.callbacks = callbacks
+
+    async def __call__(self, handler, event, data):
+        name = handler_name(event, data, self.callbacks)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            metrics.HANDLER_DURATION.observe(
+                time.perf_counter() - started, handler=name
+            )
+            stats = query_stats.get()
+            if stats is not None:
+                metrics.HANDLER_DB_DURATION.observe(stats.db_time, handler=name)
+                metrics.HANDLER_DB_STATEMENTS.inc(stats.statements, handler=name)
@@ -0,0 +1,241 @@
+"""This file contains the rate-limited queue of outgoing messages and broadcasts"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramRetryAfter,
+)
+
+import app.config as config
+import app.database.requests as rq
+from app.database.models import STATUS_EMOJI, BroadcastKind, DeliveryStatus
+from app.dates import format_due
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the queue retries after a failed database read or write
+RETRY_INTERVAL = 60
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average and bursts of up to `capacity` events.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): The maximum number of tokens.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """
+        Takes a token, possibly one that is not there yet.
+
+        Returns:
+            float: Seconds to wait until the token is there.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, 0.0)
+
+    def idle(self) -> bool:
+        """Whether the bucket is full, so dropping it changes nothing"""
+        elapsed = time.monotonic() - self.updated
+        return self.tokens + elapsed * self.rate >= self.capacity
+
+    async def acquire(self):
+        """Waits for a token"""
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class Outbox:
+    """
+    Sends messages within the limits of Telegram: `rate` messages per second
+    to all chats and `chat_rate` messages per second to the same chat.
+    A flood wait (RetryAfter) pauses all sending for the time Telegram asks for.
+
+    Also delivers broadcasts, `batch_size` deliveries at a time. The outcome of
+    every batch is stored, a restarted bot goes on with the pending deliveries.
+    Whenever every broadcast is delivered, the deliveries of the ones finished
+    more than `retention_days` ago are deleted.
+
+    Args:
+        rate (float): Messages per second to all chats.
+        chat_rate (float): Messages per second to one chat.
+        batch_size (int): Deliveries read and sent at once.
+        attempts (int): Attempts to send a message before giving up.
+        retention_days (float): Days the deliveries of finished broadcasts are kept,
+            0 keeps them forever.
+    """
+
+    def __init__(
+        self,
+        rate: float = config.OUTBOX_RATE,
+        chat_rate: float = config.OUTBOX_CHAT_RATE,
+        batch_size: int = config.OUTBOX_BATCH_SIZE,
+        attempts: int = 5,
+        retention_days: float = config.DELIVERY_RETENTION_DAYS,
+    ):
+        self.chat_rate = chat_rate
+        self.batch_size = batch_size
+        self.attempts = attempts
+        self.retention_days = retention_days
+        self.bot = None
+        self._bucket = TokenBucket(rate, rate)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def start(self, bot):
+        """Starts delivering broadcasts with the bot"""
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops delivering broadcasts, the pending deliveries are kept"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def wake(self):
+        """Tells the queue a broadcast was created"""
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Buckets of chats nobody is sent to are full, there is no need to keep them
+            if len(self._chat_buckets) >= config.CACHE_SIZE:
+                self._chat_buckets = {
+                    key: value
+                    for key, value in self._chat_buckets.items()
+                    if not value.idle()
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    async def send(self, chat_id, text, **kwargs) -> bool:
+        """
+        Sends a message once the limits allow it.
+
+        Returns:
+            bool: Whether the message was sent, False if Telegram rejected it
+                (e.g. the user blocked the bot) or every attempt failed.
+        """
+        for attempt in range(self.attempts):
+            await self._chat_bucket(chat_id).acquire()
+            while (pause := self._paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(pause)
+            await self._bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return True
+            except TelegramRetryAfter as error:
+                logger.warning("Flood wait of %s seconds", error.retry_after)
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + error.retry_after
+                )
+            except (TelegramForbiddenError, TelegramBadRequest) as error:
+                logger.info("Message to %s rejected: %s", chat_id, error.message)
+                return False
+            except Exception:
+                logger.exception("Failed to send a message to %s", chat_id)
+                await asyncio.sleep(2**attempt)
+        return False
+
+    async def _run(self):
+        while True:
+            try:
+                broadcast = await rq.get_unfinished_broadcast()
+                if broadcast is None:
+                    await self._delete_old_deliveries()
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                await self._deliver(broadcast)
+            except Exception:
+                logger.exception("Failed to deliver broadcasts")
+                await asyncio.sleep(RETRY_INTERVAL)
+
+    async def _delete_old_deliveries(self):
+        if not self.retention_days:
+            return
+        before = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(
+            days=self.retention_days
+        )
+        deleted = await rq.delete_old_deliveries(before)
+        if deleted:
+            logger.info("Deleted %s deliveries of old broadcasts", deleted)
+
+    async def _deliver_one(self, broadcast, user_id):
+        if broadcast.kind == BroadcastKind.DIGEST:
+            text = await digest_text(user_id)
+            if text is None:
+                return DeliveryStatus.SKIPPED
+        else:
+            text = broadcast.text
+        if await self.send(user_id, text):
+            return DeliveryStatus.SENT
+        return DeliveryStatus.FAILED
+
+    async def _deliver(self, broadcast):
+        """Delivers a broadcast, batch by batch, and tells its admin the outcome"""
+        while deliveries := await rq.get_pending_deliveries(
+            broadcast.id, self.batch_size
+        ):
+            outcomes = await asyncio.gather(
+                *(self._deliver_one(broadcast, row.user_id) for row in deliveries)
+            )
+            statuses = {status: [] for status in DeliveryStatus}
+            for row, status in zip(deliveries, outcomes):
+                statuses[status].append(row.id)
+            # A crash before this write sends the batch again after the restart
+            await rq.set_delivery_statuses(statuses)
+        counts = await rq.finish_broadcast(broadcast.id)
+        logger.info("Broadcast %s finished: %s", broadcast.id, counts)
+        if broadcast.created_by is not None:
+            await self.send(
+                broadcast.created_by,
+                f"Рассылка #{broadcast.id} завершена: "
+                f"отправлено {counts.get(DeliveryStatus.SENT, 0)}, "
+                f"не доставлено {counts.get(DeliveryStatus.FAILED, 0)}",
+            )
+
+
+async def digest_text(user_id):
+    """Text of the digest of the open tasks of a user, None if there are none"""
+    count, tasks = await rq.get_open_tasks(user_id, config.DIGEST_TASKS)
+    if not count:
+        return None
+    lines = [f"📋Ваши открытые задачи: {count}", ""]
+    for task in tasks:
+        line = f"{STATUS_EMOJI[task.status]} {task.name}"
+        if task.project_name != "General":
+            line += f' — проект "{task.project_name}"'
+        if task.due_at is not None:
+            line += f", срок {format_due(task.due_at)}"
+        lines.append(line)
+    if count > len(tasks):
+        lines.append(f"...и ещё {count - len(tasks)}")
+    return "\n".join(lines)
+
+
+outbox = Outbox()
@@ -0,0 +1,255 @@
+"""This file contains the jobs sending reminders of tasks and the daily digest"""
+
+import asyncio
+import heapq
+import logging
+from datetime import datetime, time, timedelta, timezone
+
+import app.config as config
+import app.database.requests as rq
+from app.database.models import STATUS_EMOJI, BroadcastKind, TaskStatus
+from app.dates import ZONE, format_due
+from app.effects import effects
+from app.outbox import outbox
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the scheduler retries after a failed database read or write
+RETRY_INTERVAL = 60
+
+# A reminder that failed to be sent is retried after REMINDER_RETRY,
+# until its task is more than REMINDER_EXPIRY past due
+REMINDER_RETRY = timedelta(minutes=10)
+REMINDER_EXPIRY = timedelta(days=1)
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class ReminderScheduler:
+    """
+    Sends the reminders of tasks when they are due.
+
+    Only the next `size` reminders are kept in a heap. They are read in order
+    from the remind_at index, the next ones once the heap is empty, so the table
+    is not polled. A reminder is cleared in the database only after it is sent,
+    pending ones are read again after a restart, so a crash while sending
+    sends a reminder twice rather than never. A reminder that fails to be sent
+    is retried every REMINDER_RETRY until it is REMINDER_EXPIRY late.
+
+    Args:
+        size (int): The maximum number of reminders kept in memory.
+    """
+
+    def __init__(self, size: int = config.REMINDER_BATCH_SIZE):
+        self.size = size
+        self._task = None
+        self._wakeup = asyncio.Event()
+        # (remind_at, task_id) of the reminders read or scheduled since,
+        # entries that no longer match `_scheduled` were superseded and are skipped
+        self._heap: list[tuple[datetime, int]] = []
+        self._scheduled: dict[int, datetime] = {}
+        # Tasks whose reminders are being sent, still pending in the database
+        self._sending: set[int] = set()
+        # The latest reminder kept, later ones are only in the database.
+        # None once every pending reminder is in the heap.
+        self._horizon: datetime | None = None
+        self._loaded = False
+
+    async def start(self):
+        """Starts sending reminders"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops sending reminders"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def schedule(self, task_id, remind_at):
+        """
+        Adds a reminder set in the database, replacing the previous one of the task.
+        A removed reminder or one later than the reminders kept is left to the database.
+        """
+        if remind_at is None or (
+            self._horizon is not None and remind_at > self._horizon
+        ):
+            self._scheduled.pop(task_id, None)
+            return
+        self._scheduled[task_id] = remind_at
+        heapq.heappush(self._heap, (remind_at, task_id))
+        if len(self._heap) > 2 * self.size:
+            self._compact()
+        self._wakeup.set()
+
+    def _compact(self):
+        """Drops superseded entries and keeps only the earliest `size` reminders"""
+        entries = [
+            (remind_at, task_id) for task_id, remind_at in self._scheduled.items()
+        ]
+        if len(entries) > self.size:
+            entries = heapq.nsmallest(self.size, entries)
+            # The dropped reminders are read from the database once these are sent
+            self._horizon = entries[-1][0]
+            self._scheduled = {task_id: remind_at for remind_at, task_id in entries}
+        heapq.heapify(entries)
+        self._heap = entries
+
+    async def _load(self):
+        reminders = await rq.get_next_reminders(self.size)
+        horizon = reminders[-1].remind_at if len(reminders) >= self.size else None
+        scheduled = {reminder.id: reminder.remind_at for reminder in reminders}
+        # Reminders scheduled during the read may have been committed after it
+        scheduled.update(
+            (task_id, remind_at)
+            for task_id, remind_at in self._scheduled.items()
+            if horizon is None or remind_at <= horizon
+        )
+        for task_id in self._sending:
+            scheduled.pop(task_id, None)
+        self._scheduled = scheduled
+        self._heap = [(remind_at, task_id) for task_id, remind_at in scheduled.items()]
+        heapq.heapify(self._heap)
+        self._horizon = horizon
+        self._loaded = True
+
+    async def _run(self):
+        while True:
+            try:
+                if not self._loaded or (not self._heap and self._horizon is not None):
+                    await self._load()
+                self._wakeup.clear()
+                timeout = None
+                if self._heap:
+                    timeout = max((self._heap[0][0] - _now()).total_seconds(), 0)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._send_due()
+            except Exception:
+                logger.exception("Failed to send reminders")
+                # Read the pending reminders again, the ones not sent are still there
+                self._heap = []
+                self._scheduled = {}
+                self._loaded = False
+                await asyncio.sleep(RETRY_INTERVAL)
+
+    def _send_due(self):
+        now = _now()
+        task_ids = set()
+        while self._heap and self._heap[0][0] <= now:
+            remind_at, task_id = heapq.heappop(self._heap)
+            if self._scheduled.get(task_id) == remind_at:
+                del self._scheduled[task_id]
+                task_ids.add(task_id)
+        if task_ids:
+            self._sending.update(task_ids)
+            # Not awaited, the outbox may hold a message back for a while
+            effects.spawn(self._deliver(task_ids, now))
+
+    async def _deliver(self, task_ids, now):
+        """Sends due reminders, then clears the sent ones in the database"""
+        try:
+            reminders = await rq.get_due_reminders(task_ids, now)
+            sent = await asyncio.gather(
+                *(self._send(reminder) for reminder in reminders)
+            )
+            done_ids, retry_ids = [], []
+            for reminder, success in zip(reminders, sent):
+                if success or now - reminder.due_at > REMINDER_EXPIRY:
+                    done_ids.append(reminder.id)
+                else:
+                    retry_ids.append(reminder.id)
+            retry_at = now + REMINDER_RETRY
+            await rq.settle_reminders(done_ids, retry_ids, now, retry_at)
+        except Exception:
+            # The reminders are still pending in the database, read them again
+            self._loaded = False
+            raise
+        finally:
+            self._sending.difference_update(task_ids)
+            # Reminders kept back while these were sent may be read now
+            self._wakeup.set()
+        for task_id in retry_ids:
+            self.schedule(task_id, retry_at)
+
+    async def _send(self, reminder):
+        """Sends a reminder, the ones of completed tasks are skipped"""
+        if reminder.status == TaskStatus.COMPLETED:
+            return True
+        return await outbox.send(
+            reminder.user_id,
+            f'⏰Напоминание: срок задачи "{STATUS_EMOJI[reminder.status]} {reminder.name}"'
+            f" — {format_due(reminder.due_at)}",
+        )
+
+
+class DailyDigest:
+    """
+    Starts the digest broadcast of open tasks every day at `at` in TIMEZONE,
+    delivered by the outbox.
+
+    A digest missed while the bot was stopped is started when it starts again,
+    unless one was started since.
+
+    Args:
+        at (str): The time of the digest, "HH:MM", an empty string disables it.
+    """
+
+    def __init__(self, at: str = config.DIGEST_TIME):
+        self.at = time.fromisoformat(at) if at else None
+        self._task = None
+
+    async def start(self):
+        """Starts the job"""
+        if self.at is not None and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops the job"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def _previous(self):
+        """The last time the digest was due at in UTC"""
+        now = datetime.now(ZONE)
+        due = datetime.combine(now.date(), self.at, ZONE)
+        if due > now:
+            due = datetime.combine(now.date() - timedelta(days=1), self.at, ZONE)
+        return due.astimezone(timezone.utc).replace(tzinfo=None)
+
+    async def _run(self):
+        last = None
+        while True:
+            try:
+                due = self._previous()
+                if last is None:
+                    # The first digest of a new bot waits for its time
+                    last = await rq.get_last_broadcast_time(BroadcastKind.DIGEST)
+                    last = last or due
+                if last < due:
+                    broadcast_id, recipients = await rq.create_broadcast(
+                        BroadcastKind.DIGEST
+                    )
+                    last = _now()
+                    logger.info(
+                        "Digest %s started for %s users", broadcast_id, recipients
+                    )
+                    outbox.wake()
+                await asyncio.sleep((due + timedelta(days=1) - _now()).total_seconds())
+            except Exception:
+                logger.exception("Failed to start the daily digest")
+                await asyncio.sleep(RETRY_INTERVAL)
+
+
+scheduler = ReminderScheduler()
+
+digest = DailyDigest()
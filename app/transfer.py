@@ -0,0 +1,135 @@
+"""This file contains the export and import of projects and tasks as JSON Lines files"""
+
+import codecs
+import json
+from dataclasses import dataclass
+
+from aiogram.types import InputFile
+
+import app.config as config
+import app.database.requests as rq
+from app.database.models import TaskStatus
+
+# Longest project and task name the database columns hold
+MAX_NAME_LENGTH = 256
+
+
+class ExportFile(InputFile):
+    """
+    JSON Lines file of all projects and tasks of a user, uploaded while it is read
+    from the database, so neither the rows nor the file are held in memory.
+
+    Every line is a task, {"project": ..., "name": ..., "status": ..., "comment": ...},
+    or a project without tasks, {"project": ...}.
+
+    Args:
+        user_id (int): The TG ID of the user.
+        filename (str): The name of the file shown in Telegram.
+    """
+
+    def __init__(self, user_id: int, filename: str = "taskzilla.jsonl"):
+        super().__init__(filename=filename)
+        self.user_id = user_id
+
+    async def read(self, bot):
+        chunk = []
+        size = 0
+        async for project, name, status, comment in rq.stream_user_tasks(self.user_id):
+            record = {"project": project}
+            if name is not None:
+                record.update(name=name, status=status.name, comment=comment)
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode()
+            chunk.append(line)
+            size += len(line)
+            if size >= self.chunk_size:
+                yield b"".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield b"".join(chunk)
+
+
+def _valid_name(value) -> bool:
+    return isinstance(value, str) and 0 < len(value.strip()) <= MAX_NAME_LENGTH
+
+
+def parse_line(line: str):
+    """
+    Parses a line of an exported file.
+
+    Returns:
+        tuple | None: (project, name, status, comment) of the line, with the name
+            set to None for a project without tasks, or None if the line is invalid.
+    """
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(record, dict) or not _valid_name(record.get("project")):
+        return None
+    name = record.get("name")
+    if name is None:
+        return record["project"], None, None, None
+    comment = record.get("comment") or ""
+    status = record.get("status") or TaskStatus.NOTSTARTED.name
+    if (
+        not _valid_name(name)
+        or not isinstance(comment, str)
+        or status not in TaskStatus.__members__
+    ):
+        return None
+    return record["project"], name, TaskStatus[status], comment
+
+
+@dataclass
+class ImportResult:
+    """
+    Outcome of an import.
+
+    Attributes:
+        tasks (int): Tasks read from the file.
+        added (int): Tasks added, -1 if the database driver does not report it.
+        invalid (int): Non-empty lines that could not be parsed.
+    """
+
+    tasks: int = 0
+    added: int = 0
+    invalid: int = 0
+
+
+async def import_file(user_id, file, batch_size=config.IMPORT_BATCH_SIZE):
+    """
+    Adds the projects and tasks of a JSON Lines file to the ones of a user,
+        `batch_size` lines per database write.
+
+    Args:
+        user_id (int): The TG ID of the user.
+        file (BinaryIO): The file, read line by line.
+        batch_size (int): The number of lines inserted at once.
+    """
+    result = ImportResult()
+    # Files saved on Windows often start with a byte order mark
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    batch = []
+
+    async def flush():
+        added = await rq.import_tasks(user_id, batch)
+        result.added = -1 if added < 0 or result.added < 0 else result.added + added
+        batch.clear()
+
+    for raw in file:
+        line = decoder.decode(raw).strip()
+        if not line:
+            continue
+        record = parse_line(line)
+        if record is None:
+            result.invalid += 1
+            continue
+        if record[1] is not None:
+            result.tasks += 1
+        batch.append(record)
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+    return result
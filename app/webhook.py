@@ -0,0 +1,116 @@
+"""This file contains the webhook mode of the bot"""
+
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+import app.config as config
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """
+    Webhook request handler that acknowledges an update as soon as it is queued.
+
+    Updates go to a bounded local queue drained by a fixed number of workers,
+    which feed them to the dispatcher. When the queue is full, the request waits
+    for a free slot, so Telegram slows down instead of the process running out of memory.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        secret_token: str | None = None,
+        workers: int = config.WEBHOOK_WORKERS,
+        queue_size: int = config.WEBHOOK_QUEUE_SIZE,
+        **data,
+    ):
+        super().__init__(
+            dispatcher,
+            bot,
+            handle_in_background=True,
+            secret_token=secret_token,
+            **data,
+        )
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._worker_tasks = []
+
+    def register(self, app: web.Application, /, path: str, **kwargs) -> None:
+        super().register(app, path, **kwargs)
+        app.on_startup.append(self._start_workers)
+
+    async def _start_workers(self, *args, **kwargs):
+        self._worker_tasks = [
+            asyncio.create_task(self._worker()) for _ in range(self.workers)
+        ]
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self._background_feed_update(self.bot, update)
+            except Exception:
+                logger.exception("Failed to process update %s", update.get("update_id"))
+            finally:
+                self.queue.task_done()
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request):
+        await self.queue.put(await request.json(loads=bot.session.json_loads))
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        """Process the updates left in the queue, stop the workers and close the bot session"""
+        await self.queue.join()
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        await super().close()
+
+
+def create_app(bot: Bot, dispatcher: Dispatcher) -> web.Application:
+    """
+    Creates the aiohttp application that receives updates on `WEBHOOK_PATH`
+    and checks the secret token Telegram sends with every request.
+    """
+    app = web.Application()
+    QueuedRequestHandler(dispatcher, bot, secret_token=config.WEBHOOK_SECRET).register(
+        app, path=config.WEBHOOK_PATH
+    )
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def set_webhook(bot: Bot, dispatcher: Dispatcher):
+    """Registers the webhook URL and secret token in Telegram"""
+    await bot.set_webhook(
+        url=config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+        secret_token=config.WEBHOOK_SECRET,
+        allowed_updates=dispatcher.resolve_used_update_types(),
+    )
+
+
+async def run_webhook(bot: Bot, dispatcher: Dispatcher):
+    """Serves the webhook application until the process is stopped"""
+    if not config.WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, webhook requests are not verified")
+    dispatcher.startup.register(set_webhook)
+    runner = web.AppRunner(create_app(bot, dispatcher))
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    await site.start()
+    logger.info(
+        "Listening for webhook updates on %s:%s%s",
+        config.WEBHOOK_HOST,
+        config.WEBHOOK_PORT,
+        config.WEBHOOK_PATH,
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,361 @@
+"""
+This file contains the handler benchmarks of the bot.
+
+Synthetic updates are fed through `Dispatcher.feed_update` with the real router,
+FSM storage and database layer, while the Telegram API is replaced by a stub session.
+Every flow is measured separately and the results are saved as JSON:
+
+    python -m benchmarks.handlers --iterations 500 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from itertools import count
+
+FLOWS = (
+    "start",
+    "list_tasks",
+    "open_task",
+    "change_status",
+    "create_task",
+    "rename",
+    "delete_project",
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--iterations", type=int, default=200, help="measured runs of every flow"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=20, help="unmeasured runs before measuring"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="users running a flow at the same time",
+    )
+    parser.add_argument(
+        "--tasks", type=int, default=30, help="tasks of every benchmark user"
+    )
+    parser.add_argument(
+        "--flows",
+        nargs="+",
+        choices=FLOWS,
+        default=list(FLOWS),
+        help="flows to measure",
+    )
+    parser.add_argument(
+        "--database-url",
+        help="database to run against, a temporary SQLite file by default",
+    )
+    parser.add_argument("--output", help="file to save the JSON results to")
+    return parser.parse_args(argv)
+
+
+def percentile(samples, percent):
+    """Percentile of the samples with linear interpolation"""
+    ordered = sorted(samples)
+    if len(ordered) == 1:
+        return ordered[0]
+    position = (len(ordered) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(samples, elapsed, updates, api_calls, statements):
+    """
+    Summary of the runs of a flow.
+
+    Args:
+        samples (list[float]): Duration of every run in seconds.
+        elapsed (float): Wall time of all runs in seconds.
+        updates (int): Number of updates fed during the runs.
+        api_calls (int): Number of Telegram API calls made during the runs.
+        statements (int): Number of SQL statements executed by the handlers during the runs.
+    """
+    return {
+        "runs": len(samples),
+        "updates": updates,
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+        "runs_per_s": round(len(samples) / elapsed, 1),
+        "updates_per_s": round(updates / elapsed, 1),
+        "api_calls_per_run": round(api_calls / len(samples), 2),
+        "statements_per_run": round(statements / len(samples), 2),
+    }
+
+
+def git_commit():
+    """Commit the benchmark runs on, if the code is a git checkout"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    # The bot modules read the configuration on import
+    from aiogram import Bot, Dispatcher
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import EditMessageText, SendMessage
+    from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+    import app.config as config
+    import app.database.requests as rq
+    from app.callbacks import Action, Position, pack
+    from app.database.models import TaskStatus, async_main, engine
+    from app.database.storage import DatabaseStorage, use_database_context
+    from app.database.writer import writer
+    from app.effects import effects
+    from app.handlers import router
+    from app.middlewares import handler_stats, reset_handler_stats
+
+    class StubSession(BaseSession):
+        """Bot session that answers API calls without sending them"""
+
+        def __init__(self):
+            super().__init__()
+            self.calls = 0
+            self.message_ids = count(1_000_000)
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls += 1
+            if isinstance(method, (SendMessage, EditMessageText)):
+                return Message(
+                    message_id=next(self.message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=method.chat_id or 0, type="private"),
+                    text=method.text,
+                )
+            return True
+
+        async def stream_content(
+            self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True
+        ):
+            yield b""
+
+        async def close(self):
+            pass
+
+    update_ids = count(1)
+    message_ids = count(1)
+
+    def message(user_id, text):
+        return Update(
+            update_id=next(update_ids),
+            message=Message(
+                message_id=next(message_ids),
+                date=datetime.now(),
+                chat=Chat(id=user_id, type="private"),
+                from_user=User(id=user_id, is_bot=False, first_name="Bench"),
+                text=text,
+            ),
+        )
+
+    def callback(user_id, data):
+        return Update(
+            update_id=next(update_ids),
+            callback_query=CallbackQuery(
+                id=str(next(update_ids)),
+                from_user=User(id=user_id, is_bot=False, first_name="Bench"),
+                chat_instance=str(user_id),
+                data=data,
+                message=Message(
+                    message_id=next(message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=user_id, type="private"),
+                    text="Benchmark",
+                ),
+            ),
+        )
+
+    await async_main()
+    session = StubSession()
+    bot = Bot("0:benchmark", session=session)
+    storage = DatabaseStorage()
+    dispatcher = Dispatcher(storage=storage)
+    use_database_context(dispatcher)
+    dispatcher.include_router(router)
+    if config.DB_SINGLE_WRITER:
+        await writer.start()
+    await effects.start()
+
+    user_ids = count(1)
+
+    async def new_user(tasks=args.tasks):
+        """Registers a user with general tasks and returns its ids"""
+        user_id = next(user_ids)
+        await rq.add_user(user_id)
+        project_id = (await rq.add_project(user_id, "General")).id
+        task_ids = [
+            (await rq.add_task(project_id, f"Task {number}", user_id)).id
+            for number in range(tasks)
+        ]
+        return user_id, project_id, task_ids[0]
+
+    users = [await new_user() for _ in range(args.concurrency)]
+    names = count()
+    statuses = (TaskStatus.INPROGRESS, TaskStatus.COMPLETED, TaskStatus.NOTSTARTED)
+
+    # A flow is prepared outside the measurement and returns the updates to feed
+    async def start(user):
+        return [message(next(user_ids), "/start")]
+
+    async def list_tasks(user):
+        user_id, project_id, task_id = user
+        return [callback(user_id, pack(Action.GENERAL_TASKS))]
+
+    async def open_task(user):
+        user_id, project_id, task_id = user
+        data = pack(
+            Action.TASK,
+            project_id=project_id,
+            task_id=task_id,
+            position=Position.GENERAL,
+        )
+        return [callback(user_id, data)]
+
+    async def change_status(user):
+        user_id, project_id, task_id = user
+        data = pack(
+            Action.TASK_STATUS,
+            project_id=project_id,
+            task_id=task_id,
+            position=Position.GENERAL,
+            status=statuses[next(names) % len(statuses)],
+        )
+        return [callback(user_id, data)]
+
+    async def create_task(user):
+        user_id, project_id, task_id = user
+        data = pack(Action.NEW_TASK, project_id=project_id, position=Position.GENERAL)
+        return [callback(user_id, data), message(user_id, f"New {next(names)}")]
+
+    async def rename(user):
+        user_id, project_id, task_id = user
+        data = pack(
+            Action.RENAME_TASK,
+            project_id=project_id,
+            task_id=task_id,
+            position=Position.GENERAL,
+        )
+        return [callback(user_id, data), message(user_id, f"Renamed {next(names)}")]
+
+    async def delete_project(user):
+        user_id = user[0]
+        name = f"Project {next(names)}"
+        project_id = (await rq.add_project(user_id, name)).id
+        for number in range(args.tasks):
+            await rq.add_task(project_id, f"Task {number}", user_id)
+        return [callback(user_id, pack(Action.DELETE_PROJECT, project_id=project_id))]
+
+    flows = {
+        "start": start,
+        "list_tasks": list_tasks,
+        "open_task": open_task,
+        "change_status": change_status,
+        "create_task": create_task,
+        "rename": rename,
+        "delete_project": delete_project,
+    }
+
+    async def feed(updates, samples):
+        started = time.perf_counter()
+        for update in updates:
+            await dispatcher.feed_update(bot, update)
+        samples.append(time.perf_counter() - started)
+
+    async def measure(flow, runs):
+        """Runs the flow `runs` times with `concurrency` users at once"""
+        samples = []
+        updates = 0
+        calls = 0
+        elapsed = 0.0
+        reset_handler_stats()
+        for offset in range(0, runs, args.concurrency):
+            batch = [
+                await flow(user)
+                for user in users[: min(args.concurrency, runs - offset)]
+            ]
+            calls -= session.calls
+            started = time.perf_counter()
+            await asyncio.gather(
+                *(feed(flow_updates, samples) for flow_updates in batch)
+            )
+            elapsed += time.perf_counter() - started
+            # Callback answers and deletions finish off the critical path, count them too
+            await effects.wait()
+            calls += session.calls
+            updates += sum(len(flow_updates) for flow_updates in batch)
+        statements = sum(stats.statements for stats in handler_stats().values())
+        return samples, elapsed, updates, calls, statements
+
+    results = {}
+    try:
+        for name in args.flows:
+            if args.warmup:
+                await measure(flows[name], args.warmup)
+            results[name] = summarize(*await measure(flows[name], args.iterations))
+    finally:
+        await effects.close()
+        await writer.close()
+        await storage.close()
+        await engine.dispose()
+    return results
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["DATABASE_URL"] = args.database_url or (
+            f"sqlite+aiosqlite:///{os.path.join(directory, 'benchmark.sqlite3')}"
+        )
+        os.environ.setdefault("DB_ECHO", "0")
+        flows = asyncio.run(run(args))
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "database": os.environ["DATABASE_URL"].split(":", 1)[0],
+        "iterations": args.iterations,
+        "warmup": args.warmup,
+        "concurrency": args.concurrency,
+        "tasks": args.tasks,
+        "flows": flows,
+    }
+    print(f"{'flow':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'runs/s':>10}")
+    for name, result in flows.items():
+        print(
+            f"{name:<16}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+            f"{result['p99_ms']:>10}{result['runs_per_s']:>10}"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
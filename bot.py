@@ -1,22 +1,54 @@
 """This is the entry point of the bot"""
 
-import os
 import logging
 import asyncio
-from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
+import app.config as config
+import app.metrics as metrics
 from app.handlers import router
 from app.database.models import async_main
+from app.database.repair import repair
+from app.database.storage import DatabaseStorage, use_database_context
+from app.database.writer import writer
+from app.effects import effects
+from app.outbox import outbox
+from app.scheduler import digest, scheduler
+from app.webhook import run_webhook
 
 
 async def main():
     """Entry point of the bot"""
     await async_main()
-    load_dotenv()
-    bot = Bot(token=str(os.getenv("BOT_TOKEN")))
-    dp = Dispatcher()
+    bot = Bot(token=config.BOT_TOKEN)
+    storage = DatabaseStorage()
+    dp = Dispatcher(storage=storage)
+    use_database_context(dp)
+    dp.startup.register(storage.start)
+    if config.DB_SINGLE_WRITER:
+        dp.startup.register(writer.start)
+        dp.shutdown.register(writer.close)
+    dp.startup.register(effects.start)
+    dp.shutdown.register(effects.close)
+    dp.startup.register(repair.start)
+    dp.shutdown.register(repair.close)
+    dp.startup.register(outbox.start)
+    dp.shutdown.register(outbox.close)
+    dp.startup.register(scheduler.start)
+    dp.shutdown.register(scheduler.close)
+    dp.startup.register(digest.start)
+    dp.shutdown.register(digest.close)
+    if config.METRICS_PORT:
+        bot.session.middleware(metrics.TelegramMetricsMiddleware())
+        dp.update.outer_middleware(metrics.observe_update_lag)
+        metrics.COLLECTORS.append(metrics.fsm_state_collector(storage))
+        dp.startup.register(metrics.server.start)
+        dp.shutdown.register(metrics.server.close)
     dp.include_router(router)
-    await dp.start_polling(bot)
+    if config.BOT_MODE == "webhook":
+        await run_webhook(bot, dp)
+    else:
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
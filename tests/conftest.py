@@ -0,0 +1,11 @@
+"""Configuration of the tests: the bot modules use a temporary SQLite database"""
+
+import os
+import tempfile
+
+# The bot modules read the configuration on import, before any test module imports them
+_directory = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = (
+    f"sqlite+aiosqlite:///{os.path.join(_directory.name, 'test.sqlite3')}"
+)
+os.environ["DB_SLOW_QUERY_MS"] = "0"
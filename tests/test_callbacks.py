@@ -0,0 +1,108 @@
+"""Tests of the callback data codec and the callback dispatch table"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.callbacks import (
+    MAX_LENGTH,
+    SCHEMAS,
+    Action,
+    CallbackPayload,
+    Position,
+    pack,
+)
+from app.database.models import TaskStatus
+from app.handlers import callbacks, outdated_button
+
+# The largest IDs, versions and pages there can be: INTEGER columns on PostgreSQL
+LARGEST = 2**31 - 1
+
+
+def _largest(name):
+    if name == "position":
+        return max(Position, key=lambda position: len(position.value))
+    if name == "status":
+        return max(TaskStatus, key=lambda status: len(str(status.value)))
+    return LARGEST
+
+
+@pytest.mark.parametrize("action", Action)
+def test_round_trip(action):
+    """Every action packs its largest payload within the limit and unpacks it unchanged"""
+    payload = CallbackPayload(
+        action, **{name: _largest(name) for name in SCHEMAS[action]}
+    )
+    data = payload.pack()
+    assert len(data.encode()) <= MAX_LENGTH
+    assert CallbackPayload.unpack(data) == payload
+
+
+@pytest.mark.parametrize("action", Action)
+def test_round_trip_of_empty_fields(action):
+    """Fields left empty, like the cursors of a first page, unpack as None"""
+    data = pack(action)
+    assert CallbackPayload.unpack(data) == CallbackPayload(action)
+
+
+def test_every_action_is_handled():
+    """Every action has a handler, so only unreadable data reaches the fallback"""
+    assert set(callbacks.handlers) == set(Action)
+    assert callbacks.fallback is outdated_button
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        None,
+        "",
+        "1",
+        # Buttons of older versions of the bot
+        "task_1_2_general",
+        "0:t:1:2:g",
+        "2:t:1:2:g",
+        # Unknown action, wrong number of fields and values of the wrong type
+        "1:zz:1",
+        "1:t:1:2",
+        "1:t:1:2:g:3",
+        "1:t:one:2:g",
+        "1:t:1:2:q",
+        "1:ts:1:2:g:9:1",
+    ],
+)
+def test_malformed_data_reaches_outdated_button(data):
+    """Malformed and old callback data is answered by the outdated button handler"""
+    payload = CallbackPayload.unpack(data)
+    assert payload is None
+    assert callbacks.resolve(payload) is outdated_button
+
+
+def test_too_long_data_is_rejected():
+    """Callback data longer than Telegram allows is refused when packed"""
+    with pytest.raises(ValueError):
+        pack(Action.TASK, project_id=10**30, task_id=10**30, position=Position.LIST)
+
+
+def test_outdated_inline_button_is_answered():
+    """An outdated button of a message sent in inline mode, which has no message
+    to show the main menu in, is only answered"""
+    answers = []
+    cleared = []
+
+    async def answer(text, show_alert=False):
+        answers.append((text, show_alert))
+
+    async def clear():
+        cleared.append(True)
+
+    callback = SimpleNamespace(message=None, inline_message_id="inline", answer=answer)
+
+    async def _test():
+        await outdated_button(callback, None, SimpleNamespace(clear=clear))
+        # Let the spawned answer run
+        await asyncio.sleep(0)
+
+    asyncio.run(_test())
+    assert cleared == [True]
+    assert answers == [("Кнопка устарела", True)]
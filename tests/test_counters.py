@@ -0,0 +1,107 @@
+"""Tests of the per-status task counters of projects"""
+
+import asyncio
+import random
+
+import pytest
+from sqlalchemy import select
+
+import app.database.requests as rq
+from app.database.models import (
+    PROJECT_COUNTERS,
+    Project,
+    TaskStatus,
+    async_main,
+    async_session,
+    engine,
+)
+
+PROJECTS = ("General", "Дом", "Работа")
+
+
+async def _counters(user_id):
+    async with async_session() as session:
+        rows = await session.execute(
+            select(Project.name, *PROJECT_COUNTERS.values())
+            .where(Project.user_id == user_id)
+            .order_by(Project.id)
+        )
+        return [tuple(row) for row in rows]
+
+
+async def _random_write(rng, user_id, project_ids, names):
+    project_id = rng.choice(project_ids)
+    tasks = await rq.get_project_tasks(project_id, user_id)
+    task_ids = [task.id for task in tasks]
+    picked = rng.sample(task_ids, min(len(task_ids), rng.randint(1, 4)))
+    status = rng.choice(list(TaskStatus))
+    write = rng.choice(
+        ["add", "add", "status", "bulk_status", "delete", "bulk_delete", "move"]
+        + ["import", "clear"]
+    )
+    if write == "add" or not task_ids:
+        # Some names repeat, adding an existing task counts nothing
+        await rq.add_task(project_id, f"Task {rng.randint(0, 30)}", user_id)
+    elif write == "status":
+        version = rng.choice([None, tasks[0].version, tasks[0].version + 1])
+        await rq.change_task_status(
+            task_ids[0], project_id, user_id, status, version=version
+        )
+    elif write == "bulk_status":
+        await rq.change_tasks_status(picked, project_id, user_id, status)
+    elif write == "delete":
+        await rq.delete_task(picked[0], project_id, user_id)
+    elif write == "bulk_delete":
+        await rq.delete_tasks(picked, project_id, user_id)
+    elif write == "move":
+        await rq.move_tasks(picked, project_id, rng.choice(project_ids), user_id)
+    elif write == "import":
+        await rq.import_tasks(
+            user_id,
+            [
+                (
+                    rng.choice(PROJECTS),
+                    f"Task {rng.randint(0, 30)}",
+                    rng.choice(list(TaskStatus)),
+                    "",
+                )
+                for _ in range(rng.randint(1, 5))
+            ],
+        )
+    elif write == "clear" and rng.random() < 0.2:
+        await rq.delete_project_tasks(project_id, user_id)
+    names.append(write)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_counters_match_recount(seed):
+    """After any sequence of task writes the counters equal a recount from the tasks"""
+    rng = random.Random(seed)
+    user_id = 900 + seed
+
+    async def _test():
+        await async_main()
+        await rq.add_user(user_id)
+        project_ids = [(await rq.add_project(user_id, name)).id for name in PROJECTS]
+        names = []
+        for _ in range(200):
+            await _random_write(rng, user_id, project_ids, names)
+        maintained = await _counters(user_id)
+        await rq.recount_project_tasks(project_ids)
+        recounted = await _counters(user_id)
+        await engine.dispose()
+        return maintained, recounted, set(names)
+
+    maintained, recounted, names = asyncio.run(_test())
+    assert maintained == recounted
+    # The sequence exercised every kind of write
+    assert {
+        "add",
+        "status",
+        "bulk_status",
+        "delete",
+        "bulk_delete",
+        "move",
+        "import",
+    } <= names
+    assert sum(sum(counts) for _, *counts in recounted) > 0
@@ -0,0 +1,39 @@
+"""Tests of the parsing of due dates"""
+
+from datetime import datetime, timezone
+
+import pytest
+
+from app.dates import ZONE, parse_due
+
+NOW = datetime(2026, 10, 17, 12, 0)
+
+
+@pytest.mark.parametrize(
+    ("text", "due"),
+    [
+        ("20.10.2026 9:30", datetime(2026, 10, 20, 9, 30)),
+        ("20.10.2025", datetime(2025, 10, 20, 23, 59)),
+        (" 20.10   18:00 ", datetime(2026, 10, 20, 18, 0)),
+        ("17.10", datetime(2026, 10, 17, 23, 59)),
+        # Dates without a year that have passed are next year
+        ("17.10 11:00", datetime(2027, 10, 17, 11, 0)),
+        ("01.01", datetime(2027, 1, 1, 23, 59)),
+        # 29.02 is the next one there is, not refused for 1900
+        ("29.02", datetime(2028, 2, 29, 23, 59)),
+        ("29.02 10:00", datetime(2028, 2, 29, 10, 0)),
+        ("29.02.2028", datetime(2028, 2, 29, 23, 59)),
+    ],
+)
+def test_parse_due(text, due):
+    """Entered dates are parsed as local times and returned in UTC"""
+    expected = due.replace(tzinfo=ZONE).astimezone(timezone.utc).replace(tzinfo=None)
+    assert parse_due(text, now=NOW) == expected
+
+
+@pytest.mark.parametrize(
+    "text", ["", "завтра", "31.02", "29.02.2027", "20.10.2026 25:00", "1.2.3.4"]
+)
+def test_parse_due_refuses_other_text(text):
+    """Text that is not a date, or a date that does not exist, is refused"""
+    assert parse_due(text, now=NOW) is None
@@ -0,0 +1,83 @@
+"""Tests of the number of queries the keyboards issue"""
+
+import asyncio
+from itertools import count
+
+import pytest
+
+import app.database.requests as rq
+import app.kb as kb
+from app.callbacks import Position
+from app.database.cache import keyboards, projects
+from app.database.models import QueryStats, async_main, engine, query_stats
+
+
+async def _statements(build):
+    """Number of statements `build()` executes with cold caches"""
+    keyboards.clear()
+    projects.clear()
+    stats = QueryStats()
+    token = query_stats.set(stats)
+    try:
+        await build()
+    finally:
+        query_stats.reset(token)
+    return stats.statements
+
+
+async def _project(user_id, tasks):
+    await rq.add_user(user_id)
+    general_id = (await rq.add_project(user_id, "General")).id
+    project_id = (await rq.add_project(user_id, "Project")).id
+    task_ids = []
+    for number in range(tasks):
+        task_ids.append((await rq.add_task(project_id, f"Task {number}", user_id)).id)
+        await rq.add_task(general_id, f"General {number}", user_id)
+    return general_id, project_id, task_ids
+
+
+# Every test registers new users in the shared test database
+USER_IDS = count(1000)
+
+KEYBOARDS = {
+    "starting_kb": lambda user_id, general_id, project_id, task_id: kb.starting_kb(
+        user_id
+    ),
+    "projects": lambda user_id, general_id, project_id, task_id: kb.projects(user_id),
+    "project_tasks": lambda user_id, general_id, project_id, task_id: kb.project_tasks(
+        project_id, user_id
+    ),
+    "general_tasks": lambda user_id, general_id, project_id, task_id: kb.general_tasks(
+        general_id, user_id
+    ),
+    "select_tasks": lambda user_id, general_id, project_id, task_id: kb.select_tasks(
+        project_id, user_id, [task_id], Position.LIST
+    ),
+    "move_targets": lambda user_id, general_id, project_id, task_id: kb.move_targets(
+        project_id, user_id, Position.LIST
+    ),
+}
+
+
+@pytest.mark.parametrize("name", KEYBOARDS)
+def test_queries_do_not_depend_on_task_count(name):
+    """A keyboard of a project with many tasks takes as many queries as with one"""
+    build = KEYBOARDS[name]
+
+    async def _test():
+        await async_main()
+        counts = []
+        for tasks in (1, 3 * kb.PAGE_SIZE + 1):
+            user_id = next(USER_IDS)
+            general_id, project_id, task_ids = await _project(user_id, tasks)
+            counts.append(
+                await _statements(
+                    lambda: build(user_id, general_id, project_id, task_ids[-1])
+                )
+            )
+        await engine.dispose()
+        return counts
+
+    one, many = asyncio.run(_test())
+    assert one > 0
+    assert one == many
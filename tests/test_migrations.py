@@ -0,0 +1,86 @@
+"""Tests of the upgrade of databases created by earlier versions of the bot"""
+
+import asyncio
+import sqlite3
+
+from app.database.migrations import run_upgrade
+from app.database.models import Base, create_engine
+
+# The schema created by the first version of the bot, with duplicates it allowed
+BASELINE = """
+CREATE TABLE users (
+    id INTEGER NOT NULL,
+    tg_id BIGINT,
+    PRIMARY KEY (id)
+);
+CREATE TABLE projects (
+    id INTEGER NOT NULL,
+    name VARCHAR(256) NOT NULL,
+    user_id BIGINT NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(user_id) REFERENCES users (tg_id)
+);
+CREATE TABLE tasks (
+    id INTEGER NOT NULL,
+    name VARCHAR(256) NOT NULL,
+    project_id INTEGER NOT NULL,
+    user_id BIGINT NOT NULL,
+    status VARCHAR(10) NOT NULL,
+    emoji VARCHAR NOT NULL,
+    comment VARCHAR NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY(project_id) REFERENCES projects (id) ON DELETE CASCADE,
+    FOREIGN KEY(user_id) REFERENCES users (tg_id)
+);
+INSERT INTO users (id, tg_id) VALUES (1, 1), (2, 2), (3, 2);
+INSERT INTO projects (id, name, user_id) VALUES
+    (1, 'General', 1), (2, 'Дача', 1), (3, 'Дача', 1), (4, 'General', 2);
+INSERT INTO tasks (id, name, project_id, user_id, status, emoji, comment) VALUES
+    (1, 'a', 1, 1, 'NOTSTARTED', '🟣', ''),
+    (2, 'b', 2, 1, 'COMPLETED', '🟢', 'x'),
+    (3, 'b', 2, 1, 'INPROGRESS', '🔵', '');
+"""
+
+
+def test_upgrade_baseline_database(tmp_path):
+    """A database of the first version is upgraded to the latest schema"""
+    path = tmp_path / "baseline.sqlite3"
+    with sqlite3.connect(path) as baseline:
+        baseline.executescript(BASELINE)
+    baseline.close()
+
+    async def _upgrade():
+        engine = create_engine(f"sqlite+aiosqlite:///{path}")
+        try:
+            async with engine.connect() as conn:
+                await conn.run_sync(run_upgrade, Base.metadata)
+            async with engine.connect() as conn:
+
+                async def rows(statement):
+                    return (await conn.exec_driver_sql(statement)).all()
+
+                return (
+                    await rows("SELECT MAX(version) FROM schema_version"),
+                    await rows("SELECT id, tg_id FROM users ORDER BY id"),
+                    await rows(
+                        "SELECT id, name, tasks_notstarted, tasks_inprogress, "
+                        "tasks_completed FROM projects ORDER BY id"
+                    ),
+                    await rows("SELECT id, name, version FROM tasks ORDER BY id"),
+                    await rows("PRAGMA foreign_keys"),
+                )
+        finally:
+            await engine.dispose()
+
+    version, users, projects, tasks, foreign_keys = asyncio.run(_upgrade())
+    assert version == [(6,)]
+    assert users == [(1, 1), (2, 2)]
+    assert projects == [
+        (1, "General", 1, 0, 0),
+        (2, "Дача", 0, 1, 1),
+        (3, "Дача (3)", 0, 0, 0),
+        (4, "General", 0, 0, 0),
+    ]
+    assert tasks == [(1, "a", 1), (2, "b", 1), (3, "b (3)", 1)]
+    # Foreign keys are enforced again on the connection that ran the upgrade
+    assert foreign_keys == [(1,)]
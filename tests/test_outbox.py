@@ -0,0 +1,228 @@
+"""Tests of the outbox against a stubbed bot"""
+
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+from sqlalchemy import select, update
+
+import app.database.requests as rq
+import app.outbox as outbox_module
+from app.database.models import (
+    Broadcast,
+    BroadcastKind,
+    Delivery,
+    DeliveryStatus,
+    User,
+    async_main,
+    async_session,
+    engine,
+)
+from app.outbox import Outbox, TokenBucket
+
+ADMIN_ID = 1400
+
+
+class StubBot:
+    """Records the chats messages are sent to and when, `floods` of the first
+    messages are answered with a flood wait"""
+
+    def __init__(self, floods=0):
+        self.floods = floods
+        self.sent = []
+        self.times = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.floods:
+            self.floods -= 1
+            raise TelegramRetryAfter(
+                SendMessage(chat_id=chat_id, text=text), "Flood control", 1
+            )
+        self.sent.append(chat_id)
+        self.times.append(time.monotonic())
+
+
+async def _until(condition, timeout=5):
+    async with asyncio.timeout(timeout):
+        while not await condition():
+            await asyncio.sleep(0.01)
+
+
+async def _deliveries(broadcast_id):
+    async with async_session() as session:
+        return (
+            await session.scalars(
+                select(Delivery.id).where(Delivery.broadcast_id == broadcast_id)
+            )
+        ).all()
+
+
+async def _finished(broadcast_id):
+    async with async_session() as session:
+        return await session.scalar(
+            select(Broadcast.finished_at).where(Broadcast.id == broadcast_id)
+        )
+
+
+def test_deliveries_of_old_broadcasts_are_deleted():
+    """Once every broadcast is delivered, the deliveries of old ones are deleted"""
+
+    async def _test():
+        await async_main()
+        await rq.add_user(ADMIN_ID)
+        old_id, _ = await rq.create_broadcast(BroadcastKind.MESSAGE, "Старая")
+        outbox = Outbox(rate=1000, chat_rate=1000, retention_days=30)
+        await outbox.start(StubBot())
+        await _until(lambda: _finished(old_id))
+        async with async_session() as session:
+            await session.execute(
+                update(Broadcast)
+                .where(Broadcast.id == old_id)
+                .values(
+                    finished_at=datetime.now(timezone.utc).replace(tzinfo=None)
+                    - timedelta(days=31)
+                )
+            )
+            await session.commit()
+        new_id, _ = await rq.create_broadcast(BroadcastKind.MESSAGE, "Новая")
+        outbox.wake()
+
+        async def deleted():
+            return await _finished(new_id) and not await _deliveries(old_id)
+
+        await _until(deleted)
+        await outbox.close()
+        kept = await _deliveries(new_id)
+        broadcast = await _finished(old_id)
+        await engine.dispose()
+        return kept, broadcast
+
+    kept, broadcast = asyncio.run(_test())
+    assert kept
+    assert broadcast is not None
+
+
+def test_token_bucket(monkeypatch):
+    """Bursts up to the capacity pass at once, the rest wait for the rate"""
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(
+        outbox_module, "time", SimpleNamespace(monotonic=lambda: clock.now)
+    )
+    bucket = TokenBucket(rate=2, capacity=3)
+    assert [bucket.reserve() for _ in range(5)] == [0, 0, 0, 0.5, 1.0]
+    clock.now += 1
+    # Two tokens came back, both already taken by the reservations
+    assert bucket.reserve() == 0.5
+    assert not bucket.idle()
+    clock.now += 10
+    assert bucket.idle()
+
+
+def test_send_keeps_to_the_rates():
+    """Messages to all chats and to one chat are spread out to their rates"""
+
+    async def _test():
+        every_chat, one_chat = StubBot(), StubBot()
+        outbox = Outbox(rate=20, chat_rate=1000)
+        outbox.bot = every_chat
+        started = time.monotonic()
+        sent = await asyncio.gather(
+            *(outbox.send(chat_id, "Текст") for chat_id in range(30))
+        )
+        outbox = Outbox(rate=1000, chat_rate=10)
+        outbox.bot = one_chat
+        sent += await asyncio.gather(*(outbox.send(1, "Текст") for _ in range(3)))
+        return every_chat, one_chat, started, sent
+
+    every_chat, one_chat, started, sent = asyncio.run(_test())
+    assert all(sent)
+    # A burst of 20, then 20 per second
+    assert every_chat.times[-1] - started >= (30 - 20) / 20 - 0.01
+    times = one_chat.times
+    assert all(b - a >= 0.1 - 0.01 for a, b in zip(times, times[1:]))
+
+
+def test_flood_wait_pauses_every_chat():
+    """A flood wait holds back every message for its time, then the message is sent"""
+
+    async def _test():
+        bot = StubBot(floods=1)
+        outbox = Outbox(rate=1000, chat_rate=1000)
+        outbox.bot = bot
+        started = time.monotonic()
+        flooded = asyncio.create_task(outbox.send(1, "Текст"))
+        await asyncio.sleep(0.05)
+        sent = await asyncio.gather(flooded, outbox.send(2, "Текст"))
+        return bot, started, sent
+
+    bot, started, sent = asyncio.run(_test())
+    assert sent == [True, True]
+    assert sorted(bot.sent) == [1, 2]
+    assert all(at - started >= 1 - 0.01 for at in bot.times)
+
+
+def test_unfinished_broadcast_goes_on_after_a_restart():
+    """A restarted outbox sends the deliveries not recorded before it stopped"""
+
+    async def _test():
+        await async_main()
+        for user_id in range(ADMIN_ID, ADMIN_ID + 5):
+            await rq.add_user(user_id)
+        async with async_session() as session:
+            users = set((await session.scalars(select(User.tg_id))).all())
+        broadcast_id, recipients = await rq.create_broadcast(
+            BroadcastKind.MESSAGE, "Новости", created_by=ADMIN_ID
+        )
+        stopped = asyncio.Event()
+
+        class StoppingBot(StubBot):
+            async def send_message(self, chat_id, text, **kwargs):
+                if len(self.sent) == 2:
+                    # The bot stops while the second batch is being sent
+                    await stopped.wait()
+                await super().send_message(chat_id, text, **kwargs)
+
+        first = StoppingBot()
+        outbox = Outbox(rate=1000, chat_rate=1000, batch_size=2)
+        await outbox.start(first)
+
+        async def stuck():
+            # The first batch is recorded, the second one is being sent
+            pending = await rq.get_pending_deliveries(broadcast_id, recipients)
+            return len(pending) == recipients - 2
+
+        await _until(stuck)
+        await outbox.close()
+        pending = await rq.get_pending_deliveries(broadcast_id, recipients)
+
+        second = StubBot()
+        outbox = Outbox(rate=1000, chat_rate=1000, batch_size=2)
+        await outbox.start(second)
+        await _until(lambda: _finished(broadcast_id))
+
+        async def told():
+            # The pending deliveries and the message to the admin
+            return len(second.sent) == len(pending) + 1
+
+        await _until(told)
+        await outbox.close()
+        async with async_session() as session:
+            statuses = (
+                await session.scalars(
+                    select(Delivery.status).where(Delivery.broadcast_id == broadcast_id)
+                )
+            ).all()
+        await engine.dispose()
+        return users, recipients, first, pending, second, statuses
+
+    users, recipients, first, pending, second, statuses = asyncio.run(_test())
+    assert recipients == len(users) > 2
+    assert len(pending) == recipients - 2
+    # The recorded batch is not sent again, the rest is sent once, then the admin is told
+    assert set(first.sent).isdisjoint(second.sent[:-1])
+    assert sorted(first.sent + second.sent[:-1]) == sorted(users)
+    assert second.sent[-1] == ADMIN_ID
+    assert set(statuses) == {DeliveryStatus.SENT}
@@ -0,0 +1,179 @@
+"""Tests of the reminder scheduler against a stubbed outbox"""
+
+import asyncio
+from datetime import timedelta
+
+from sqlalchemy import select, update
+
+import app.database.requests as rq
+import app.scheduler as scheduler_module
+from app.database.models import Task, async_main, async_session, engine
+from app.scheduler import REMINDER_RETRY, ReminderScheduler
+
+USER_ID = 1300
+
+
+async def _add_reminders(names, late=timedelta(minutes=1)):
+    """Adds tasks with reminders that are already due, returns their IDs"""
+    async with async_session() as session:
+        # Reminders left by other tests would be sent too
+        await session.execute(update(Task).values(remind_at=None))
+        await session.commit()
+    await rq.add_user(USER_ID)
+    project_id = (await rq.add_project(USER_ID, "General")).id
+    due_at = scheduler_module._now() - late
+    task_ids = []
+    for name in names:
+        task = await rq.add_task(project_id, name, USER_ID)
+        await rq.set_task_due(task.id, project_id, USER_ID, due_at)
+        task_ids.append(task.id)
+    return task_ids
+
+
+async def _remind_at(task_ids):
+    async with async_session() as session:
+        rows = await session.execute(
+            select(Task.id, Task.remind_at).where(Task.id.in_(task_ids))
+        )
+        return dict(rows.all())
+
+
+async def _until(condition, timeout=5):
+    async with asyncio.timeout(timeout):
+        while not await condition():
+            await asyncio.sleep(0.01)
+
+
+class StubOutbox:
+    """Records the reminders sent and the pending reminders at the time of sending"""
+
+    def __init__(self, task_ids, result=True):
+        self.task_ids = task_ids
+        self.result = result
+        self.sent = []
+        self.pending = []
+
+    async def send(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        self.pending.append(await _remind_at(self.task_ids))
+        return self.result
+
+
+def test_reminders_are_cleared_after_they_are_sent(monkeypatch):
+    """Due reminders are sent, then cleared, failed ones are moved to a retry"""
+
+    async def _test():
+        await async_main()
+        task_ids = await _add_reminders(["Позвонить", "Написать"])
+        stub = StubOutbox(task_ids)
+        monkeypatch.setattr(scheduler_module.outbox, "send", stub.send)
+        scheduler = ReminderScheduler()
+        await scheduler.start()
+
+        async def cleared():
+            return not any((await _remind_at(task_ids)).values())
+
+        await _until(cleared)
+        # A failed reminder is kept for the retry
+        stub.result = False
+        failed_id = (await _add_reminders(["Купить"]))[0]
+        stub.task_ids = [failed_id]
+        scheduler.schedule(failed_id, (await _remind_at([failed_id]))[failed_id])
+
+        async def retried():
+            remind_at = (await _remind_at([failed_id]))[failed_id]
+            return (
+                remind_at is not None
+                and remind_at > scheduler_module._now() + REMINDER_RETRY / 2
+            )
+
+        await _until(retried)
+        await scheduler.close()
+        await engine.dispose()
+        return stub
+
+    stub = asyncio.run(_test())
+    assert [chat_id for chat_id, _ in stub.sent] == [USER_ID] * 3
+    for name in ("Позвонить", "Написать", "Купить"):
+        assert sum(f'{name}"' in text for _, text in stub.sent) == 1
+    # Every reminder was still pending in the database while it was sent
+    assert all(all(pending.values()) for pending in stub.pending)
+
+
+def test_batches_are_read_again_once_sent(monkeypatch):
+    """More due reminders than the batch size are read and sent batch by batch"""
+
+    async def _test():
+        await async_main()
+        task_ids = await _add_reminders([f"Задача {i}" for i in range(7)])
+        stub = StubOutbox(task_ids)
+        monkeypatch.setattr(scheduler_module.outbox, "send", stub.send)
+        reads = []
+        get_next_reminders = rq.get_next_reminders
+
+        async def counted(limit):
+            reminders = await get_next_reminders(limit)
+            reads.append(len(reminders))
+            return reminders
+
+        monkeypatch.setattr(rq, "get_next_reminders", counted)
+        scheduler = ReminderScheduler(size=3)
+        await scheduler.start()
+
+        async def cleared():
+            return not any((await _remind_at(task_ids)).values())
+
+        await _until(cleared)
+        await scheduler.close()
+        await engine.dispose()
+        return stub, reads
+
+    stub, reads = asyncio.run(_test())
+    # Every reminder is sent once, although a batch read while the previous one
+    # is being sent holds some of its reminders again
+    assert len({text for _, text in stub.sent}) == len(stub.sent) == 7
+    assert max(reads) == 3
+    assert len(reads) >= 3
+
+
+def test_pending_reminders_are_sent_after_a_restart(monkeypatch):
+    """Reminders that were being sent when the bot stopped are sent by the next run"""
+
+    async def _test():
+        await async_main()
+        task_ids = await _add_reminders(["Позвонить", "Написать"])
+        stuck = asyncio.Event()
+        first = []
+
+        async def stuck_send(chat_id, text, **kwargs):
+            first.append(text)
+            # The bot stops before Telegram answers
+            await stuck.wait()
+
+        monkeypatch.setattr(scheduler_module.outbox, "send", stuck_send)
+        scheduler = ReminderScheduler()
+        await scheduler.start()
+
+        async def sending():
+            return len(first) == len(task_ids)
+
+        await _until(sending)
+        await scheduler.close()
+        pending = await _remind_at(task_ids)
+
+        stub = StubOutbox(task_ids)
+        monkeypatch.setattr(scheduler_module.outbox, "send", stub.send)
+        restarted = ReminderScheduler()
+        await restarted.start()
+
+        async def cleared():
+            return not any((await _remind_at(task_ids)).values())
+
+        await _until(cleared)
+        await restarted.close()
+        await engine.dispose()
+        return pending, stub
+
+    pending, stub = asyncio.run(_test())
+    assert all(pending.values())
+    assert len(stub.sent) == 2
@@ -0,0 +1,63 @@
+"""Tests of the full-text search of tasks"""
+
+import asyncio
+
+from sqlalchemy.dialects import postgresql
+
+import app.database.requests as rq
+from app.database.models import async_main, engine
+
+USER_ID = 1200
+# The ID of the other user is a prefix of USER_ID, the words of one must not match the other
+OTHER_USER_ID = 12
+
+
+async def _names(user_id, query, **kwargs):
+    return [task.name for task in await rq.search_tasks(user_id, query, **kwargs)]
+
+
+def test_search_is_scoped_ranked_and_kept_current():
+    """Word prefixes match the tasks of the user only, names ranking above comments"""
+
+    async def _test():
+        await async_main()
+        results = {}
+        for user_id in (OTHER_USER_ID, USER_ID):
+            await rq.add_user(user_id)
+            project_id = (await rq.add_project(user_id, "General")).id
+            await rq.add_task(project_id, f"Купить молоко {user_id}", user_id)
+        bread = await rq.add_task(project_id, "Хлеб", USER_ID)
+        await rq.chgange_task_comment(bread.id, project_id, USER_ID, "и молоко")
+        results["prefix"] = await _names(USER_ID, "мол")
+        results["other user"] = await _names(OTHER_USER_ID, "мол")
+        results["every word"] = await _names(USER_ID, "куп, мол!")
+        results["page"] = await _names(USER_ID, "мол", limit=1, offset=1)
+        results["no words"] = await _names(USER_ID, '"*')
+        await rq.rename_task(bread.id, project_id, USER_ID, "Батон")
+        results["renamed"] = await _names(USER_ID, "бат")
+        results["old name"] = await _names(USER_ID, "хлеб")
+        await rq.delete_task(bread.id, project_id, USER_ID)
+        results["deleted"] = await _names(USER_ID, "бат")
+        await engine.dispose()
+        return results
+
+    results = asyncio.run(_test())
+    assert results == {
+        "prefix": [f"Купить молоко {USER_ID}", "Хлеб"],
+        "other user": [f"Купить молоко {OTHER_USER_ID}"],
+        "every word": [f"Купить молоко {USER_ID}"],
+        "page": ["Хлеб"],
+        "no words": [],
+        "renamed": ["Батон"],
+        "old name": [],
+        "deleted": [],
+    }
+
+
+def test_postgresql_document_matches_index():
+    """The searched expression compiles to the expression of the GIN index"""
+    compiled = rq._task_search_document().compile(dialect=postgresql.dialect())
+    assert str(compiled) == (
+        "to_tsvector('simple', tasks.name || ' ' || tasks.comment)"
+    )
+    assert compiled.params == {}
@@ -0,0 +1,128 @@
+"""Tests of the FSM storage backed by the bot database"""
+
+import asyncio
+from datetime import timedelta
+
+from aiogram import Dispatcher
+from aiogram.fsm.storage.base import StorageKey
+
+import app.database.storage as storage_module
+from app.database.models import QueryStats, async_main, engine, query_stats
+from app.database.storage import (
+    DatabaseFSMContext,
+    DatabaseFSMContextMiddleware,
+    DatabaseStorage,
+    use_database_context,
+)
+from app.database.writer import writer
+
+
+def _key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def _run(test):
+    async def _test():
+        await async_main()
+        try:
+            return await test()
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(_test())
+
+
+async def _statements(awaitable):
+    stats = QueryStats()
+    token = query_stats.set(stats)
+    try:
+        result = await awaitable
+    finally:
+        query_stats.reset(token)
+    return stats.statements, result
+
+
+def test_cache():
+    """Records are read from the cache, evicted ones from the database"""
+
+    async def _test():
+        storage = DatabaseStorage(cache_size=2)
+        for user_id in (101, 102, 103):
+            await storage.set_state(_key(user_id), f"state {user_id}")
+            await storage.set_data(_key(user_id), {"user_id": user_id})
+        cached = await _statements(storage.get_state(_key(103)))
+        evicted = await _statements(storage.get_data(_key(101)))
+        # A fresh storage reads what the first one wrote
+        stored = await DatabaseStorage().get_state(_key(102))
+        return cached, evicted, stored
+
+    cached, evicted, stored = _run(_test)
+    assert cached == (0, "state 103")
+    assert evicted[0] > 0
+    assert evicted[1] == {"user_id": 101}
+    assert stored == "state 102"
+
+
+def test_ttl(monkeypatch):
+    """Records untouched for longer than the TTL are read as empty and cleaned up"""
+
+    async def _test():
+        storage = DatabaseStorage(ttl=60)
+        await storage.set_state(_key(201), "state")
+        await storage.set_data(_key(201), {"a": 1})
+        await storage.set_state(_key(202), "state")
+        now = storage_module._now()
+        monkeypatch.setattr(storage_module, "_now", lambda: now + timedelta(seconds=61))
+        expired = (
+            await storage.get_state(_key(201)),
+            await storage.get_data(_key(201)),
+        )
+        deleted = await storage.cleanup()
+        after = await DatabaseStorage(ttl=60).get_state(_key(201))
+        return expired, deleted, after
+
+    expired, deleted, after = _run(_test)
+    assert expired == (None, {})
+    assert deleted >= 2
+    assert after is None
+
+
+def test_clear_is_one_write(monkeypatch):
+    """Clearing a flow deletes its record with a single write"""
+    writes = []
+    submit = writer.submit
+
+    async def counting_submit(operation):
+        writes.append(operation)
+        return await submit(operation)
+
+    async def _test():
+        storage = DatabaseStorage()
+        context = DatabaseFSMContext(storage=storage, key=_key(301))
+        await context.set_state("state")
+        await context.update_data(a=1)
+        monkeypatch.setattr(writer, "submit", counting_submit)
+        await context.clear()
+        cleared = len(writes)
+        # Clearing an empty flow writes nothing
+        await context.clear()
+        return cleared, len(writes), await DatabaseStorage().get_data(_key(301))
+
+    cleared, total, data = _run(_test)
+    assert cleared == 1
+    assert total == 1
+    assert data == {}
+
+
+def test_use_database_context():
+    """The dispatcher gives handlers the database FSM context"""
+    storage = DatabaseStorage()
+    dispatcher = Dispatcher(storage=storage)
+    use_database_context(dispatcher)
+    assert isinstance(dispatcher.fsm, DatabaseFSMContextMiddleware)
+    assert dispatcher.fsm in dispatcher.update.outer_middleware
+    assert dispatcher.fsm.storage is storage
+    context = dispatcher.fsm.get_context(
+        bot=type("Bot", (), {"id": 1})(), chat_id=1, user_id=1
+    )
+    assert isinstance(context, DatabaseFSMContext)
@@ -0,0 +1,58 @@
+"""Tests of the webhook request handler, posting updates with a local HTTP client"""
+
+import asyncio
+
+from aiogram import Bot, Dispatcher, Router
+from aiogram.types import Message
+from aiohttp.test_utils import TestClient, TestServer
+
+import app.config as config
+from app.webhook import create_app
+
+SECRET = "test-secret"
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 42, "type": "private"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+        "text": "hello",
+    },
+}
+
+
+def test_webhook(monkeypatch):
+    """Only requests with the secret token are accepted and their updates handled"""
+    monkeypatch.setattr(config, "WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(config, "WEBHOOK_PATH", "/webhook")
+
+    async def _test():
+        received = asyncio.Queue()
+        router = Router()
+
+        @router.message()
+        async def echo(message: Message):
+            await received.put(message.text)
+
+        dispatcher = Dispatcher()
+        dispatcher.include_router(router)
+        bot = Bot("42:TEST")
+        async with TestClient(TestServer(create_app(bot, dispatcher))) as client:
+            statuses = []
+            for headers in (
+                {},
+                {"X-Telegram-Bot-Api-Secret-Token": "wrong"},
+                {"X-Telegram-Bot-Api-Secret-Token": SECRET},
+            ):
+                response = await client.post("/webhook", json=UPDATE, headers=headers)
+                statuses.append(response.status)
+            text = await asyncio.wait_for(received.get(), 5)
+            # Rejected requests are not queued
+            assert received.empty()
+        return statuses, text
+
+    statuses, text = asyncio.run(_test())
+    assert statuses == [401, 401, 200]
+    assert text == "hello"
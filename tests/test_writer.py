@@ -0,0 +1,119 @@
+"""Tests of the single writer and its group commit"""
+
+import asyncio
+
+import pytest
+from sqlalchemy import event, select
+
+from app.database.models import User, async_main, async_session, engine
+from app.database.writer import Writer
+
+
+def _insert(tg_id, fail=False):
+    async def _write(session):
+        session.add(User(tg_id=tg_id))
+        await session.flush()
+        if fail:
+            raise ValueError(tg_id)
+        return tg_id
+
+    return _write
+
+
+async def _users(*tg_ids):
+    async with async_session() as session:
+        result = await session.scalars(select(User.tg_id).where(User.tg_id.in_(tg_ids)))
+        return set(result)
+
+
+def _run(test):
+    async def _test():
+        await async_main()
+        commits = []
+        listener = lambda conn: commits.append(conn)  # noqa: E731
+        event.listen(engine.sync_engine, "commit", listener)
+        writer = Writer()
+        await writer.start()
+        try:
+            return await test(writer), len(commits)
+        finally:
+            await writer.close()
+            event.remove(engine.sync_engine, "commit", listener)
+            await engine.dispose()
+
+    return asyncio.run(_test())
+
+
+def test_failing_operation_is_isolated():
+    """A failing operation is rolled back to its savepoint, the others of the batch commit"""
+
+    async def _test(writer):
+        results = await asyncio.gather(
+            writer.submit(_insert(401)),
+            writer.submit(_insert(402, fail=True)),
+            writer.submit(_insert(403)),
+            return_exceptions=True,
+        )
+        return results, await _users(401, 402, 403)
+
+    (results, users), commits = _run(_test)
+    assert results[0] == 401
+    assert isinstance(results[1], ValueError)
+    assert results[2] == 403
+    assert users == {401, 403}
+    assert commits == 1
+
+
+def test_commit_failure_reaches_every_waiter():
+    """When the commit of a batch fails, every operation of the batch fails with it"""
+
+    def fail_commit(conn):
+        raise RuntimeError("commit failed")
+
+    async def _failing_commit(session):
+        # Savepoints are released without the event, only the commit of the batch fails
+        event.listen(engine.sync_engine, "commit", fail_commit, once=True)
+
+    async def _test(writer):
+        results = await asyncio.gather(
+            writer.submit(_insert(501)),
+            writer.submit(_failing_commit),
+            writer.submit(_insert(502)),
+            return_exceptions=True,
+        )
+        return results, await _users(501, 502)
+
+    (results, users), _ = _run(_test)
+    assert [type(result) for result in results] == [RuntimeError] * 3
+    assert users == set()
+
+
+def test_close_drains_queued_writes():
+    """Writes queued when the writer is closed are applied before it stops"""
+
+    async def _test(writer):
+        tasks = [
+            asyncio.ensure_future(writer.submit(_insert(tg_id)))
+            for tg_id in range(601, 611)
+        ]
+        await asyncio.sleep(0)
+        await writer.close()
+        assert all(task.done() for task in tasks)
+        return [task.result() for task in tasks], await _users(*range(601, 611))
+
+    (results, users), _ = _run(_test)
+    assert results == list(range(601, 611))
+    assert users == set(range(601, 611))
+
+
+@pytest.mark.parametrize("size", [1, 3])
+def test_batches_are_bounded(size):
+    """At most `batch_size` operations share a transaction"""
+
+    async def _test(writer):
+        writer.batch_size = size
+        base = 700 + size * 10
+        await asyncio.gather(*(writer.submit(_insert(base + n)) for n in range(6)))
+
+    _, commits = _run(_test)
+    assert commits == 6 // size